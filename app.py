@@ -1,14 +1,47 @@
 import streamlit as st
-import pandas as pd
-import numpy as np
 from datetime import datetime, date
-import plotly.express as px
-import plotly.graph_objects as go
+import importlib
 import io
 import os
+import hashlib
+import hmac
+import secrets
+import shutil
+import unicodedata
+import sys
 import json
+import time
+import cProfile
+import pstats
+import threading
+from collections import Counter
 from pathlib import Path
 
+# -------------------------------------------------------------------
+# IMPORTACIONES DIFERIDAS
+# -------------------------------------------------------------------
+class _ModuloDiferido:
+    """
+    Proxy que importa el módulo real en el primer acceso a un atributo.
+    Evita cargar pandas, numpy y plotly en la pantalla de login, que no los necesita.
+    """
+    
+    def __init__(self, nombre):
+        self._nombre = nombre
+        self._modulo = None
+    
+    def __getattr__(self, atributo):
+        if self._modulo is None:
+            # import_module es seguro entre hilos (sesiones concurrentes)
+            self._modulo = importlib.import_module(self._nombre)
+        return getattr(self._modulo, atributo)
+
+pd = _ModuloDiferido('pandas')
+np = _ModuloDiferido('numpy')
+pa = _ModuloDiferido('pyarrow')
+px = _ModuloDiferido('plotly.express')
+go = _ModuloDiferido('plotly.graph_objects')
+
 # -------------------------------------------------------------------
 # CONFIGURACIÓN DE COLORES CORPORATIVOS
 # -------------------------------------------------------------------
@@ -33,7 +66,10 @@ st.set_page_config(
 )
 
 # CSS personalizado con los colores corporativos
-st.markdown(f"""
+@st.cache_resource
+def construir_css():
+    """Construye el bloque CSS una sola vez por proceso"""
+    return f"""
 <style>
     /* Colores principales */
     :root {{
@@ -182,10 +218,14 @@ st.markdown(f"""
         color: {COLORES['secondary']};
     }}
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(construir_css(), unsafe_allow_html=True)
 
 # -------------------------------------------------------------------
 # PROFESIONALES_INFO - Diccionario de médicos ACTUALIZADO
+# Solo se usa como catálogo inicial: el catálogo vigente se edita desde
+# el panel de administración (ver CATÁLOGO DE PROFESIONALES)
 # -------------------------------------------------------------------
 PROFESIONALES_INFO = {
     "FALLONE, JAN": {"especialidad": "HOMBRO Y CODO", "tipo": "CONSULTOR"},
@@ -216,6 +256,7 @@ def cargar_usuarios():
     """
     Carga los usuarios y credenciales desde Streamlit Secrets.
     En local usa .streamlit/secrets.toml si existe.
+    No llamar directamente: usar obtener_almacen_credenciales().
     """
     
     try:
@@ -398,6 +439,81 @@ def cargar_usuarios():
     usuarios.update(medicos)
     return usuarios
 
+# -------------------------------------------------------------------
+# ALMACÉN DE CREDENCIALES (HASHES CON SAL, CACHEADO POR PROCESO)
+# -------------------------------------------------------------------
+ALGORITMO_HASH = 'pbkdf2_sha256'
+ITERACIONES_HASH = 100_000
+RUTAS_SECRETS = ['.streamlit/secrets.toml', os.path.expanduser('~/.streamlit/secrets.toml')]
+
+def generar_hash_password(password, sal=None, iteraciones=ITERACIONES_HASH):
+    """
+    Genera un hash PBKDF2 con sal en formato 'pbkdf2_sha256$iteraciones$sal$hash'.
+    Este formato también puede guardarse directamente en secrets.toml
+    en lugar de la contraseña en claro.
+    """
+    sal = sal if sal is not None else secrets.token_bytes(16)
+    derivada = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), sal, iteraciones)
+    return f"{ALGORITMO_HASH}${iteraciones}${sal.hex()}${derivada.hex()}"
+
+class AlmacenCredenciales:
+    """Índice de usuarios con contraseñas hasheadas y verificación en tiempo constante"""
+    
+    def __init__(self, usuarios):
+        self._hashes = {}
+        self._usuarios = {}
+        
+        for username, info in usuarios.items():
+            password = str(info.get('password', ''))
+            if not password.startswith(ALGORITMO_HASH + '$'):
+                password = generar_hash_password(password)
+            self._hashes[username] = password
+            # La información de sesión nunca incluye la contraseña
+            self._usuarios[username] = {k: v for k, v in info.items() if k != 'password'}
+        
+        # Hash ficticio para que un usuario inexistente cueste lo mismo que uno real
+        self._hash_ficticio = generar_hash_password(secrets.token_hex(8))
+    
+    @staticmethod
+    def _comparar(password, hash_guardado):
+        """Recalcula el hash con la sal guardada y compara en tiempo constante"""
+        try:
+            _, iteraciones, sal_hex, _ = hash_guardado.split('$')
+            candidato = generar_hash_password(password, bytes.fromhex(sal_hex), int(iteraciones))
+        except ValueError:
+            return False
+        return hmac.compare_digest(candidato.encode('utf-8'), hash_guardado.encode('utf-8'))
+    
+    def verificar(self, username, password):
+        """Devuelve la información del usuario si las credenciales son válidas, None si no"""
+        hash_guardado = self._hashes.get(username, self._hash_ficticio)
+        valido = self._comparar(password, hash_guardado)
+        if valido and username in self._usuarios:
+            return dict(self._usuarios[username])
+        return None
+    
+    def __contains__(self, username):
+        return username in self._usuarios
+
+def _firma_secrets():
+    """Fecha de modificación de los ficheros de secrets (clave de recarga del almacén)"""
+    firma = []
+    for ruta in RUTAS_SECRETS:
+        try:
+            firma.append(os.stat(ruta).st_mtime_ns)
+        except OSError:
+            firma.append(None)
+    return tuple(firma)
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def _construir_almacen_credenciales(firma):
+    """Construye el almacén una vez por proceso y por versión de los secrets"""
+    return AlmacenCredenciales(cargar_usuarios())
+
+def obtener_almacen_credenciales():
+    """Obtiene el almacén de credenciales, recargándolo si cambió secrets.toml"""
+    return _construir_almacen_credenciales(_firma_secrets())
+
 # -------------------------------------------------------------------
 # FUNCIÓN PARA MOSTRAR HEADER CON LOGO
 # -------------------------------------------------------------------
@@ -443,9 +559,6 @@ def mostrar_header():
 def check_password():
     """Sistema de autenticación con Streamlit Secrets"""
     
-    # Cargar usuarios desde secrets
-    USUARIOS = cargar_usuarios()
-    
     def login_form():
         with st.form("Credentials"):
             # Mostrar header en login
@@ -462,10 +575,12 @@ def check_password():
             submitted = st.form_submit_button("Iniciar Sesión", use_container_width=True)
             
             if submitted:
-                if username in USUARIOS and password == USUARIOS[username]["password"]:
+                # El almacén solo se construye al enviar el formulario, no al pintar el login
+                user_info = obtener_almacen_credenciales().verificar(username, password)
+                if user_info is not None:
                     st.session_state["authentication_status"] = True
                     st.session_state["username"] = username
-                    st.session_state["user_info"] = USUARIOS[username]
+                    st.session_state["user_info"] = user_info
                     st.rerun()
                 else:
                     st.error("Usuario o contraseña incorrectos")
@@ -491,7 +606,27 @@ def logout():
 # GESTIÓN DE DATOS PERSISTENTES
 # -------------------------------------------------------------------
 class DataManager:
-    """Gestiona el almacenamiento persistente de datos"""
+    """
+    Gestiona el almacenamiento persistente de datos.
+    
+    Los datos médicos se publican como versiones inmutables: cada carga crea un
+    directorio versiones/<id>/ con el parquet y sus metadatos, y el archivo
+    VERSION_ACTUAL apunta a la vigente. El puntero se sustituye con os.replace
+    (atómico), así que un lector siempre ve una versión completa aunque otra
+    sesión esté escribiendo la siguiente, y volver a una versión anterior es
+    solo mover el puntero.
+    
+    Cada versión lleva además una copia Arrow IPC sin comprimir que se abre
+    con memory-map: todos los procesos y sesiones comparten las mismas páginas
+    de la caché del sistema en lugar de tener cada uno su copia de pandas.
+    """
+    
+    ARCHIVO_DATOS = 'medical_data.parquet'
+    ARCHIVO_ARROW = 'medical_data.arrow'
+    ARCHIVO_METADATOS = 'upload_metadata.json'
+    DIRECTORIO_VERSIONES = 'versiones'
+    PUNTERO_VERSION = 'VERSION_ACTUAL'
+    MAX_VERSIONES = 10
     
     @staticmethod
     def get_data_path():
@@ -508,20 +643,35 @@ class DataManager:
         return data_dir
     
     @staticmethod
-    def save_dataframe(df, filename='medical_data.parquet'):
-        """Guarda el DataFrame de manera persistente"""
+    def _escribir_atomico(path, escribir):
+        """Escribe en un temporal junto al destino y lo publica con os.replace"""
+        temporal = f"{path}.{secrets.token_hex(4)}.tmp"
+        try:
+            escribir(temporal)
+            os.replace(temporal, path)
+        finally:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+    
+    @staticmethod
+    def save_dataframe(df, filename=ARCHIVO_DATOS):
+        """Guarda el DataFrame de manera persistente (los datos médicos, como nueva versión)"""
+        if filename == DataManager.ARCHIVO_DATOS:
+            return DataManager.publicar_version(df, DataManager.get_upload_metadata() or {}) is not None
         try:
             path = os.path.join(DataManager.get_data_path(), filename)
-            df.to_parquet(path, index=False)
+            DataManager._escribir_atomico(path, lambda destino: df.to_parquet(destino, index=False))
             return True
         except Exception as e:
             st.error(f"Error guardando datos: {e}")
             return False
     
     @staticmethod
-    def load_dataframe(filename='medical_data.parquet'):
-        """Carga el DataFrame guardado"""
+    def load_dataframe(filename=ARCHIVO_DATOS, version=None):
+        """Carga el DataFrame guardado (los datos médicos de la versión vigente o de la indicada)"""
         try:
+            if filename == DataManager.ARCHIVO_DATOS:
+                return DataManager._cargar_datos_version(version)
             path = os.path.join(DataManager.get_data_path(), filename)
             if os.path.exists(path):
                 return pd.read_parquet(path)
@@ -531,10 +681,14 @@ class DataManager:
             return None
     
     @staticmethod
-    def get_upload_metadata():
-        """Obtiene metadatos de la última carga"""
+    def get_upload_metadata(version=None):
+        """Obtiene metadatos de la carga vigente (o de la versión indicada)"""
         try:
-            path = os.path.join(DataManager.get_data_path(), 'upload_metadata.json')
+            version = version or DataManager.version_actual()
+            if version:
+                path = os.path.join(DataManager._ruta_versiones(), version, DataManager.ARCHIVO_METADATOS)
+            else:
+                path = os.path.join(DataManager.get_data_path(), DataManager.ARCHIVO_METADATOS)
             if os.path.exists(path):
                 with open(path, 'r') as f:
                     return json.load(f)
@@ -542,195 +696,1310 @@ class DataManager:
         except:
             return None
     
+    # --- Versiones de los datos ---
+    
+    @staticmethod
+    def _ruta_versiones():
+        path = os.path.join(DataManager.get_data_path(), DataManager.DIRECTORIO_VERSIONES)
+        Path(path).mkdir(parents=True, exist_ok=True)
+        return path
+    
     @staticmethod
-    def save_upload_metadata(metadata):
-        """Guarda metadatos de la carga"""
+    def version_actual():
+        """Identificador de la versión vigente (None si aún no se ha publicado ninguna)"""
         try:
-            path = os.path.join(DataManager.get_data_path(), 'upload_metadata.json')
-            with open(path, 'w') as f:
-                json.dump(metadata, f)
-            return True
-        except:
-            return False
-
-# -------------------------------------------------------------------
-# FUNCIONES DE PROCESAMIENTO
-# -------------------------------------------------------------------
-def procesar_datos(df):
-    """Procesa el DataFrame cargado"""
-    df_procesado = df.copy()
+            with open(os.path.join(DataManager.get_data_path(), DataManager.PUNTERO_VERSION), 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
     
-    # Convertir columnas de fecha
-    if 'Fecha del Servicio' in df_procesado.columns:
-        df_procesado['Fecha del Servicio'] = pd.to_datetime(df_procesado['Fecha del Servicio'], errors='coerce')
+    @staticmethod
+    def _ruta_datos_version(version=None):
+        """Parquet de una versión; sin versiones publicadas, el archivo suelto de instalaciones anteriores"""
+        version = version or DataManager.version_actual()
+        if version is None:
+            return os.path.join(DataManager.get_data_path(), DataManager.ARCHIVO_DATOS)
+        return os.path.join(DataManager._ruta_versiones(), version, DataManager.ARCHIVO_DATOS)
     
-    # Asegurar columnas numéricas
-    if 'Importe HHMM' in df_procesado.columns:
-        df_procesado['Importe HHMM'] = pd.to_numeric(df_procesado['Importe HHMM'], errors='coerce')
+    @staticmethod
+    def _cargar_datos_version(version=None):
+        """
+        Datos de una versión desde su copia Arrow mapeada en memoria (compartida
+        por todas las sesiones del proceso; es de solo lectura). Las versiones
+        anteriores a la copia Arrow la generan la primera vez que se leen.
+        """
+        path = DataManager._ruta_datos_version(version)
+        if not os.path.exists(path):
+            return None
+        if version is None and DataManager.version_actual() is None:
+            return ordenar_por_fecha(pd.read_parquet(path))
+        ruta_arrow = os.path.join(os.path.dirname(path), DataManager.ARCHIVO_ARROW)
+        if not os.path.exists(ruta_arrow):
+            DataManager._escribir_atomico(ruta_arrow, lambda destino: DataManager._escribir_arrow(pd.read_parquet(path), destino))
+        return _leer_arrow_mapeado(ruta_arrow, _firma_archivo(ruta_arrow))
     
-    if '% Liquidación' in df_procesado.columns:
-        df_procesado['% Liquidación'] = pd.to_numeric(df_procesado['% Liquidación'], errors='coerce')
+    @staticmethod
+    def _escribir_arrow(df, path):
+        """Arrow IPC (Feather v2) sin comprimir, para poder mapearlo sin descomprimir"""
+        ordenar_por_fecha(df).to_feather(path, compression='uncompressed')
     
-    # Crear columna de Importe Total (100%)
-    if 'Importe HHMM' in df_procesado.columns and '% Liquidación' in df_procesado.columns:
-        df_procesado['Importe Total'] = df_procesado.apply(
-            lambda row: (row['Importe HHMM'] / (row['% Liquidación'] / 100)) 
-            if pd.notnull(row['Importe HHMM']) and pd.notnull(row['% Liquidación']) and row['% Liquidación'] > 0 
-            else row['Importe HHMM'], 
-            axis=1
-        )
+    @staticmethod
+    def firma_version():
+        """Clave barata de la versión de los datos para las cachés"""
+        return DataManager.version_actual() or _firma_archivo(DataManager._ruta_datos_version())
     
-    # Añadir información de especialidad y tipo de médico
-    if 'Profesional' in df_procesado.columns:
-        df_procesado['Subespecialidad'] = df_procesado['Profesional'].map(
-            lambda x: PROFESIONALES_INFO.get(str(x).strip(), {}).get('especialidad', 'NO ESPECIFICADA')
+    @staticmethod
+    def _apuntar_version(version):
+        DataManager._escribir_atomico(
+            os.path.join(DataManager.get_data_path(), DataManager.PUNTERO_VERSION),
+            lambda destino: Path(destino).write_text(version)
         )
-        df_procesado['Tipo Médico'] = df_procesado['Profesional'].map(
-            lambda x: PROFESIONALES_INFO.get(str(x).strip(), {}).get('tipo', 'NO ESPECIFICADO')
+    
+    @staticmethod
+    def publicar_version(df, metadata):
+        """
+        Escribe datos y metadatos juntos en un directorio temporal, lo renombra
+        a versiones/<id>/ y mueve el puntero. Devuelve el id o None si falla.
+        """
+        try:
+            versiones = DataManager._ruta_versiones()
+            DataManager._migrar_datos_sueltos()
+            df = ordenar_por_fecha(df)
+            version = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{secrets.token_hex(2)}"
+            temporal = os.path.join(versiones, f".{version}.tmp")
+            os.mkdir(temporal)
+            try:
+                df.to_parquet(os.path.join(temporal, DataManager.ARCHIVO_DATOS), index=False)
+                DataManager._escribir_arrow(df, os.path.join(temporal, DataManager.ARCHIVO_ARROW))
+                with open(os.path.join(temporal, DataManager.ARCHIVO_METADATOS), 'w') as f:
+                    json.dump({**metadata, 'version': version}, f)
+                os.replace(temporal, os.path.join(versiones, version))
+            finally:
+                if os.path.exists(temporal):
+                    shutil.rmtree(temporal, ignore_errors=True)
+            DataManager._apuntar_version(version)
+            DataManager._podar_versiones()
+            return version
+        except Exception as e:
+            st.error(f"Error guardando datos: {e}")
+            return None
+    
+    @staticmethod
+    def _migrar_datos_sueltos():
+        """Convierte los datos guardados antes de las versiones en la primera versión"""
+        suelto = os.path.join(DataManager.get_data_path(), DataManager.ARCHIVO_DATOS)
+        if DataManager.version_actual() is not None or not os.path.exists(suelto):
+            return
+        metadata = DataManager.get_upload_metadata() or {}
+        version = f"{datetime.fromtimestamp(os.path.getmtime(suelto)).strftime('%Y%m%d-%H%M%S-%f')}-0000"
+        destino = os.path.join(DataManager._ruta_versiones(), version)
+        Path(destino).mkdir(exist_ok=True)
+        shutil.copy2(suelto, os.path.join(destino, DataManager.ARCHIVO_DATOS))
+        with open(os.path.join(destino, DataManager.ARCHIVO_METADATOS), 'w') as f:
+            json.dump({**metadata, 'version': version}, f)
+        DataManager._apuntar_version(version)
+    
+    @staticmethod
+    def listar_versiones():
+        """Versiones publicadas, de la más reciente a la más antigua, con sus metadatos"""
+        versiones = DataManager._ruta_versiones()
+        nombres = sorted(
+            (n for n in os.listdir(versiones) if not n.startswith('.') and os.path.isdir(os.path.join(versiones, n))),
+            reverse=True
         )
+        return [{**(DataManager.get_upload_metadata(n) or {}), 'version': n} for n in nombres]
     
-    # Añadir mes y año para filtros
-    df_procesado['Mes'] = df_procesado['Fecha del Servicio'].dt.month
-    df_procesado['Año'] = df_procesado['Fecha del Servicio'].dt.year
-    df_procesado['Mes-Año'] = df_procesado['Fecha del Servicio'].dt.strftime('%Y-%m')
+    @staticmethod
+    def restaurar_version(version):
+        """Vuelve a publicar una versión anterior moviendo el puntero (no copia datos)"""
+        if not os.path.exists(os.path.join(DataManager._ruta_versiones(), version, DataManager.ARCHIVO_DATOS)):
+            return False
+        DataManager._apuntar_version(version)
+        return True
     
-    return df_procesado
+    @staticmethod
+    def _podar_versiones():
+        """Conserva las MAX_VERSIONES más recientes y siempre la vigente"""
+        actual = DataManager.version_actual()
+        for info in DataManager.listar_versiones()[DataManager.MAX_VERSIONES:]:
+            if info['version'] != actual:
+                shutil.rmtree(os.path.join(DataManager._ruta_versiones(), info['version']), ignore_errors=True)
+
+# -------------------------------------------------------------------
+# CATÁLOGO DE PROFESIONALES (PERSISTENTE, CON VIGENCIAS)
+# -------------------------------------------------------------------
+ARCHIVO_CATALOGO = 'catalogo_profesionales.json'
+COLUMNAS_CATALOGO = ['Profesional', 'Especialidad', 'Tipo', 'Vigente desde', 'Vigente hasta']
+TIPOS_MEDICO = ['CONSULTOR', 'ESPECIALISTA']
+
+def plegar_acentos(texto):
+    """Elimina tildes y diéresis conservando la letra base (la Ñ pasa a N)"""
+    descompuesto = unicodedata.normalize('NFKD', texto)
+    return ''.join(c for c in descompuesto if not unicodedata.combining(c))
 
-def calcular_promedio_subespecialidad(df, subespecialidad):
-    """Calcula el promedio de facturación para una subespecialidad específica"""
-    if 'Subespecialidad' not in df.columns or subespecialidad not in df['Subespecialidad'].values:
-        return 0, 0, 0
+def normalizar_nombre_medico(nombre):
+    """
+    Normaliza el nombre del médico para poder comparar:
+    - Elimina acentos (MÉNDEZ -> MENDEZ)
+    - Elimina comas
+    - Convierte a mayúsculas
+    - Elimina espacios extras
+    - Ordena apellido y nombre de forma consistente
+    """
+    if pd.isna(nombre):
+        return ""
     
-    df_especialidad = df[df['Subespecialidad'] == subespecialidad]
+    nombre_str = plegar_acentos(str(nombre)).strip().upper()
     
-    if df_especialidad.empty:
-        return 0, 0, 0
+    # Eliminar comas y espacios múltiples
+    nombre_sin_comas = nombre_str.replace(',', ' ')
+    nombre_sin_comas = ' '.join(nombre_sin_comas.split())
     
-    suma_total = df_especialidad['Importe HHMM'].sum()
-    num_medicos = df_especialidad['Profesional'].nunique()
-    promedio = suma_total / num_medicos if num_medicos > 0 else 0
+    # Dividir en partes y ordenar alfabéticamente
+    partes = nombre_sin_comas.split()
+    partes_ordenadas = sorted(partes)
     
-    return promedio, suma_total, num_medicos
+    return ' '.join(partes_ordenadas)
 
-def calcular_a_cobrar_individual(df_medico, promedio_subespecialidad):
-    """Calcula los KPIs para un médico individual"""
-    if df_medico.empty:
+def normalizar_nombres_serie(serie):
+    """Normaliza una columna de nombres calculando cada nombre distinto una sola vez"""
+    codigos, unicos = pd.factorize(serie)
+    normalizados = np.array([normalizar_nombre_medico(n) for n in unicos] + [""], dtype=object)
+    # factorize marca los nulos con -1, que apunta al "" añadido al final
+    return pd.Series(normalizados[codigos], index=serie.index)
+
+def catalogo_inicial():
+    """Construye el catálogo a partir de PROFESIONALES_INFO (sin límites de vigencia)"""
+    return pd.DataFrame([
+        {
+            'Profesional': profesional,
+            'Especialidad': info['especialidad'],
+            'Tipo': info['tipo'],
+            'Vigente desde': pd.NaT,
+            'Vigente hasta': pd.NaT
+        }
+        for profesional, info in PROFESIONALES_INFO.items()
+    ], columns=COLUMNAS_CATALOGO)
+
+def _ruta_catalogo():
+    return os.path.join(DataManager.get_data_path(), ARCHIVO_CATALOGO)
+
+def _firma_archivo(path):
+    """Fecha de modificación de un archivo (None si no existe), usada como clave de caché"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
         return None
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _leer_arrow_mapeado(path, firma):
+    """
+    Abre un Arrow IPC con memory-map y lo convierte a pandas sin copiar las
+    columnas que lo permiten (números y fechas sin nulos, textos con el tipo
+    str de pandas respaldado por Arrow). Un DataFrame por versión y proceso.
+    """
+    tabla = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    # Las copias anteriores a guardar los datos ordenados se ordenan al abrirlas (con copia)
+    return ordenar_por_fecha(tabla.to_pandas(split_blocks=True))
+
+@st.cache_data(show_spinner=False)
+def _leer_catalogo(path, firma):
+    """Lee el catálogo persistido y le añade el índice de nombres normalizados"""
+    if firma is None:
+        catalogo = catalogo_inicial()
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            catalogo = pd.DataFrame(json.load(f), columns=COLUMNAS_CATALOGO)
+    
+    for col in ['Vigente desde', 'Vigente hasta']:
+        catalogo[col] = pd.to_datetime(catalogo[col], errors='coerce')
+    catalogo['Profesional'] = catalogo['Profesional'].astype(str).str.strip()
+    catalogo['Nombre_norm'] = normalizar_nombres_serie(catalogo['Profesional'])
+    return catalogo
+
+def cargar_catalogo_profesionales():
+    """Carga el catálogo de profesionales (el inicial si aún no se ha guardado ninguno)"""
+    path = _ruta_catalogo()
+    return _leer_catalogo(path, _firma_archivo(path))
+
+def guardar_catalogo_profesionales(catalogo):
+    """Valida y guarda el catálogo. Devuelve una lista de errores (vacía si se guardó)"""
+    catalogo = catalogo[COLUMNAS_CATALOGO].copy()
+    catalogo = catalogo[catalogo['Profesional'].notna() & (catalogo['Profesional'].astype(str).str.strip() != '')]
+    catalogo['Profesional'] = catalogo['Profesional'].astype(str).str.strip()
+    catalogo['Especialidad'] = catalogo['Especialidad'].fillna('').astype(str).str.strip().str.upper()
+    catalogo['Tipo'] = catalogo['Tipo'].fillna('').astype(str).str.strip().str.upper()
+    for col in ['Vigente desde', 'Vigente hasta']:
+        catalogo[col] = pd.to_datetime(catalogo[col], errors='coerce')
+    
+    errores = []
+    if (catalogo['Especialidad'] == '').any():
+        errores.append("Hay profesionales sin especialidad.")
+    tipos_invalidos = sorted(set(catalogo['Tipo']) - set(TIPOS_MEDICO))
+    if tipos_invalidos:
+        errores.append(f"Tipos no válidos: {', '.join(tipos_invalidos)}")
+    rangos_invertidos = catalogo['Vigente desde'] > catalogo['Vigente hasta']
+    if rangos_invertidos.any():
+        errores.append(f"Vigencia invertida en: {', '.join(catalogo.loc[rangos_invertidos, 'Profesional'])}")
+    
+    # Los periodos de un mismo profesional no pueden solaparse
+    catalogo['Nombre_norm'] = normalizar_nombres_serie(catalogo['Profesional'])
+    ordenado = catalogo.sort_values(['Nombre_norm', 'Vigente desde'], na_position='first')
+    hasta_anterior = ordenado.groupby('Nombre_norm')['Vigente hasta'].shift()
+    mismo_nombre = ordenado['Nombre_norm'].duplicated()
+    solapados = mismo_nombre & (
+        hasta_anterior.isna() | ordenado['Vigente desde'].isna() | (ordenado['Vigente desde'] <= hasta_anterior)
+    )
+    if solapados.any():
+        errores.append(f"Vigencias solapadas en: {', '.join(sorted(set(ordenado.loc[solapados, 'Profesional'])))}")
     
-    total_registros = len(df_medico)
-    importe_total = df_medico['Importe Total'].sum() if 'Importe Total' in df_medico.columns else 0
-    importe_hhmm_total = df_medico['Importe HHMM'].sum() if 'Importe HHMM' in df_medico.columns else 0
-    
-    tipo_medico = df_medico['Tipo Médico'].iloc[0] if 'Tipo Médico' in df_medico.columns else 'NO ESPECIFICADO'
+    if errores:
+        return errores
     
-    por_encima_promedio = importe_hhmm_total >= promedio_subespecialidad
+    registros = catalogo[COLUMNAS_CATALOGO].copy()
+    for col in ['Vigente desde', 'Vigente hasta']:
+        registros[col] = registros[col].dt.strftime('%Y-%m-%d')
+    registros = registros.astype(object).where(registros.notna(), None)
     
-    if tipo_medico == 'CONSULTOR':
-        porcentaje_cobrar = 0.92 if por_encima_promedio else 0.88
-    elif tipo_medico == 'ESPECIALISTA':
-        porcentaje_cobrar = 0.90 if por_encima_promedio else 0.85
-    else:
-        porcentaje_cobrar = 0.90
+    try:
+        with open(_ruta_catalogo(), 'w', encoding='utf-8') as f:
+            json.dump(registros.to_dict('records'), f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        return [f"Error guardando catálogo: {e}"]
+    return []
+
+def asignar_info_profesional(nombres, fechas=None, catalogo=None):
+    """
+    Busca especialidad y tipo de cada fila en el catálogo con un único join
+    por nombre normalizado, respetando la vigencia en la fecha del servicio.
+    Devuelve dos Series (Subespecialidad, Tipo Médico) alineadas con 'nombres'.
+    """
+    if catalogo is None:
+        catalogo = cargar_catalogo_profesionales()
+    
+    claves = pd.DataFrame({
+        'pos': np.arange(len(nombres)),
+        'Nombre_norm': normalizar_nombres_serie(nombres).to_numpy(),
+        'fecha': pd.to_datetime(fechas, errors='coerce').to_numpy() if fechas is not None else pd.NaT
+    })
+    cruce = claves.merge(
+        catalogo[['Nombre_norm', 'Especialidad', 'Tipo', 'Vigente desde', 'Vigente hasta']],
+        on='Nombre_norm',
+        how='inner'
+    )
+    # Sin fecha conocida vale cualquier vigencia; con fecha, solo la que la contiene
+    vigente = cruce['fecha'].isna() | (
+        (cruce['Vigente desde'].isna() | (cruce['fecha'] >= cruce['Vigente desde'])) &
+        (cruce['Vigente hasta'].isna() | (cruce['fecha'] <= cruce['Vigente hasta']))
+    )
+    cruce = cruce[vigente].sort_values('Vigente desde', na_position='first').drop_duplicates('pos', keep='last')
     
-    total_a_cobrar = importe_hhmm_total * porcentaje_cobrar
-    porcentaje_osa = 100 - (porcentaje_cobrar * 100)
-    a_cobrar_osa = importe_hhmm_total - total_a_cobrar
+    subespecialidad = np.full(len(nombres), 'NO ESPECIFICADA', dtype=object)
+    tipo = np.full(len(nombres), 'NO ESPECIFICADO', dtype=object)
+    subespecialidad[cruce['pos'].to_numpy()] = cruce['Especialidad'].to_numpy()
+    tipo[cruce['pos'].to_numpy()] = cruce['Tipo'].to_numpy()
     
-    return {
-        'total_registros': total_registros,
-        'importe_total': importe_total,
-        'importe_hhmm_total': importe_hhmm_total,
-        'promedio_subespecialidad': promedio_subespecialidad,
-        'porcentaje_cobrar': porcentaje_cobrar * 100,
-        'total_a_cobrar': total_a_cobrar,
-        'porcentaje_osa': porcentaje_osa,
-        'a_cobrar_osa': a_cobrar_osa,
-        'tipo_medico': tipo_medico,
-        'por_encima_promedio': por_encima_promedio
-    }
+    return pd.Series(subespecialidad, index=nombres.index), pd.Series(tipo, index=nombres.index)
 
-def calcular_dashboard_general(df):
-    """Calcula métricas generales para el dashboard del admin"""
-    if df is None or df.empty:
-        return None
+def editor_catalogo_profesionales(df_actual):
+    """Editor del catálogo de profesionales para la pestaña de información del admin"""
+    st.markdown("**Catálogo de profesionales:**")
+    st.caption(
+        "Añade filas para nuevos médicos. Para un cambio de especialidad o tipo, cierra la fila "
+        "anterior con 'Vigente hasta' y añade una nueva con 'Vigente desde'."
+    )
     
-    total_medicos = df['Profesional'].nunique()
-    total_registros = len(df)
-    importe_hhmm_total = df['Importe HHMM'].sum()
-    importe_total_vithas = df['Importe Total'].sum()
+    catalogo = cargar_catalogo_profesionales()
+    catalogo_editado = st.data_editor(
+        catalogo[COLUMNAS_CATALOGO],
+        num_rows="dynamic",
+        use_container_width=True,
+        hide_index=True,
+        key="editor_catalogo",
+        column_config={
+            "Profesional": st.column_config.TextColumn("Profesional", required=True),
+            "Especialidad": st.column_config.TextColumn("Especialidad", required=True),
+            "Tipo": st.column_config.SelectboxColumn("Tipo", options=TIPOS_MEDICO, required=True),
+            "Vigente desde": st.column_config.DateColumn("Vigente desde", format="DD/MM/YYYY"),
+            "Vigente hasta": st.column_config.DateColumn("Vigente hasta", format="DD/MM/YYYY")
+        }
+    )
     
-    # Distribución por subespecialidad
-    distribucion_subesp = df.groupby('Subespecialidad').agg({
-        'Importe HHMM': ['sum', 'count', 'nunique']
-    }).reset_index()
-    distribucion_subesp.columns = ['Subespecialidad', 'Monto_Total', 'Registros', 'Num_Medicos']
+    if st.button("💾 Guardar catálogo", use_container_width=True, key="guardar_catalogo"):
+        errores = guardar_catalogo_profesionales(catalogo_editado)
+        if errores:
+            for error in errores:
+                st.error(f"❌ {error}")
+            return
+        
+        # Reaplicar el catálogo a los datos ya guardados: el nombre se vuelve a
+        # resolver desde el del archivo (catálogo nuevo + alias) antes de asignar
+        # especialidad y tipo, igual que en procesar_datos
+        if df_actual is not None and not df_actual.empty:
+            nombres_archivo = df_actual.get('Profesional Original', df_actual['Profesional'])
+            profesional, _ = resolver_nombres_profesionales(nombres_archivo)
+            subespecialidad, tipo = asignar_info_profesional(profesional, df_actual['Fecha del Servicio'])
+            df_actualizado = df_actual.assign(**{
+                'Profesional': profesional,
+                'Subespecialidad': subespecialidad,
+                'Tipo Médico': tipo
+            })
+            metadata = {
+                **(DataManager.get_upload_metadata() or {}),
+                'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'usuario': st.session_state.get('username'),
+                'origen': 'Catálogo reaplicado'
+            }
+            if DataManager.publicar_version(df_actualizado, metadata):
+                guardar_datos_derivados(df_actualizado)
+        
+        st.success("✅ Catálogo guardado y aplicado a los datos almacenados.")
+        st.rerun()
+
+# -------------------------------------------------------------------
+# RESOLUCIÓN DE NOMBRES DE PROFESIONALES (ÍNDICE DE N-GRAMAS + ALIAS)
+# -------------------------------------------------------------------
+ARCHIVO_ALIAS = 'alias_profesionales.json'
+UMBRAL_PROPUESTA_NOMBRE = 0.5
+
+def _ngramas_nombre(nombre_norm, n=3):
+    """Trigramas de cada token del nombre normalizado (con relleno en los bordes)"""
+    ngramas = set()
+    for token in nombre_norm.split():
+        token = f" {token} "
+        ngramas.update(token[i:i + n] for i in range(max(len(token) - n + 1, 1)))
+    return ngramas
+
+class IndiceNombres:
+    """
+    Índice invertido de trigramas sobre los nombres del catálogo.
+    Solo puntúa los nombres que comparten al menos un trigrama con la consulta.
+    """
     
-    # Top 5 médicos
-    top_medicos = df.groupby('Profesional').agg({
-        'Importe HHMM': 'sum',
-        'Importe Total': 'sum',
-        'Fecha del Servicio': 'count'
-    }).reset_index()
-    top_medicos.columns = ['Profesional', 'Importe_HHMM', 'Importe_Total', 'Registros']
-    top_medicos = top_medicos.sort_values('Importe_HHMM', ascending=False).head(5)
+    def __init__(self, nombres):
+        self.nombres = list(dict.fromkeys(nombres))
+        self._ngramas = [_ngramas_nombre(normalizar_nombre_medico(n)) for n in self.nombres]
+        self._invertido = {}
+        for i, ngramas in enumerate(self._ngramas):
+            for ngrama in ngramas:
+                self._invertido.setdefault(ngrama, []).append(i)
+    
+    def candidatos(self, nombre, limite=3):
+        """Devuelve [(nombre_catalogo, similitud)] ordenados por similitud (coeficiente de Dice)"""
+        consulta = _ngramas_nombre(normalizar_nombre_medico(nombre))
+        if not consulta:
+            return []
+        
+        comunes = Counter()
+        for ngrama in consulta:
+            comunes.update(self._invertido.get(ngrama, ()))
+        
+        puntuados = [
+            (self.nombres[i], 2 * n_comunes / (len(consulta) + len(self._ngramas[i])))
+            for i, n_comunes in comunes.items()
+        ]
+        return sorted(puntuados, key=lambda x: x[1], reverse=True)[:limite]
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _construir_indice_nombres(nombres):
+    return IndiceNombres(nombres)
+
+def obtener_indice_nombres(catalogo=None):
+    """Índice de nombres del catálogo (se reconstruye solo si cambia el catálogo)"""
+    if catalogo is None:
+        catalogo = cargar_catalogo_profesionales()
+    return _construir_indice_nombres(tuple(catalogo['Profesional']))
+
+def _ruta_alias():
+    return os.path.join(DataManager.get_data_path(), ARCHIVO_ALIAS)
+
+@st.cache_data(show_spinner=False)
+def _leer_alias(path, firma):
+    if firma is None:
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def cargar_alias_profesionales():
+    """Carga los alias recordados: {nombre normalizado de la variante: nombre del catálogo}"""
+    path = _ruta_alias()
+    try:
+        return _leer_alias(path, _firma_archivo(path))
+    except Exception:
+        return {}
+
+def guardar_alias_profesionales(nuevos_alias):
+    """Añade asignaciones {variante: nombre del catálogo} a los alias recordados"""
+    alias = dict(cargar_alias_profesionales())
+    alias.update({normalizar_nombre_medico(variante): canonico for variante, canonico in nuevos_alias.items()})
+    try:
+        with open(_ruta_alias(), 'w', encoding='utf-8') as f:
+            json.dump(alias, f, ensure_ascii=False, indent=2)
+        return True
+    except Exception as e:
+        st.error(f"Error guardando alias: {e}")
+        return False
+
+def resolver_nombres_profesionales(nombres, catalogo=None):
+    """
+    Sustituye en bloque cada nombre por su nombre del catálogo:
+    primero por nombre normalizado exacto y después por los alias recordados.
+    Devuelve (serie resuelta, lista de nombres originales sin resolver).
+    """
+    if catalogo is None:
+        catalogo = cargar_catalogo_profesionales()
+    
+    canonicos = dict(zip(catalogo['Nombre_norm'], catalogo['Profesional']))
+    alias = cargar_alias_profesionales()
+    
+    codigos, unicos = pd.factorize(nombres)
+    resueltos = []
+    desconocidos = []
+    for nombre in unicos:
+        clave = normalizar_nombre_medico(nombre)
+        canonico = canonicos.get(clave) or alias.get(clave)
+        if canonico is None:
+            desconocidos.append(nombre)
+            canonico = nombre
+        resueltos.append(canonico)
+    
+    # Los nulos (código -1) se mantienen como nulos
+    resueltos = np.array(resueltos + [None], dtype=object)
+    return pd.Series(resueltos[codigos], index=nombres.index), desconocidos
+
+def revisar_nombres_desconocidos(df_procesado):
+    """
+    Muestra los profesionales del archivo que no están en el catálogo ni tienen
+    alias con la mejor propuesta del índice y permite recordar la asignación
+    para futuras cargas. Los profesionales del catálogo con servicios fuera de
+    su vigencia se listan aparte: no son nombres desconocidos.
+    """
+    if 'Profesional' not in df_procesado.columns:
+        return
+    
+    # 'Profesional' ya viene resuelto (catálogo + alias): desconocido es lo que no está en el catálogo
+    sin_especificar = df_procesado['Subespecialidad'] == 'NO ESPECIFICADA'
+    en_catalogo = normalizar_nombres_serie(df_procesado['Profesional']).isin(
+        set(cargar_catalogo_profesionales()['Nombre_norm'])
+    )
+    fuera_de_vigencia = df_procesado[sin_especificar & en_catalogo]
+    desconocidos = df_procesado.loc[~en_catalogo, 'Profesional'].dropna()
+    
+    if not fuera_de_vigencia.empty:
+        resumen_vigencia = fuera_de_vigencia.groupby('Profesional').agg(**{
+            'Registros': ('Profesional', 'size'),
+            'Primer servicio': ('Fecha del Servicio', 'min'),
+            'Último servicio': ('Fecha del Servicio', 'max')
+        }).reset_index()
+        st.warning(
+            f"⚠️ {len(fuera_de_vigencia):,} registros de {len(resumen_vigencia)} profesionales del catálogo "
+            "caen fuera de sus vigencias y quedarían como 'NO ESPECIFICADA'. Revisa 'Vigente desde' / "
+            "'Vigente hasta' en el catálogo."
+        )
+        with st.expander("📅 Registros fuera de la vigencia del catálogo"):
+            st.dataframe(
+                resumen_vigencia,
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    "Primer servicio": st.column_config.DateColumn("Primer servicio", format="DD/MM/YYYY"),
+                    "Último servicio": st.column_config.DateColumn("Último servicio", format="DD/MM/YYYY")
+                }
+            )
     
-    # KPIs calculados
-    total_pagar_medicos = 0
-    total_osa_retiene = 0
+    if desconocidos.empty:
+        return
     
-    for medico in df['Profesional'].unique():
-        df_medico = df[df['Profesional'] == medico]
-        subesp = df_medico['Subespecialidad'].iloc[0]
-        promedio, _, _ = calcular_promedio_subespecialidad(df, subesp)
-        kpis = calcular_a_cobrar_individual(df_medico, promedio)
-        if kpis:
-            total_pagar_medicos += kpis['total_a_cobrar']
-            total_osa_retiene += kpis['a_cobrar_osa']
+    indice = obtener_indice_nombres()
+    propuestas = []
+    for nombre, registros in desconocidos.value_counts().items():
+        candidatos = indice.candidatos(nombre, limite=1)
+        mejor, similitud = candidatos[0] if candidatos else (None, 0.0)
+        propuestas.append({
+            'Nombre en archivo': nombre,
+            'Registros': registros,
+            'Asignar a': mejor if similitud >= UMBRAL_PROPUESTA_NOMBRE else None,
+            'Similitud': similitud
+        })
     
-    return {
-        'total_medicos': total_medicos,
-        'total_registros': total_registros,
-        'importe_hhmm_total': importe_hhmm_total,
-        'importe_total_vithas': importe_total_vithas,
-        'total_pagar_medicos': total_pagar_medicos,
-        'total_osa_retiene': total_osa_retiene,
-        'distribucion_subesp': distribucion_subesp,
-        'top_medicos': top_medicos
-    }
+    st.warning(f"⚠️ {len(propuestas)} profesionales no están en el catálogo y quedarían como 'NO ESPECIFICADA'.")
+    with st.expander("🔗 Asignar nombres desconocidos al catálogo", expanded=True):
+        st.caption("Las asignaciones se recuerdan y se aplican automáticamente en las próximas cargas y en el match.")
+        asignaciones = st.data_editor(
+            pd.DataFrame(propuestas),
+            use_container_width=True,
+            hide_index=True,
+            key="editor_alias",
+            disabled=['Nombre en archivo', 'Registros', 'Similitud'],
+            column_config={
+                "Registros": st.column_config.NumberColumn("Registros", format="%d"),
+                "Asignar a": st.column_config.SelectboxColumn("Asignar a", options=indice.nombres),
+                "Similitud": st.column_config.ProgressColumn("Similitud", min_value=0, max_value=1, format="%.2f")
+            }
+        )
+        
+        if st.button("💾 Guardar asignaciones", use_container_width=True, key="guardar_alias"):
+            nuevos = asignaciones.dropna(subset=['Asignar a'])
+            if nuevos.empty:
+                st.info("No hay asignaciones seleccionadas.")
+            elif guardar_alias_profesionales(dict(zip(nuevos['Nombre en archivo'], nuevos['Asignar a']))):
+                st.success(f"✅ {len(nuevos)} asignaciones guardadas.")
+                st.rerun()
 
 # -------------------------------------------------------------------
-# FUNCIÓN PARA TABLA DETALLADA DE ADMIN
+# PERFILADO DE EJECUCIONES (SOLO ADMIN)
 # -------------------------------------------------------------------
-def tabla_detalle_admin(df):
-    """Genera la tabla detallada para administradores con todos los médicos"""
-    
-    st.subheader("📋 Detalle de Servicios - Todos los Médicos")
+MAX_PERFILES_GUARDADOS = 20
+
+def get_profiles_path():
+    """Obtiene la carpeta donde se guardan los perfiles de ejecución"""
+    profiles_dir = os.path.join(DataManager.get_data_path(), 'perfiles')
+    Path(profiles_dir).mkdir(parents=True, exist_ok=True)
+    return profiles_dir
+
+def _muestrear_pilas(hilo_id, codigo_raiz, pilas, detener, intervalo=0.005):
+    """
+    Muestrea periódicamente la pila del hilo perfilado y acumula
+    las pilas en formato "collapsed" (una línea por pila, frames separados por ';')
+    """
+    while not detener.is_set():
+        frame = sys._current_frames().get(hilo_id)
+        frames = []
+        while frame is not None and frame.f_code is not codigo_raiz:
+            codigo = frame.f_code
+            frames.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        if frames:
+            pilas[';'.join(reversed(frames))] += 1
+        detener.wait(intervalo)
+
+def perfilar_ejecucion(funcion):
+    """
+    Ejecuta la función bajo cProfile y un muestreador de pilas.
+    Guarda el perfil (.pstats), un resumen legible (.txt) y las pilas
+    en formato flame graph (.folded). Devuelve el nombre base del perfil.
+    """
+    # Sufijo aleatorio: dos perfiles en el mismo segundo no se sobrescriben
+    nombre_base = f"perfil_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(3)}"
+    ruta_base = os.path.join(get_profiles_path(), nombre_base)
+    
+    pilas = Counter()
+    detener = threading.Event()
+    muestreador = threading.Thread(
+        target=_muestrear_pilas,
+        args=(threading.get_ident(), sys._getframe().f_code, pilas, detener),
+        daemon=True
+    )
+    perfil = cProfile.Profile()
+    inicio = time.perf_counter()
     
-    # -----------------------------------------------------------------
-    # PASO 1: DETECTAR COLUMNAS REALES DEL DATAFRAME
-    # -----------------------------------------------------------------
-    columnas_df = df.columns.tolist()
+    muestreador.start()
+    perfil.enable()
+    try:
+        # st.rerun()/st.stop() lanzan excepciones de control: el perfil se guarda igualmente
+        funcion()
+    finally:
+        perfil.disable()
+        detener.set()
+        muestreador.join()
+        duracion = time.perf_counter() - inicio
+        
+        try:
+            perfil.dump_stats(ruta_base + '.pstats')
+            
+            with open(ruta_base + '.txt', 'w') as f:
+                f.write(f"Duración total: {duracion:.3f} s\n\n")
+                stats = pstats.Stats(perfil, stream=f)
+                stats.sort_stats('cumulative').print_stats(60)
+            
+            with open(ruta_base + '.folded', 'w') as f:
+                for pila, muestras in pilas.most_common():
+                    f.write(f"{pila} {muestras}\n")
+            
+            limpiar_perfiles_antiguos()
+            st.session_state['ultimo_perfil'] = {'nombre': nombre_base, 'duracion': duracion}
+        except Exception as e:
+            st.session_state['ultimo_perfil'] = {'nombre': nombre_base, 'error': str(e)}
     
-    # Mapeo de nombres de columna que podrían significar "Aseguradora"
-    posibles_nombres_aseguradora = [
-        'Aseguradora', 'aseguradora', 'ASEGURADORA',
-        'Aseguradora ', ' ASEGURADORA',
-        'Nombre Aseguradora', 'Compañía', 'CIA', 'Cia',
-        'Aseguradora Nombre', 'Aseguradora Name',
-        'Insurance', 'INSURANCE', 'insurance',
-        'Insurance Company', 'COMPANY', 'Company'
-    ]
+    return nombre_base
+
+def listar_perfiles():
+    """Lista los perfiles guardados agrupados por nombre base (más recientes primero)"""
+    try:
+        archivos = os.listdir(get_profiles_path())
+    except OSError:
+        return {}
     
-    # Buscar qué columna del DataFrame coincide con alguna de las posibles
-    columna_aseguradora_real = None
-    for posible in posibles_nombres_aseguradora:
-        if posible in columnas_df:
-            columna_aseguradora_real = posible
-            break
+    perfiles = {}
+    for archivo in archivos:
+        nombre_base, extension = os.path.splitext(archivo)
+        if extension in ('.pstats', '.txt', '.folded'):
+            perfiles.setdefault(nombre_base, []).append(archivo)
     
-    # -----------------------------------------------------------------
-    # PASO 2: DEFINIR COLUMNAS DESEADAS CON LOS NOMBRES REALES
-    # -----------------------------------------------------------------
+    return {nombre: sorted(perfiles[nombre]) for nombre in sorted(perfiles, reverse=True)}
+
+def limpiar_perfiles_antiguos():
+    """Elimina los perfiles más antiguos si se supera el máximo permitido"""
+    perfiles = listar_perfiles()
+    for nombre in list(perfiles)[MAX_PERFILES_GUARDADOS:]:
+        for archivo in perfiles[nombre]:
+            try:
+                os.remove(os.path.join(get_profiles_path(), archivo))
+            except OSError:
+                pass
+
+def panel_perfilado():
+    """Controles de perfilado en la barra lateral (solo administradores)"""
+    with st.expander("🧪 Perfilado de rendimiento", expanded=False):
+        ultimo = st.session_state.pop('ultimo_perfil', None)
+        if ultimo:
+            if 'error' in ultimo:
+                st.error(f"Error guardando el perfil {ultimo['nombre']}: {ultimo['error']}")
+            else:
+                st.success(f"✅ Perfil guardado: {ultimo['nombre']} ({ultimo['duracion']:.2f} s)")
+        
+        # El indicador guarda la ejecución en que se activó; se consume en una
+        # ejecución posterior que no sea el clic en "Cancelar" (ver bloque __main__)
+        st.caption("Captura un perfil completo (cProfile + flame graph) de la próxima interacción.")
+        col_p1, col_p2 = st.columns(2)
+        with col_p1:
+            if st.button("⏺️ Perfilar", use_container_width=True, key="activar_perfilado"):
+                st.session_state['perfilar_proxima'] = st.session_state.get('ejecucion_actual', 0)
+        with col_p2:
+            if st.button("Cancelar", use_container_width=True, key="cancelar_perfilado"):
+                st.session_state.pop('perfilar_proxima', None)
+        
+        if st.session_state.get('perfilar_proxima') is not None:
+            st.info("⏺️ La próxima interacción se perfilará.")
+        
+        perfiles = listar_perfiles()
+        if perfiles:
+            st.markdown("**Perfiles guardados:**")
+            nombre_sel = st.selectbox("Perfil", list(perfiles.keys()), key="perfil_seleccionado")
+            for archivo in perfiles[nombre_sel]:
+                ruta = os.path.join(get_profiles_path(), archivo)
+                with open(ruta, 'rb') as f:
+                    st.download_button(
+                        label=f"⬇️ {archivo}",
+                        data=f.read(),
+                        file_name=archivo,
+                        mime="application/octet-stream",
+                        use_container_width=True,
+                        key=f"descargar_{archivo}"
+                    )
+
+# -------------------------------------------------------------------
+# MEMORIA DE LA SESIÓN
+# -------------------------------------------------------------------
+# Los datos médicos se comparten entre sesiones (DataManager); lo que cada
+# sesión retiene en st.session_state se mide y se limita. Las entradas
+# guardadas con guardar_en_sesion() se pueden descartar al superar el límite.
+MAX_MEMORIA_SESION_MB = 256
+CLAVE_DESCARTABLES = '_claves_descartables'
+
+def tamano_objeto(valor):
+    """Bytes aproximados que retiene un objeto de la sesión"""
+    if isinstance(valor, (pd.DataFrame, pd.Series)):
+        uso = valor.memory_usage(deep=True, index=True)
+        return int(uso.sum() if isinstance(valor, pd.DataFrame) else uso)
+    if hasattr(valor, 'nbytes'):
+        return int(valor.nbytes)
+    if hasattr(valor, 'getbuffer'):
+        return valor.getbuffer().nbytes
+    if isinstance(valor, dict):
+        return sys.getsizeof(valor) + sum(tamano_objeto(v) for v in valor.values())
+    if isinstance(valor, (list, tuple, set)):
+        return sys.getsizeof(valor) + sum(tamano_objeto(v) for v in valor)
+    return sys.getsizeof(valor)
+
+def memoria_sesion():
+    """MB retenidos por cada clave de st.session_state, de mayor a menor"""
+    tamanos = {clave: tamano_objeto(valor) / 1024 ** 2 for clave, valor in st.session_state.items()}
+    return dict(sorted(tamanos.items(), key=lambda item: item[1], reverse=True))
+
+def memoria_proceso():
+    """MB residentes y privados del proceso (Linux); None si no se pueden leer"""
+    try:
+        valores = {}
+        with open('/proc/self/smaps_rollup') as f:
+            for linea in f:
+                partes = linea.split()
+                if len(partes) >= 3 and partes[-1] == 'kB':
+                    valores[partes[0].rstrip(':')] = int(partes[1]) / 1024
+        return {
+            'rss': valores.get('Rss', 0.0),
+            'privada': valores.get('Private_Clean', 0.0) + valores.get('Private_Dirty', 0.0)
+        }
+    except OSError:
+        return None
+
+def guardar_en_sesion(clave, valor):
+    """Guarda un resultado recalculable en la sesión, marcándolo como descartable"""
+    st.session_state[clave] = valor
+    descartables = st.session_state.setdefault(CLAVE_DESCARTABLES, [])
+    if clave not in descartables:
+        descartables.append(clave)
+
+def limitar_memoria_sesion(limite_mb=MAX_MEMORIA_SESION_MB):
+    """Descarta los resultados descartables más grandes hasta que la sesión quede bajo el límite"""
+    tamanos = memoria_sesion()
+    total = sum(tamanos.values())
+    descartadas = []
+    for clave in [c for c in tamanos if c in st.session_state.get(CLAVE_DESCARTABLES, [])]:
+        if total <= limite_mb:
+            break
+        total -= tamanos[clave]
+        del st.session_state[clave]
+        st.session_state[CLAVE_DESCARTABLES].remove(clave)
+        descartadas.append(clave)
+    return descartadas
+
+def filtrar_vista(df, *mascaras):
+    """
+    Filas de df que cumplen todas las máscaras (las None se ignoran). Sin
+    filtros activos, o si todas las filas los cumplen, devuelve una vista
+    superficial de df (un objeto nuevo que comparte los datos): con
+    copy-on-write el resultado se puede seguir transformando, incluso con
+    escrituras in situ, sin copiar ni tocar el DataFrame compartido entre
+    sesiones, así que nunca hace falta .copy().
+    """
+    mascaras = [m for m in mascaras if m is not None]
+    if not mascaras:
+        return df.copy(deep=False)
+    mascara = np.logical_and.reduce([np.asarray(m, dtype=bool) for m in mascaras])
+    return df.copy(deep=False) if mascara.all() else df[mascara]
+
+def fechas_ordenadas(df):
+    """True si las fechas de servicio están en orden creciente con las vacías al final"""
+    fechas = df['Fecha del Servicio']
+    validas = int(fechas.notna().sum())
+    return bool(fechas.iloc[:validas].notna().all() and fechas.iloc[:validas].is_monotonic_increasing)
+
+def ordenar_por_fecha(df):
+    """
+    Datos ordenados por fecha de servicio (orden estable, sin fecha al final)
+    con índice 0..n-1. Es el orden en que se publican las versiones, para
+    que los rangos de fechas sean porciones contiguas (ver rango_fechas).
+    """
+    if 'Fecha del Servicio' not in df.columns or fechas_ordenadas(df):
+        return df if isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and df.index.step == 1 \
+            else df.reset_index(drop=True)
+    return df.sort_values('Fecha del Servicio', kind='stable', na_position='last').reset_index(drop=True)
+
+def extremos_fechas(df):
+    """Primera y última fecha de servicio de unos datos ordenados por fecha (búsqueda binaria)"""
+    fechas = df['Fecha del Servicio'].to_numpy()
+    validas = int(np.searchsorted(fechas, np.datetime64('NaT')))
+    if validas == 0:
+        return None, None
+    return pd.Timestamp(fechas[0]), pd.Timestamp(fechas[validas - 1])
+
+def rango_fechas(df, inicio, fin):
+    """
+    Filas con fecha de servicio entre inicio y fin (días completos) de unos
+    datos ordenados por fecha: dos búsquedas binarias sobre el array
+    datetime64 y una porción contigua (vista, sin copia).
+    """
+    fechas = df['Fecha del Servicio'].to_numpy()
+    desde = np.searchsorted(fechas, np.datetime64(pd.Timestamp(inicio)), side='left')
+    hasta = np.searchsorted(fechas, np.datetime64(pd.Timestamp(fin) + pd.Timedelta(days=1)), side='left')
+    return df.iloc[desde:hasta]
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _posiciones_por_medico(_df, version):
+    """Posiciones de las filas de cada médico (en orden de fecha), una vez por versión de datos"""
+    return _df.groupby('Profesional', sort=False).indices
+
+def filas_medico(df, profesional):
+    """Partición de un médico de los datos publicados, conservando el orden por fecha"""
+    posiciones = _posiciones_por_medico(df, firma_datos(df)).get(profesional)
+    return df.iloc[posiciones] if posiciones is not None else df.iloc[0:0]
+
+def panel_memoria():
+    """Memoria del proceso y de la sesión en la barra lateral (solo administradores)"""
+    with st.expander("🧠 Memoria", expanded=False):
+        proceso = memoria_proceso()
+        if proceso:
+            st.caption(f"Proceso: {proceso['rss']:,.0f} MB residentes, {proceso['privada']:,.0f} MB privados")
+        tamanos = memoria_sesion()
+        st.caption(f"Esta sesión retiene {sum(tamanos.values()):,.1f} MB (límite {MAX_MEMORIA_SESION_MB} MB)")
+        mayores = {clave: mb for clave, mb in list(tamanos.items())[:5] if mb >= 0.1}
+        if mayores:
+            st.dataframe(
+                pd.DataFrame({'Clave': list(mayores), 'MB': list(mayores.values())}),
+                use_container_width=True,
+                hide_index=True,
+                column_config={"MB": st.column_config.NumberColumn("MB", format="%.1f")}
+            )
+
+# -------------------------------------------------------------------
+# FUNCIONES DE PROCESAMIENTO
+# -------------------------------------------------------------------
+def procesar_datos(df):
+    """Procesa el DataFrame cargado"""
+    df_procesado = df.copy()
+    
+    # Convertir columnas de fecha
+    if 'Fecha del Servicio' in df_procesado.columns:
+        df_procesado['Fecha del Servicio'] = pd.to_datetime(df_procesado['Fecha del Servicio'], errors='coerce')
+    
+    # Asegurar columnas numéricas
+    if 'Importe HHMM' in df_procesado.columns:
+        df_procesado['Importe HHMM'] = pd.to_numeric(df_procesado['Importe HHMM'], errors='coerce')
+    
+    if '% Liquidación' in df_procesado.columns:
+        df_procesado['% Liquidación'] = pd.to_numeric(df_procesado['% Liquidación'], errors='coerce')
+    
+    # Crear columna de Importe Total (100%); sin % válido queda el Importe HHMM
+    # (esas líneas se señalan en la validación de anomalías)
+    if 'Importe HHMM' in df_procesado.columns and '% Liquidación' in df_procesado.columns:
+        liquidacion = df_procesado['% Liquidación']
+        df_procesado['Importe Total'] = df_procesado['Importe HHMM'].where(
+            ~(liquidacion > 0), df_procesado['Importe HHMM'] / (liquidacion / 100)
+        )
+    
+    # Sustituir variantes conocidas del nombre por el nombre del catálogo
+    if 'Profesional' in df_procesado.columns:
+        df_procesado['Profesional Original'] = df_procesado['Profesional']
+        df_procesado['Profesional'], _ = resolver_nombres_profesionales(df_procesado['Profesional'])
+    
+    # Añadir información de especialidad y tipo de médico (catálogo vigente en la fecha del servicio)
+    if 'Profesional' in df_procesado.columns:
+        subespecialidad, tipo = asignar_info_profesional(
+            df_procesado['Profesional'],
+            df_procesado['Fecha del Servicio'] if 'Fecha del Servicio' in df_procesado.columns else None
+        )
+        df_procesado['Subespecialidad'] = subespecialidad
+        df_procesado['Tipo Médico'] = tipo
+    
+    # Añadir mes y año para filtros
+    df_procesado['Mes'] = df_procesado['Fecha del Servicio'].dt.month
+    df_procesado['Año'] = df_procesado['Fecha del Servicio'].dt.year
+    df_procesado['Mes-Año'] = df_procesado['Fecha del Servicio'].dt.strftime('%Y-%m')
+    
+    return df_procesado
+
+# -------------------------------------------------------------------
+# LIQUIDACIÓN MENSUAL (MÉDICO × MES)
+# -------------------------------------------------------------------
+# Cada médico se liquida mes a mes contra el promedio de su subespecialidad
+# en ese mismo mes; los paneles leen estas liquidaciones cerradas en lugar
+# de recalcular promedios sobre el rango que se esté mirando.
+ARCHIVO_LIQUIDACIONES = 'liquidaciones_mensuales.parquet'
+
+# -------------------------------------------------------------------
+# REGLAS DE COBRO DE LOS MÉDICOS (TABLA CONFIGURABLE)
+# -------------------------------------------------------------------
+# Cada fila es un tramo: para un tipo de médico, a partir de una fecha de
+# vigencia y de un rendimiento (HHMM del mes / promedio de su subespecialidad),
+# el médico cobra un % del HHMM. Cada vigencia de un tipo define todos sus
+# tramos; el tipo '*' aplica a los tipos sin reglas propias y a los meses
+# anteriores a la primera vigencia de cada tipo.
+ARCHIVO_REGLAS_COBRO = 'reglas_cobro.json'
+COLUMNAS_REGLAS = ['Tipo', 'Tramo', 'Desde (× promedio)', '% Médico', 'Vigente desde']
+TIPO_CUALQUIERA = '*'
+PORCENTAJE_COBRO_DEFECTO = 0.90
+TRAMO_ENCIMA = 'Por encima'
+TRAMO_DEBAJO = 'Por debajo'
+TRAMO_GENERAL = 'General'
+MES_FIN_VIGENCIA = '9999-12'
+# Rendimientos representativos del escenario determinista si no hay histórico
+RENDIMIENTO_REFERENCIA = {TRAMO_ENCIMA: 1.0, TRAMO_DEBAJO: 0.9}
+
+def reglas_cobro_inicial():
+    """Reglas vigentes antes de tenerlas configurables: dos tramos por tipo de médico"""
+    return pd.DataFrame([
+        ('CONSULTOR', TRAMO_DEBAJO, 0.0, 88.0),
+        ('CONSULTOR', TRAMO_ENCIMA, 1.0, 92.0),
+        ('ESPECIALISTA', TRAMO_DEBAJO, 0.0, 85.0),
+        ('ESPECIALISTA', TRAMO_ENCIMA, 1.0, 90.0),
+        (TIPO_CUALQUIERA, TRAMO_GENERAL, 0.0, PORCENTAJE_COBRO_DEFECTO * 100)
+    ], columns=COLUMNAS_REGLAS[:4]).assign(**{'Vigente desde': MES_INICIAL_MODELO})
+
+def _ruta_reglas_cobro():
+    return os.path.join(DataManager.get_data_path(), ARCHIVO_REGLAS_COBRO)
+
+@st.cache_data(show_spinner=False)
+def _leer_reglas_cobro(path, firma):
+    if firma is None:
+        return reglas_cobro_inicial()
+    with open(path, 'r', encoding='utf-8') as f:
+        return pd.DataFrame(json.load(f), columns=COLUMNAS_REGLAS)
+
+def cargar_reglas_cobro():
+    """Tabla de reglas de cobro (la inicial si aún no se ha guardado ninguna)"""
+    path = _ruta_reglas_cobro()
+    return _leer_reglas_cobro(path, _firma_archivo(path))
+
+def validar_reglas_cobro(reglas):
+    """Normaliza una tabla de reglas. Devuelve (reglas, errores)"""
+    reglas = reglas[COLUMNAS_REGLAS].copy()
+    reglas = reglas[reglas['Tipo'].notna() & (reglas['Tipo'].astype(str).str.strip() != '')]
+    reglas['Tipo'] = reglas['Tipo'].astype(str).str.strip().str.upper()
+    reglas['Tramo'] = reglas['Tramo'].fillna('').astype(str).str.strip()
+    reglas['Desde (× promedio)'] = pd.to_numeric(reglas['Desde (× promedio)'], errors='coerce')
+    reglas['% Médico'] = pd.to_numeric(reglas['% Médico'], errors='coerce')
+    reglas['Vigente desde'] = reglas['Vigente desde'].astype(str).str.strip()
+    
+    errores = []
+    if reglas.empty:
+        errores.append("La tabla de reglas está vacía.")
+    if (~reglas['Vigente desde'].str.fullmatch(r'\d{4}-(0[1-9]|1[0-2])')).any():
+        errores.append("'Vigente desde' debe tener formato AAAA-MM.")
+    if (reglas['Desde (× promedio)'].isna() | (reglas['Desde (× promedio)'] < 0)).any():
+        errores.append("Cada tramo necesita un 'Desde (× promedio)' mayor o igual que 0.")
+    if (reglas['% Médico'].isna() | (reglas['% Médico'] < 0) | (reglas['% Médico'] > 100)).any():
+        errores.append("El % del médico debe estar entre 0 y 100.")
+    if reglas.duplicated(['Tipo', 'Vigente desde', 'Desde (× promedio)']).any():
+        errores.append("Hay tramos repetidos (mismo tipo, vigencia y 'Desde').")
+    return reglas.sort_values(['Tipo', 'Vigente desde', 'Desde (× promedio)']), errores
+
+def guardar_reglas_cobro(reglas):
+    """Valida y guarda las reglas de cobro. Devuelve una lista de errores (vacía si se guardó)"""
+    reglas, errores = validar_reglas_cobro(reglas)
+    if errores:
+        return errores
+    try:
+        with open(_ruta_reglas_cobro(), 'w', encoding='utf-8') as f:
+            json.dump(reglas.to_dict('records'), f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        return [f"Error guardando las reglas de cobro: {e}"]
+    return []
+
+def intervalos_reglas(reglas, claves=()):
+    """
+    Convierte la tabla de reglas en intervalos cerrados por abajo: vigencia
+    [Vigente desde, siguiente vigencia del tipo) y rendimiento [desde, siguiente
+    tramo). El primer tramo de cada vigencia queda abierto por abajo. `claves`
+    son columnas adicionales que separan tablas apiladas (p. ej. 'Variante').
+    """
+    tipo = list(claves) + ['Tipo']
+    intervalos = reglas.sort_values(tipo + ['Vigente desde', 'Desde (× promedio)']).reset_index(drop=True)
+    inicio_version = ~intervalos.duplicated(tipo + ['Vigente desde'])
+    vigencias = intervalos.loc[inicio_version, tipo + ['Vigente desde']]
+    intervalos['Vigente hasta'] = (
+        vigencias.groupby(tipo)['Vigente desde'].shift(-1).fillna(MES_FIN_VIGENCIA)
+        .reindex(intervalos.index).ffill()
+    )
+    version = intervalos.groupby(tipo + ['Vigente desde'])['Desde (× promedio)']
+    intervalos['Rendimiento desde'] = intervalos['Desde (× promedio)'].where(version.cumcount() > 0, -np.inf)
+    intervalos['Rendimiento hasta'] = version.shift(-1).fillna(np.inf)
+    return intervalos
+
+def evaluar_reglas_cobro(reglas, tipos, meses, rendimiento):
+    """
+    % que cobra el médico (0-1) y nombre del tramo para arrays de tipo, mes
+    (AAAA-MM) y rendimiento. Cada regla es una condición de np.select sobre los
+    arrays completos, así que el coste crece con el número de reglas y no con
+    Python por fila. Los tipos sin reglas, y los meses anteriores a la primera
+    vigencia de su tipo, usan las de '*' y, si tampoco hay, PORCENTAJE_COBRO_DEFECTO.
+    """
+    tipos = np.asarray(tipos).astype(str)
+    meses = np.asarray(meses).astype(str)
+    rendimiento = np.asarray(rendimiento, dtype=float)
+    intervalos = intervalos_reglas(reglas)
+    
+    # Cada tipo usa sus reglas desde su primera vigencia; antes (o sin reglas propias), las de '*'
+    primera_vigencia = intervalos[intervalos['Tipo'] != TIPO_CUALQUIERA].groupby('Tipo')['Vigente desde'].min()
+    sin_reglas = meses < pd.Series(tipos).map(primera_vigencia).fillna(MES_FIN_VIGENCIA).to_numpy(dtype=str)
+    condiciones = [
+        (sin_reglas if regla['Tipo'] == TIPO_CUALQUIERA else tipos == regla['Tipo']) &
+        (meses >= regla['Vigente desde']) & (meses < regla['Vigente hasta']) &
+        (rendimiento >= regla['Rendimiento desde']) & (rendimiento < regla['Rendimiento hasta'])
+        for regla in intervalos.to_dict('records')
+    ]
+    porcentaje = np.select(condiciones, (intervalos['% Médico'] / 100).tolist(), default=PORCENTAJE_COBRO_DEFECTO)
+    tramo = np.select(condiciones, intervalos['Tramo'].tolist(), default=TRAMO_GENERAL)
+    return porcentaje, tramo
+
+def rendimientos_referencia(liquidaciones):
+    """Rendimiento mediano histórico de los meses por encima y por debajo del promedio"""
+    referencia = dict(RENDIMIENTO_REFERENCIA)
+    if liquidaciones is not None and not liquidaciones.empty:
+        medianas = liquidaciones.groupby('Por encima')['Rendimiento'].median()
+        referencia[TRAMO_ENCIMA] = float(medianas.get(True, referencia[TRAMO_ENCIMA]))
+        referencia[TRAMO_DEBAJO] = float(medianas.get(False, referencia[TRAMO_DEBAJO]))
+    return referencia
+
+def margenes_escenario(reglas, mes, referencia, tipos=('CONSULTOR', 'ESPECIALISTA')):
+    """
+    Margen OSA (%) por tipo para un médico por encima y por debajo del promedio
+    en el mes dado, evaluando las reglas en los rendimientos de referencia.
+    Devuelve {tipo: (margen encima, margen debajo)}.
+    """
+    tipos_eval = np.repeat(list(tipos), 2)
+    rendimientos = np.tile([referencia[TRAMO_ENCIMA], referencia[TRAMO_DEBAJO]], len(tipos))
+    porcentaje, _ = evaluar_reglas_cobro(reglas, tipos_eval, np.full(len(tipos_eval), mes), rendimientos)
+    margenes = ((1 - porcentaje) * 100).round(4).reshape(len(tipos), 2)
+    return {tipo: (float(margenes[i, 0]), float(margenes[i, 1])) for i, tipo in enumerate(tipos)}
+
+def editor_reglas_cobro():
+    """Editor de la tabla de reglas de cobro; al guardar se reliquida todo el histórico"""
+    st.caption(
+        "Cada fila es un tramo: el médico del tipo indicado cobra '% Médico' de su HHMM cuando su "
+        "facturación del mes es al menos 'Desde' veces el promedio de su subespecialidad. "
+        "Para cambiar las reglas de un tipo a partir de un mes, añade todos sus tramos con la nueva "
+        "'Vigente desde' (AAAA-MM). El tipo '*' aplica a los tipos sin reglas propias y a los "
+        "meses anteriores a la primera vigencia de cada tipo."
+    )
+    reglas_editadas = st.data_editor(
+        cargar_reglas_cobro(),
+        num_rows="dynamic",
+        use_container_width=True,
+        hide_index=True,
+        key="editor_reglas_cobro",
+        column_config={
+            "Desde (× promedio)": st.column_config.NumberColumn("Desde (× promedio)", min_value=0.0, format="%.2f"),
+            "% Médico": st.column_config.NumberColumn("% Médico", min_value=0, max_value=100, format="%.2f%%"),
+            "Vigente desde": st.column_config.TextColumn("Vigente desde", help="AAAA-MM")
+        }
+    )
+    if st.button("💾 Guardar reglas de cobro", use_container_width=True, key="guardar_reglas_cobro"):
+        errores = guardar_reglas_cobro(reglas_editadas)
+        if errores:
+            for error in errores:
+                st.error(f"❌ {error}")
+            return
+        df = DataManager.load_dataframe()
+        if df is not None:
+            guardar_liquidaciones(df)
+        st.success("✅ Reglas guardadas y liquidaciones recalculadas.")
+        st.rerun()
+
+def calcular_liquidaciones(df, reglas=None):
+    """
+    Liquida todo el histórico en una sola pasada agrupada: una fila por médico
+    y mes con registros, importes, el promedio mensual de su subespecialidad
+    (HHMM del mes / médicos de la subespecialidad con actividad ese mes), el
+    rendimiento frente a ese promedio, el tramo y % de las reglas de cobro
+    vigentes ese mes, lo que cobra el médico y lo que retiene OSA.
+    Los registros sin fecha de servicio no tienen mes y no se liquidan; los
+    paneles los señalan con resumen_sin_fecha().
+    """
+    columnas = ['Profesional', 'Mes-Año', 'Subespecialidad', 'Tipo', 'Registros', 'Importe Total',
+                'Importe HHMM', 'Promedio Subespecialidad', 'Rendimiento', 'Por encima', 'Tramo',
+                '% Cobrar', 'A Cobrar', 'OSA Retiene']
+    if df is None or df.empty:
+        return pd.DataFrame(columns=columnas)
+
+    agregados = {
+        'Subespecialidad': ('Subespecialidad', 'first'),
+        'Tipo': ('Tipo Médico', 'first'),
+        'Registros': ('Profesional', 'size'),
+        'Importe HHMM': ('Importe HHMM', 'sum'),
+    }
+    if 'Importe Total' in df.columns:
+        agregados['Importe Total'] = ('Importe Total', 'sum')
+    liquidaciones = df.groupby(
+        ['Profesional', 'Mes-Año'], observed=True, sort=True, dropna=True
+    ).agg(**agregados).reset_index()
+    if 'Importe Total' not in liquidaciones.columns:
+        liquidaciones['Importe Total'] = liquidaciones['Importe HHMM']
+
+    liquidaciones['Promedio Subespecialidad'] = liquidaciones.groupby(
+        ['Subespecialidad', 'Mes-Año'], dropna=False
+    )['Importe HHMM'].transform('mean')
+    # Con promedio 0 (subespecialidad sin facturación ese mes) el médico está en el promedio
+    promedio = liquidaciones['Promedio Subespecialidad']
+    liquidaciones['Rendimiento'] = (liquidaciones['Importe HHMM'] / promedio.where(promedio != 0)).fillna(1.0)
+    liquidaciones['Por encima'] = liquidaciones['Rendimiento'] >= 1
+    porcentaje, tramo = evaluar_reglas_cobro(
+        cargar_reglas_cobro() if reglas is None else reglas,
+        liquidaciones['Tipo'], liquidaciones['Mes-Año'], liquidaciones['Rendimiento']
+    )
+    liquidaciones['Tramo'] = tramo
+    liquidaciones['% Cobrar'] = porcentaje * 100
+    liquidaciones['A Cobrar'] = liquidaciones['Importe HHMM'] * porcentaje
+    liquidaciones['OSA Retiene'] = liquidaciones['Importe HHMM'] - liquidaciones['A Cobrar']
+    return liquidaciones[columnas]
+
+def guardar_liquidaciones(df):
+    """Recalcula y guarda las liquidaciones mensuales del histórico completo"""
+    return DataManager.save_dataframe(calcular_liquidaciones(df), ARCHIVO_LIQUIDACIONES)
+
+def guardar_datos_derivados(df):
+    """Regenera lo que se calcula a partir de los datos publicados: índice de tarifas y liquidaciones"""
+    guardar_indice_tarifas(df)
+    guardar_liquidaciones(df)
+
+@st.cache_data(show_spinner=False)
+def _leer_liquidaciones(path, firma):
+    return pd.read_parquet(path)
+
+def cargar_liquidaciones():
+    """Liquidaciones guardadas; si aún no existen se generan a partir de los datos cargados"""
+    path = os.path.join(DataManager.get_data_path(), ARCHIVO_LIQUIDACIONES)
+    if _firma_archivo(path) is None:
+        df = DataManager.load_dataframe()
+        if df is None or not guardar_liquidaciones(df):
+            return calcular_liquidaciones(df)
+    return _leer_liquidaciones(path, _firma_archivo(path))
+
+def firma_liquidaciones():
+    """Versión de las liquidaciones guardadas y de las reglas de cobro con que se calcularon"""
+    return (
+        _firma_archivo(os.path.join(DataManager.get_data_path(), ARCHIVO_LIQUIDACIONES)),
+        _firma_archivo(_ruta_reglas_cobro())
+    )
+
+def resumen_sin_fecha(df):
+    """Registros sin fecha de servicio (sin mes, fuera de toda liquidación): (registros, HHMM)"""
+    if df is None or df.empty or 'Mes-Año' not in df.columns:
+        return 0, 0.0
+    sin_fecha = df['Mes-Año'].isna()
+    return int(sin_fecha.sum()), float(df.loc[sin_fecha, 'Importe HHMM'].sum())
+
+def liquidaciones_de(df):
+    """
+    Liquidaciones de los pares médico-mes presentes en df (con los filtros ya
+    aplicados). El tramo y el % se deciden con el mes completo; si el rango de
+    fechas solo cubre parte de un mes, ese mes se prorratea aplicando su % al
+    HHMM del rango, así que 'A Cobrar' + 'OSA Retiene' suman siempre el HHMM
+    filtrado. La columna 'Mes completo' indica qué meses entran enteros.
+    """
+    liquidaciones = cargar_liquidaciones()
+    if df is None or df.empty or liquidaciones.empty:
+        return liquidaciones.iloc[0:0].assign(**{'Mes completo': pd.Series(dtype=bool)})
+    
+    sumas = ['Importe HHMM'] + (['Importe Total'] if 'Importe Total' in df.columns else [])
+    en_rango = df.groupby(['Profesional', 'Mes-Año'], observed=True).agg(
+        **{'Registros rango': ('Profesional', 'size')},
+        **{f'{columna} rango': (columna, 'sum') for columna in sumas}
+    )
+    seleccion = liquidaciones.join(en_rango, on=['Profesional', 'Mes-Año'], how='inner')
+    
+    completo = (seleccion['Registros rango'] == seleccion['Registros']).to_numpy()
+    if completo.all():
+        return seleccion[liquidaciones.columns].assign(**{'Mes completo': True})
+    
+    # Parte del mes dentro del rango (por HHMM; por registros si el mes no facturó)
+    hhmm_mes = seleccion['Importe HHMM']
+    fraccion = (seleccion['Importe HHMM rango'] / hhmm_mes.where(hhmm_mes != 0)).fillna(
+        seleccion['Registros rango'] / seleccion['Registros']
+    )
+    hhmm = seleccion['Importe HHMM rango']
+    a_cobrar = hhmm * seleccion['% Cobrar'] / 100
+    prorrateo = {
+        'Registros': seleccion['Registros rango'],
+        'Importe Total': seleccion['Importe Total rango'] if 'Importe Total' in df.columns else hhmm,
+        'Importe HHMM': hhmm,
+        'Promedio Subespecialidad': seleccion['Promedio Subespecialidad'] * fraccion,
+        'A Cobrar': a_cobrar,
+        'OSA Retiene': hhmm - a_cobrar
+    }
+    return seleccion[liquidaciones.columns].assign(**{
+        columna: seleccion[columna].where(completo, valores) for columna, valores in prorrateo.items()
+    }, **{'Mes completo': completo})
+
+def calcular_a_cobrar_individual(liquidaciones_medico):
+    """
+    KPIs de un médico sumando sus liquidaciones mensuales. El promedio de
+    subespecialidad es la suma de los promedios de sus meses (comparable con su
+    facturación del periodo) y el % a cobrar es el efectivo (cobrado / HHMM).
+    """
+    if liquidaciones_medico is None or liquidaciones_medico.empty:
+        return None
+
+    importe_hhmm_total = liquidaciones_medico['Importe HHMM'].sum()
+    total_a_cobrar = liquidaciones_medico['A Cobrar'].sum()
+    a_cobrar_osa = liquidaciones_medico['OSA Retiene'].sum()
+    promedio_subespecialidad = liquidaciones_medico['Promedio Subespecialidad'].sum()
+    porcentaje_cobrar = total_a_cobrar / importe_hhmm_total * 100 if importe_hhmm_total else PORCENTAJE_COBRO_DEFECTO * 100
+
+    return {
+        'total_registros': int(liquidaciones_medico['Registros'].sum()),
+        'importe_total': liquidaciones_medico['Importe Total'].sum(),
+        'importe_hhmm_total': importe_hhmm_total,
+        'promedio_subespecialidad': promedio_subespecialidad,
+        'porcentaje_cobrar': porcentaje_cobrar,
+        'total_a_cobrar': total_a_cobrar,
+        'porcentaje_osa': 100 - porcentaje_cobrar,
+        'a_cobrar_osa': a_cobrar_osa,
+        'tipo_medico': liquidaciones_medico['Tipo'].iloc[-1],
+        'por_encima_promedio': importe_hhmm_total >= promedio_subespecialidad,
+        'meses_liquidados': len(liquidaciones_medico),
+        'meses_por_encima': int(liquidaciones_medico['Por encima'].sum())
+    }
+
+def calcular_dashboard_general(df):
+    """Calcula métricas generales para el dashboard del admin"""
+    if df is None or df.empty:
+        return None
+    
+    total_medicos = df['Profesional'].nunique()
+    total_registros = len(df)
+    importe_hhmm_total = df['Importe HHMM'].sum()
+    importe_total_vithas = df['Importe Total'].sum()
+    
+    # Distribución por subespecialidad
+    distribucion_subesp = df.groupby('Subespecialidad').agg({
+        'Importe HHMM': ['sum', 'count', 'nunique']
+    }).reset_index()
+    distribucion_subesp.columns = ['Subespecialidad', 'Monto_Total', 'Registros', 'Num_Medicos']
+    
+    # Top 5 médicos
+    top_medicos = df.groupby('Profesional').agg({
+        'Importe HHMM': 'sum',
+        'Importe Total': 'sum',
+        'Fecha del Servicio': 'count'
+    }).reset_index()
+    top_medicos.columns = ['Profesional', 'Importe_HHMM', 'Importe_Total', 'Registros']
+    top_medicos = top_medicos.sort_values('Importe_HHMM', ascending=False).head(5)
+    
+    # KPIs de las liquidaciones mensuales de los médicos y meses filtrados
+    liquidaciones = liquidaciones_de(df)
+    total_pagar_medicos = liquidaciones['A Cobrar'].sum()
+    total_osa_retiene = liquidaciones['OSA Retiene'].sum()
+    
+    return {
+        'total_medicos': total_medicos,
+        'total_registros': total_registros,
+        'importe_hhmm_total': importe_hhmm_total,
+        'importe_total_vithas': importe_total_vithas,
+        'total_pagar_medicos': total_pagar_medicos,
+        'total_osa_retiene': total_osa_retiene,
+        'distribucion_subesp': distribucion_subesp,
+        'top_medicos': top_medicos
+    }
+
+# -------------------------------------------------------------------
+# FUNCIÓN PARA TABLA DETALLADA DE ADMIN
+# -------------------------------------------------------------------
+@st.fragment
+def tabla_detalle_admin(df):
+    """
+    Genera la tabla detallada para administradores con todos los médicos.
+    Es un fragmento: cambiar el médico o la aseguradora solo vuelve a
+    ejecutar esta tabla, no el dashboard ni el resto de la página.
+    """
+    
+    st.subheader("📋 Detalle de Servicios - Todos los Médicos")
+    
+    # -----------------------------------------------------------------
+    # PASO 1: DETECTAR COLUMNAS REALES DEL DATAFRAME
+    # -----------------------------------------------------------------
+    columnas_df = df.columns.tolist()
+    
+    # Mapeo de nombres de columna que podrían significar "Aseguradora"
+    posibles_nombres_aseguradora = [
+        'Aseguradora', 'aseguradora', 'ASEGURADORA',
+        'Aseguradora ', ' ASEGURADORA',
+        'Nombre Aseguradora', 'Compañía', 'CIA', 'Cia',
+        'Aseguradora Nombre', 'Aseguradora Name',
+        'Insurance', 'INSURANCE', 'insurance',
+        'Insurance Company', 'COMPANY', 'Company'
+    ]
+    
+    # Buscar qué columna del DataFrame coincide con alguna de las posibles
+    columna_aseguradora_real = None
+    for posible in posibles_nombres_aseguradora:
+        if posible in columnas_df:
+            columna_aseguradora_real = posible
+            break
+    
+    # -----------------------------------------------------------------
+    # PASO 2: DEFINIR COLUMNAS DESEADAS CON LOS NOMBRES REALES
+    # -----------------------------------------------------------------
     mapeo_columnas = {
         'Fecha del Servicio': 'Fecha del servicio',
         'Profesional': 'Profesional',
@@ -758,7 +2027,7 @@ def tabla_detalle_admin(df):
     # -----------------------------------------------------------------
     # PASO 4: CREAR DATAFRAME CON LAS COLUMNAS SELECCIONADAS
     # -----------------------------------------------------------------
-    df_detalle = df[columnas_existentes].copy()
+    df_detalle = df[columnas_existentes]
     
     # Renombrar columnas
     renombres = {}
@@ -790,16 +2059,7 @@ def tabla_detalle_admin(df):
     df_detalle = df_detalle[orden_columnas]
     
     # -----------------------------------------------------------------
-    # PASO 6: FORMATEAR FECHAS
-    # -----------------------------------------------------------------
-    if 'Fecha del servicio' in df_detalle.columns:
-        df_detalle['Fecha del servicio'] = pd.to_datetime(
-            df_detalle['Fecha del servicio'], 
-            errors='coerce'
-        ).dt.strftime('%d/%m/%Y')
-    
-    # -----------------------------------------------------------------
-    # PASO 7: FILTROS PARA ADMIN
+    # PASO 6: FILTROS PARA ADMIN
     # -----------------------------------------------------------------
     col_f1, col_f2 = st.columns(2)
     
@@ -817,15 +2077,25 @@ def tabla_detalle_admin(df):
             st.info("ℹ️ Columna 'Aseguradora' no encontrada en el archivo")
     
     # -----------------------------------------------------------------
-    # PASO 8: APLICAR FILTROS
+    # PASO 7: APLICAR FILTROS
     # -----------------------------------------------------------------
-    df_detalle_filtrado = df_detalle.copy()
-    
-    if medico_filtro != 'TODOS':
-        df_detalle_filtrado = df_detalle_filtrado[df_detalle_filtrado['Profesional'] == medico_filtro]
+    df_detalle_filtrado = filtrar_vista(
+        df_detalle,
+        df_detalle['Profesional'] == medico_filtro if medico_filtro != 'TODOS' else None,
+        df_detalle['Aseguradora'] == aseguradora_filtro
+        if 'Aseguradora' in df_detalle.columns and aseguradora_filtro != 'TODAS' else None
+    )
     
-    if 'Aseguradora' in df_detalle.columns and aseguradora_filtro != 'TODAS':
-        df_detalle_filtrado = df_detalle_filtrado[df_detalle_filtrado['Aseguradora'] == aseguradora_filtro]
+    # -----------------------------------------------------------------
+    # PASO 8: FORMATEAR FECHAS (solo las filas que se muestran)
+    # -----------------------------------------------------------------
+    if 'Fecha del servicio' in df_detalle_filtrado.columns:
+        df_detalle_filtrado = df_detalle_filtrado.assign(**{
+            'Fecha del servicio': pd.to_datetime(
+                df_detalle_filtrado['Fecha del servicio'],
+                errors='coerce'
+            ).dt.strftime('%d/%m/%Y')
+        })
     
     # -----------------------------------------------------------------
     # PASO 9: MÉTRICAS DEL FILTRO
@@ -921,115 +2191,703 @@ def tabla_detalle_admin(df):
         )
 
 # -------------------------------------------------------------------
-# PROYECCIÓN GERENCIA - ACTUALIZADA
+# MODELO DE GASTOS FIJOS Y REPARTO ENTRE SOCIOS (VIGENCIAS MENSUALES)
 # -------------------------------------------------------------------
-def proyeccion_gerencia(df):
-    """Calcula proyecciones financieras para gerencia"""
-    
-    st.markdown(f"""
-    <div class='custom-card'>
-        <h2 style='color: {COLORES['primary']}; margin-bottom: 0;'>📈 Proyección Gerencia</h2>
-        <p style='color: {COLORES['secondary']};'>Análisis de punto de equilibrio y márgenes OSA</p>
-    </div>
-    """, unsafe_allow_html=True)
-    
-    # -----------------------------------------------------------------
-    # GASTOS FIJOS MENSUALES - ACTUALIZADOS
-    # -----------------------------------------------------------------
-    st.subheader("🏢 Gastos Fijos Mensuales OSA")
-    
-    col_g1, col_g2, col_g3, col_g4 = st.columns(4)
-    
-    with col_g1:
-        st.markdown(f"""
-        <div class='stMetric'>
-            <label>👥 SF</label>
-            <div style='font-size: 24px; font-weight: bold; color: {COLORES['primary']};'>
-                €3,290
-            </div>
-            <small>Costo mensual empresa</small>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with col_g2:
-        st.markdown(f"""
-        <div class='stMetric'>
-            <label>👤 IR</label>
-            <div style='font-size: 24px; font-weight: bold; color: {COLORES['primary']};'>
-                €2,835
-            </div>
-            <small>Costo mensual empresa</small>
-        </div>
-        """, unsafe_allow_html=True)
+ARCHIVO_MODELO_COSTES = 'modelo_costes.json'
+MES_INICIAL_MODELO = '2000-01'
+COLUMNAS_GASTOS = ['Concepto', 'Importe mensual', 'Descripción', 'Vigente desde']
+COLUMNAS_SOCIOS = ['Socio', 'Porcentaje', 'Vigente desde']
+ICONOS_GASTO = {
+    'SF': '👥', 'IR': '👤', 'Jefe Servicio': '👨‍⚕️', 'RC Profesional': '🛡️',
+    'Otros (Web, Google, etc)': '🌐', 'Despacho legal y laboral': '⚖️'
+}
+
+def modelo_costes_inicial():
+    """Gastos fijos y reparto entre socios vigentes antes de tener el modelo configurable"""
+    gastos = pd.DataFrame([
+        ('SF', 3290.0, 'Costo mensual empresa'),
+        ('IR', 2835.0, 'Costo mensual empresa'),
+        ('Jefe Servicio', 3000.0, 'Honorarios mensuales'),
+        ('RC Profesional', 500.0, 'Seguro responsabilidad civil'),
+        ('Otros (Web, Google, etc)', 100.0, 'Mantenimiento, publicidad'),
+        ('Despacho legal y laboral', 400.0, 'Asesoría legal y laboral')
+    ], columns=COLUMNAS_GASTOS[:3]).assign(**{'Vigente desde': MES_INICIAL_MODELO})
+    socios = pd.DataFrame([
+        ('Fallone', 70.0),
+        ('Puigdellivol', 22.5),
+        ('Ortega', 7.5)
+    ], columns=COLUMNAS_SOCIOS[:2]).assign(**{'Vigente desde': MES_INICIAL_MODELO})
+    return {'gastos': gastos, 'socios': socios}
+
+def _ruta_modelo_costes():
+    return os.path.join(DataManager.get_data_path(), ARCHIVO_MODELO_COSTES)
+
+@st.cache_data(show_spinner=False)
+def _leer_modelo_costes(path, firma):
+    if firma is None:
+        return modelo_costes_inicial()
+    with open(path, 'r', encoding='utf-8') as f:
+        datos = json.load(f)
+    return {
+        'gastos': pd.DataFrame(datos['gastos'], columns=COLUMNAS_GASTOS),
+        'socios': pd.DataFrame(datos['socios'], columns=COLUMNAS_SOCIOS)
+    }
+
+def cargar_modelo_costes():
+    """Modelo de gastos y reparto (el inicial si aún no se ha guardado ninguno)"""
+    path = _ruta_modelo_costes()
+    return _leer_modelo_costes(path, _firma_archivo(path))
+
+def firma_modelo_costes():
+    return _firma_archivo(_ruta_modelo_costes())
+
+def guardar_modelo_costes(gastos, socios):
+    """Valida y guarda el modelo de gastos y reparto. Devuelve una lista de errores (vacía si se guardó)"""
+    gastos = gastos[COLUMNAS_GASTOS].copy()
+    gastos = gastos[gastos['Concepto'].notna() & (gastos['Concepto'].astype(str).str.strip() != '')]
+    gastos['Concepto'] = gastos['Concepto'].astype(str).str.strip()
+    gastos['Descripción'] = gastos['Descripción'].fillna('').astype(str)
+    gastos['Importe mensual'] = pd.to_numeric(gastos['Importe mensual'], errors='coerce')
+    socios = socios[COLUMNAS_SOCIOS].copy()
+    socios = socios[socios['Socio'].notna() & (socios['Socio'].astype(str).str.strip() != '')]
+    socios['Socio'] = socios['Socio'].astype(str).str.strip()
+    socios['Porcentaje'] = pd.to_numeric(socios['Porcentaje'], errors='coerce')
+    
+    errores = []
+    for nombre, tabla in [('gastos', gastos), ('reparto', socios)]:
+        meses_invalidos = ~tabla['Vigente desde'].astype(str).str.fullmatch(r'\d{4}-(0[1-9]|1[0-2])')
+        if meses_invalidos.any():
+            errores.append(f"'Vigente desde' debe tener formato AAAA-MM en {nombre}.")
+    if (gastos['Importe mensual'].isna() | (gastos['Importe mensual'] < 0)).any():
+        errores.append("Hay gastos sin importe o con importe negativo.")
+    if gastos.duplicated(['Concepto', 'Vigente desde']).any():
+        errores.append("Hay conceptos repetidos con la misma fecha de vigencia.")
+    if (socios['Porcentaje'].isna() | (socios['Porcentaje'] < 0)).any():
+        errores.append("Hay socios sin porcentaje o con porcentaje negativo.")
+    suma_reparto = socios.groupby('Vigente desde')['Porcentaje'].sum()
+    repartos_incompletos = suma_reparto[(suma_reparto - 100).abs() > 0.01]
+    if not repartos_incompletos.empty:
+        errores.append(f"El reparto debe sumar 100% en cada vigencia: {', '.join(repartos_incompletos.index)}")
+    
+    if errores:
+        return errores
     
-    with col_g3:
-        st.markdown(f"""
-        <div class='stMetric'>
-            <label>👨‍⚕️ Jefe Servicio</label>
-            <div style='font-size: 24px; font-weight: bold; color: {COLORES['primary']};'>
-                €3,000
-            </div>
-            <small>Honorarios mensuales</small>
-        </div>
-        """, unsafe_allow_html=True)
+    try:
+        with open(_ruta_modelo_costes(), 'w', encoding='utf-8') as f:
+            json.dump({
+                'gastos': gastos.sort_values(['Vigente desde', 'Concepto']).to_dict('records'),
+                'socios': socios.sort_values(['Vigente desde', 'Socio']).to_dict('records')
+            }, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        return [f"Error guardando el modelo de gastos: {e}"]
+    return []
+
+def _vigentes_por_mes(pivote, meses):
+    """Propaga cada vigencia (índice AAAA-MM) hasta la siguiente y la evalúa en los meses pedidos"""
+    indice = sorted(set(pivote.index) | set(meses))
+    return pivote.reindex(indice).ffill().reindex(meses).fillna(0.0)
+
+def gastos_por_mes(gastos, meses):
+    """
+    Matriz meses × conceptos con el importe vigente de cada concepto en cada mes.
+    Cada concepto mantiene su último importe hasta una nueva vigencia (un 0 lo da de baja).
+    """
+    pivote = gastos.pivot_table(index='Vigente desde', columns='Concepto', values='Importe mensual', aggfunc='last')
+    return _vigentes_por_mes(pivote, meses)[list(dict.fromkeys(gastos['Concepto']))]
+
+def reparto_por_mes(socios, meses):
+    """Matriz meses × socios con el % vigente; cada fecha de vigencia define el reparto completo"""
+    pivote = socios.pivot_table(index='Vigente desde', columns='Socio', values='Porcentaje', aggfunc='last').fillna(0.0)
+    return _vigentes_por_mes(pivote, meses)[list(dict.fromkeys(socios['Socio']))]
+
+def firma_datos(df):
+    """Versión de los datos cargados para las cachés que reciben el DataFrame sin hashearlo"""
+    return (DataManager.firma_version(), len(df))
+
+@st.cache_data(show_spinner=False)
+def _cobertura_mensual(_df, version_datos, version_modelo, version_liquidaciones):
+    """
+    Serie mensual de cobertura: HHMM, retención OSA (liquidaciones mensuales),
+    gastos fijos vigentes ese mes, % de cobertura y aporte de cada socio según
+    el reparto vigente. Se calcula una vez por versión de datos, de modelo y
+    de liquidaciones (cambian al guardar nuevas reglas de cobro).
+    """
+    mensual = liquidaciones_de(_df).groupby('Mes-Año').agg(
+        **{'Facturación HHMM': ('Importe HHMM', 'sum'), 'OSA retiene': ('OSA Retiene', 'sum')}
+    )
+    meses = mensual.index.tolist()
+    modelo = cargar_modelo_costes()
+    reparto = reparto_por_mes(modelo['socios'], meses)
+    
+    mensual['Gastos fijos'] = gastos_por_mes(modelo['gastos'], meses).sum(axis=1).to_numpy()
+    mensual['Cobertura %'] = (mensual['OSA retiene'] / mensual['Gastos fijos'].where(mensual['Gastos fijos'] > 0) * 100).fillna(0)
+    mensual['Aporte socios'] = (mensual['Gastos fijos'] - mensual['OSA retiene']).clip(lower=0)
+    for socio in reparto.columns:
+        mensual[f'Aporte {socio}'] = mensual['Aporte socios'] * reparto[socio].to_numpy() / 100
+    return mensual.reset_index()
+
+def cobertura_mensual(df):
+    """Serie mensual de cobertura de gastos de los datos cargados"""
+    return _cobertura_mensual(df, firma_datos(df), firma_modelo_costes(), firma_liquidaciones())
+
+def editor_modelo_costes():
+    """Editor de gastos fijos y reparto entre socios con sus vigencias"""
+    modelo = cargar_modelo_costes()
+    st.caption(
+        "Para cambiar un importe o el reparto a partir de un mes, añade una fila con el nuevo valor y su "
+        "'Vigente desde' (AAAA-MM); las filas anteriores siguen aplicando a los meses previos. "
+        "Un gasto con importe 0 deja de aplicarse. Cada vigencia del reparto debe sumar 100%."
+    )
+    col_e1, col_e2 = st.columns([3, 2])
+    with col_e1:
+        st.markdown("**Gastos fijos mensuales:**")
+        gastos_editados = st.data_editor(
+            modelo['gastos'],
+            num_rows="dynamic",
+            use_container_width=True,
+            hide_index=True,
+            key="editor_gastos_fijos",
+            column_config={
+                "Importe mensual": st.column_config.NumberColumn("Importe mensual", min_value=0, format="€%.2f"),
+                "Vigente desde": st.column_config.TextColumn("Vigente desde", help="AAAA-MM")
+            }
+        )
+    with col_e2:
+        st.markdown("**Reparto entre socios:**")
+        socios_editados = st.data_editor(
+            modelo['socios'],
+            num_rows="dynamic",
+            use_container_width=True,
+            hide_index=True,
+            key="editor_reparto_socios",
+            column_config={
+                "Porcentaje": st.column_config.NumberColumn("Porcentaje", min_value=0, max_value=100, format="%.2f%%"),
+                "Vigente desde": st.column_config.TextColumn("Vigente desde", help="AAAA-MM")
+            }
+        )
     
-    with col_g4:
-        st.markdown(f"""
-        <div class='stMetric'>
-            <label>🛡️ RC Profesional</label>
-            <div style='font-size: 24px; font-weight: bold; color: {COLORES['primary']};'>
-                €500
-            </div>
-            <small>Seguro responsabilidad civil</small>
-        </div>
-        """, unsafe_allow_html=True)
+    if st.button("💾 Guardar gastos y reparto", use_container_width=True, key="guardar_modelo_costes"):
+        errores = guardar_modelo_costes(gastos_editados, socios_editados)
+        if errores:
+            for error in errores:
+                st.error(f"❌ {error}")
+            return
+        st.success("✅ Modelo de gastos y reparto guardado.")
+        st.rerun()
+
+# -------------------------------------------------------------------
+# SIMULACIÓN MONTE CARLO DE ESCENARIOS
+# -------------------------------------------------------------------
+ESCENARIOS_MONTECARLO = 10_000
+PERCENTILES_MONTECARLO = [5, 25, 50, 75, 95]
+
+def simular_montecarlo(muestras, n_consultores, n_especialistas, gastos_fijos,
+                       n_escenarios=ESCENARIOS_MONTECARLO, semilla=0, reglas=None, mes=None):
+    """
+    Simula n_escenarios meses para una composición de médicos. `muestras` son
+    las liquidaciones médico × mes: cada médico simulado toma un mes real de un
+    médico de su tipo (si no hay médicos de ese tipo, de cualquiera) con las
+    reglas de cobro de su tipo vigentes en `mes` (por defecto el actual) según
+    el rendimiento de ese mes real. Todo el cálculo es una matriz escenarios × médicos.
+    Devuelve las retenciones OSA simuladas, la probabilidad de cubrir los
+    gastos fijos y los percentiles de retención y facturación.
+    """
+    rng = np.random.default_rng(semilla)
+    reglas = cargar_reglas_cobro() if reglas is None else reglas
+    meses = np.full(len(muestras), mes or pd.Timestamp.now().strftime('%Y-%m'))
+    hhmm = muestras['Importe HHMM'].to_numpy(dtype=float)
+    rendimiento = muestras['Rendimiento'].to_numpy(dtype=float)
+    por_encima = muestras['Por encima'].to_numpy(dtype=bool)
+    tipos = muestras['Tipo'].to_numpy()
+    
+    retencion = np.zeros(n_escenarios)
+    facturacion = np.zeros(n_escenarios)
+    encima = np.zeros(n_escenarios)
+    for tipo, cantidad in [('CONSULTOR', n_consultores), ('ESPECIALISTA', n_especialistas)]:
+        if cantidad <= 0:
+            continue
+        candidatos = np.flatnonzero(tipos == tipo)
+        if candidatos.size == 0:
+            candidatos = np.arange(len(muestras))
+        # Retención de cada muestra si la factura un médico de este tipo
+        porcentaje, _ = evaluar_reglas_cobro(reglas, np.full(len(hhmm), tipo), meses, rendimiento)
+        retencion_tipo = hhmm * (1 - porcentaje)
+        elegidos = candidatos[rng.integers(0, candidatos.size, size=(n_escenarios, cantidad))]
+        retencion += retencion_tipo[elegidos].sum(axis=1)
+        facturacion += hhmm[elegidos].sum(axis=1)
+        encima += por_encima[elegidos].sum(axis=1)
+    
+    total_medicos = n_consultores + n_especialistas
+    return {
+        'retencion': retencion,
+        'prob_equilibrio': float((retencion >= gastos_fijos).mean()),
+        'percentiles_retencion': dict(zip(PERCENTILES_MONTECARLO, np.percentile(retencion, PERCENTILES_MONTECARLO))),
+        'percentiles_facturacion': dict(zip(PERCENTILES_MONTECARLO, np.percentile(facturacion, PERCENTILES_MONTECARLO))),
+        'pct_encima_medio': float(encima.mean() / total_medicos * 100) if total_medicos > 0 else 0.0
+    }
+
+def simulacion_montecarlo(df, n_consultores, n_especialistas, total_gastos_fijos, mes=None):
+    """Bloque de la proyección con la simulación Monte Carlo de la composición elegida"""
+    st.subheader("🎲 Simulación Monte Carlo")
     
-    col_g5, col_g6, col_g7 = st.columns(3)
+    if df is None or df.empty:
+        st.info("La simulación necesita datos cargados: remuestrea la facturación mensual real de cada médico.")
+        return
+    if n_consultores + n_especialistas == 0:
+        st.info("Indica al menos un médico en la composición para simular.")
+        return
     
-    with col_g5:
-        st.markdown(f"""
-        <div class='stMetric'>
-            <label>🌐 Otros (Web, Google, etc)</label>
-            <div style='font-size: 24px; font-weight: bold; color: {COLORES['primary']};'>
-                €100
-            </div>
-            <small>Mantenimiento, publicidad</small>
-        </div>
-        """, unsafe_allow_html=True)
+    col_mc1, col_mc2 = st.columns([1, 3])
+    with col_mc1:
+        n_escenarios = st.select_slider(
+            "Nº de escenarios",
+            options=[10_000, 25_000, 50_000, 100_000],
+            value=ESCENARIOS_MONTECARLO,
+            key="mc_escenarios"
+        )
+    with col_mc2:
+        st.caption(
+            "Cada escenario es un mes: cada médico de la composición toma la facturación de un mes real "
+            "de un médico de su mismo tipo y se le aplica el tramo de las reglas de cobro que corresponde a su "
+            "rendimiento frente al promedio de su subespecialidad. El % de médicos por encima sale de los "
+            "datos, no del selector."
+        )
     
-    with col_g6:
-        st.markdown(f"""
-        <div class='stMetric'>
-            <label>⚖️ Despacho legal y laboral</label>
-            <div style='font-size: 24px; font-weight: bold; color: {COLORES['primary']};'>
-                €400
-            </div>
-            <small>Asesoría legal y laboral</small>
-        </div>
-        """, unsafe_allow_html=True)
+    resultado = simular_montecarlo(
+        liquidaciones_de(df), n_consultores, n_especialistas, total_gastos_fijos, n_escenarios, mes=mes
+    )
+    percentiles = resultado['percentiles_retencion']
+    
+    col_p1, col_p2, col_p3, col_p4 = st.columns(4)
+    with col_p1:
+        st.metric("🎯 Prob. cubrir gastos fijos", f"{resultado['prob_equilibrio'] * 100:.1f}%")
+    with col_p2:
+        st.metric("🏥 Retención OSA mediana", f"€{percentiles[50]:,.0f}",
+                  delta=f"€{percentiles[50] - total_gastos_fijos:,.0f} vs gastos", delta_color="normal")
+    with col_p3:
+        st.metric("📉 Banda P5 – P95", f"€{percentiles[5]:,.0f} – €{percentiles[95]:,.0f}")
+    with col_p4:
+        st.metric("📊 % médicos por encima (simulado)", f"{resultado['pct_encima_medio']:.1f}%")
+    
+    fig_mc = px.histogram(
+        x=resultado['retencion'],
+        nbins=60,
+        title='Distribución de la retención OSA mensual simulada',
+        color_discrete_sequence=[COLORES['secondary']]
+    )
+    fig_mc.add_vline(x=total_gastos_fijos, line_dash='dash', line_color=COLORES['primary'],
+                     annotation_text='Gastos fijos')
+    fig_mc.update_layout(
+        height=350,
+        title_x=0.5,
+        plot_bgcolor='white',
+        xaxis_title='Retención OSA mensual (€)',
+        yaxis_title='Escenarios'
+    )
+    st.plotly_chart(fig_mc, use_container_width=True)
+    
+    st.dataframe(
+        pd.DataFrame({
+            'Percentil': [f'P{p}' for p in PERCENTILES_MONTECARLO],
+            'Facturación HHMM (€)': list(resultado['percentiles_facturacion'].values()),
+            'Retención OSA (€)': list(percentiles.values()),
+            'Diferencia vs gastos (€)': [v - total_gastos_fijos for v in percentiles.values()]
+        }),
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            col: st.column_config.NumberColumn(col, format="€%.0f")
+            for col in ['Facturación HHMM (€)', 'Retención OSA (€)', 'Diferencia vs gastos (€)']
+        }
+    )
+
+# -------------------------------------------------------------------
+# BARRIDO DE COMPOSICIONES (SUPERFICIE DE EQUILIBRIO)
+# -------------------------------------------------------------------
+MAX_CONSULTORES_BARRIDO = 30
+MAX_ESPECIALISTAS_BARRIDO = 30
+PASO_PCT_BARRIDO = 5
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def barrido_composiciones(total_gastos_fijos, margenes, max_consultores=MAX_CONSULTORES_BARRIDO,
+                          max_especialistas=MAX_ESPECIALISTAS_BARRIDO, paso_pct=PASO_PCT_BARRIDO):
+    """
+    Evalúa el escenario determinista de la proyección para toda la rejilla
+    consultores × especialistas × % por encima del promedio con una sola
+    operación vectorizada (broadcasting). `margenes` es {tipo: (margen encima,
+    margen debajo)} de margenes_escenario(). Se guarda en caché por gastos fijos
+    y márgenes, así que moverse por la rejilla no recalcula nada.
+    Devuelve los ejes y los cubos de margen total (puntos %·médico), margen
+    ponderado y facturación HHMM necesaria total y por médico.
+    """
+    consultores = np.arange(max_consultores + 1)[:, None, None]
+    especialistas = np.arange(max_especialistas + 1)[None, :, None]
+    pct_encima = np.arange(0, 101, paso_pct)[None, None, :]
     
-    # Calcular total gastos fijos
-    gastos_fijos = {
-        'SF': 3290,
-        'IR': 2835,
-        'Jefe Servicio': 3000,
-        'RC Profesional': 500,
-        'Otros': 100,
-        'Despacho legal': 400
+    # Mismo reparto que el escenario determinista (truncando como int())
+    consultores_encima = np.floor(consultores * (pct_encima / 100))
+    especialistas_encima = np.floor(especialistas * (pct_encima / 100))
+    total_margen = (
+        consultores_encima * margenes['CONSULTOR'][0] +
+        (consultores - consultores_encima) * margenes['CONSULTOR'][1] +
+        especialistas_encima * margenes['ESPECIALISTA'][0] +
+        (especialistas - especialistas_encima) * margenes['ESPECIALISTA'][1]
+    )
+    total_medicos = (consultores + especialistas).astype(float)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        margen_ponderado = np.where(total_medicos > 0, total_margen / total_medicos, np.nan)
+        facturacion_necesaria = total_gastos_fijos / (margen_ponderado / 100)
+        facturacion_por_medico = facturacion_necesaria / total_medicos
+    
+    return {
+        'consultores': np.arange(max_consultores + 1),
+        'especialistas': np.arange(max_especialistas + 1),
+        'pct_encima': np.arange(0, 101, paso_pct),
+        'total_margen': total_margen,
+        'margen_ponderado': margen_ponderado,
+        'facturacion_necesaria': facturacion_necesaria,
+        'facturacion_por_medico': facturacion_por_medico
     }
+
+def mapa_equilibrio(total_gastos_fijos, margenes, facturacion_media, n_consultores, n_especialistas, pct_encima):
+    """Mapa de calor de la superficie de equilibrio para un % por encima del promedio"""
+    st.subheader("🗺️ Mapa de Equilibrio por Composición")
+    
+    barrido = barrido_composiciones(total_gastos_fijos, margenes)
+    
+    col_b1, col_b2 = st.columns(2)
+    with col_b1:
+        pct_mapa = st.select_slider(
+            "% Médicos por encima del promedio (mapa)",
+            options=barrido['pct_encima'].tolist(),
+            value=int(round(pct_encima / PASO_PCT_BARRIDO) * PASO_PCT_BARRIDO),
+            key="barrido_pct"
+        )
+    with col_b2:
+        metrica_mapa = st.radio(
+            "Mostrar",
+            ["Facturación HHMM necesaria por médico", "Superávit / déficit con la facturación media"],
+            horizontal=True,
+            key="barrido_metrica"
+        )
     
-    total_gastos_fijos = sum(gastos_fijos.values())
+    k = int(np.searchsorted(barrido['pct_encima'], pct_mapa))
+    if metrica_mapa == "Facturación HHMM necesaria por médico":
+        z = barrido['facturacion_por_medico'][:, :, k]
+        escala = [[0, '#2e7d32'], [0.5, '#fff59d'], [1, '#c62828']]
+        rango = (0, max(facturacion_media * 2, 1))
+        etiqueta = 'HHMM/médico (€)'
+    else:
+        # Retención con la facturación media actual: solo escala el cubo guardado
+        z = barrido['total_margen'][:, :, k] / 100 * facturacion_media - total_gastos_fijos
+        escala = [[0, '#c62828'], [0.5, '#ffffff'], [1, '#2e7d32']]
+        limite = max(float(np.nanmax(np.abs(z))), 1)
+        rango = (-limite, limite)
+        etiqueta = 'Superávit (€)'
+    
+    fig_mapa = px.imshow(
+        z,
+        x=barrido['especialistas'],
+        y=barrido['consultores'],
+        origin='lower',
+        aspect='auto',
+        color_continuous_scale=escala,
+        range_color=rango,
+        labels={'x': 'Nº Especialistas', 'y': 'Nº Consultores', 'color': etiqueta},
+        title=f'{metrica_mapa} ({pct_mapa}% por encima del promedio)'
+    )
+    if n_consultores <= barrido['consultores'][-1] and n_especialistas <= barrido['especialistas'][-1]:
+        fig_mapa.add_scatter(
+            x=[n_especialistas], y=[n_consultores], mode='markers',
+            marker=dict(symbol='x', size=14, color=COLORES['primary']),
+            name='Escenario actual', showlegend=False
+        )
+    fig_mapa.update_layout(height=500, title_x=0.5, plot_bgcolor='white')
+    st.plotly_chart(fig_mapa, use_container_width=True)
+    
+    # Composiciones mínimas que cubren los gastos con la facturación media
+    cubre = barrido['total_margen'][:, :, k] / 100 * facturacion_media >= total_gastos_fijos
+    if cubre.any():
+        consultores_idx, especialistas_idx = np.nonzero(cubre)
+        total = consultores_idx + especialistas_idx
+        minimo = total.min()
+        opciones = ', '.join(
+            f"{c}C / {e}E" for c, e in zip(consultores_idx[total == minimo], especialistas_idx[total == minimo])
+        )
+        st.caption(f"Con €{facturacion_media:,.0f} por médico, el equilibrio se alcanza con un mínimo de "
+                   f"{minimo} médicos: {opciones}.")
+    else:
+        st.caption(f"Con €{facturacion_media:,.0f} por médico ninguna composición de la rejilla cubre los gastos fijos.")
+
+# -------------------------------------------------------------------
+# SIMULACIÓN WHAT-IF DE REGLAS DE COBRO SOBRE EL HISTÓRICO
+# -------------------------------------------------------------------
+# Base con la que se calcula el rendimiento de cada médico-mes: (agrupación, estadístico)
+BASES_PROMEDIO = {
+    'Media subespecialidad': (['Subespecialidad', 'Mes-Año'], 'mean'),
+    'Mediana subespecialidad': (['Subespecialidad', 'Mes-Año'], 'median'),
+    'Media de todos los médicos': (['Mes-Año'], 'mean'),
+}
+BASE_PROMEDIO_ACTUAL = 'Media subespecialidad'
+VARIANTE_ACTUAL = 'Actual'
+MAX_VARIANTES_WHATIF = 200
+
+def _mes_a_entero(meses):
+    """'AAAA-MM' -> año * 12 + mes, para comparar vigencias con aritmética entera"""
+    meses = pd.Series(meses, dtype=str)
+    return (meses.str[:4].astype(int) * 12 + meses.str[5:7].astype(int)).to_numpy()
+
+def rendimientos_por_base(liquidaciones):
+    """Rendimiento (HHMM / promedio de referencia) de cada médico-mes con cada base de promedio"""
+    rendimientos = {}
+    for base, (grupo, estadistico) in BASES_PROMEDIO.items():
+        promedio = liquidaciones.groupby(grupo, dropna=False)['Importe HHMM'].transform(estadistico)
+        rendimientos[base] = (liquidaciones['Importe HHMM'] / promedio.where(promedio != 0)).fillna(1.0).to_numpy()
+    return pd.DataFrame(rendimientos, index=liquidaciones.index)
+
+def reliquidar_variantes(liquidaciones, variantes, gastos=None):
+    """
+    Reliquida todo el histórico con cada variante de reglas en una sola pasada.
+    `variantes` es una lista de (nombre, reglas, base del promedio). Las reglas
+    de todas las variantes se apilan y se evalúan a la vez con broadcasting
+    médico-mes × regla; como los tramos de una variante no se solapan, cada
+    médico-mes cumple como mucho una regla por variante.
+    Devuelve la matriz médico-mes × variante del % cobrado, la retención
+    mensual (mes × variante) y un resumen por variante con pagos, retención y
+    cobertura de los gastos fijos vigentes cada mes.
+    """
+    gastos = cargar_modelo_costes()['gastos'] if gastos is None else gastos
+    n_variantes = len(variantes)
+    hhmm = liquidaciones['Importe HHMM'].to_numpy(dtype=float)
+    codigos_tipo, tipos = pd.factorize(liquidaciones['Tipo'].astype(str))
+    meses = _mes_a_entero(liquidaciones['Mes-Año'])
+    
+    # Reglas de todas las variantes apiladas y convertidas a intervalos de una vez
+    intervalos = intervalos_reglas(
+        pd.concat([reglas.assign(Variante=k) for k, (_, reglas, _) in enumerate(variantes)], ignore_index=True),
+        claves=['Variante']
+    )
+    variante_regla = intervalos['Variante'].to_numpy()
+    tipo_regla = intervalos['Tipo'].to_numpy(dtype=str)
+    
+    # Primer mes con reglas propias de cada tipo en cada variante (tipo × variante);
+    # antes de ese mes, o sin reglas propias, aplican las de '*'
+    inicio_propias = np.full((len(tipos), n_variantes), _mes_a_entero([MES_FIN_VIGENCIA])[0])
+    primeras = intervalos[intervalos['Tipo'] != TIPO_CUALQUIERA].groupby(
+        ['Tipo', 'Variante'], as_index=False
+    )['Vigente desde'].min()
+    indice_tipo = pd.Index(tipos).get_indexer(primeras['Tipo'])
+    validos = indice_tipo >= 0
+    inicio_propias[indice_tipo[validos], primeras['Variante'].to_numpy()[validos]] = (
+        _mes_a_entero(primeras['Vigente desde'])[validos]
+    )
+    sin_reglas = meses[:, None] < inicio_propias[codigos_tipo]
+    
+    # Rendimiento de cada médico-mes con la base de promedio de cada variante
+    rendimientos = rendimientos_por_base(liquidaciones)
+    rendimiento = rendimientos[[base for _, _, base in variantes]].to_numpy()[:, variante_regla]
+    
+    cumple = (
+        ((tipos.to_numpy(dtype=str)[codigos_tipo][:, None] == tipo_regla[None, :]) |
+         ((tipo_regla == TIPO_CUALQUIERA)[None, :] & sin_reglas[:, variante_regla])) &
+        (meses[:, None] >= _mes_a_entero(intervalos['Vigente desde'])[None, :]) &
+        (meses[:, None] < _mes_a_entero(intervalos['Vigente hasta'])[None, :]) &
+        (rendimiento >= intervalos['Rendimiento desde'].to_numpy()[None, :]) &
+        (rendimiento < intervalos['Rendimiento hasta'].to_numpy()[None, :])
+    )
+    porcentaje = np.full((len(hhmm), n_variantes), PORCENTAJE_COBRO_DEFECTO)
+    filas, reglas_cumplidas = np.nonzero(cumple)
+    porcentaje[filas, variante_regla[reglas_cumplidas]] = intervalos['% Médico'].to_numpy()[reglas_cumplidas] / 100
+    
+    a_cobrar = hhmm[:, None] * porcentaje
+    retencion = hhmm[:, None] - a_cobrar
+    
+    codigos_mes, meses_historico = pd.factorize(liquidaciones['Mes-Año'], sort=True)
+    retencion_mensual = np.zeros((len(meses_historico), n_variantes))
+    np.add.at(retencion_mensual, codigos_mes, retencion)
+    gastos_mensuales = gastos_por_mes(gastos, list(meses_historico)).sum(axis=1).to_numpy()
+    total_gastos = gastos_mensuales.sum()
+    
+    total_hhmm = hhmm.sum()
+    total_retencion = retencion.sum(axis=0)
+    resumen = pd.DataFrame({
+        'Variante': [nombre for nombre, _, _ in variantes],
+        'Base del promedio': [base for _, _, base in variantes],
+        'Pagos médicos (€)': a_cobrar.sum(axis=0),
+        'OSA retiene (€)': total_retencion,
+        '% OSA': total_retencion / total_hhmm * 100 if total_hhmm else np.zeros(n_variantes),
+        'Cobertura gastos %': total_retencion / total_gastos * 100 if total_gastos else np.zeros(n_variantes),
+        'Meses cubiertos': (retencion_mensual >= gastos_mensuales[:, None]).sum(axis=0),
+        'Δ OSA vs actual (€)': total_retencion - total_retencion[0]
+    })
+    return {
+        'porcentaje': porcentaje,
+        'retencion_mensual': pd.DataFrame(retencion_mensual, index=meses_historico, columns=resumen['Variante']),
+        'gastos_mensuales': pd.Series(gastos_mensuales, index=meses_historico),
+        'resumen': resumen
+    }
+
+def variantes_whatif(reglas_candidatas, bases, ajustes):
+    """
+    Variantes a comparar: las reglas actuales primero (referencia) y después
+    cada conjunto candidato × base de promedio × ajuste en puntos del % médico.
+    """
+    variantes = [(VARIANTE_ACTUAL, cargar_reglas_cobro(), BASE_PROMEDIO_ACTUAL)]
+    for nombre, reglas in reglas_candidatas.groupby('Variante', sort=False):
+        reglas, errores = validar_reglas_cobro(reglas)
+        if errores:
+            continue
+        for base in bases:
+            for ajuste in ajustes:
+                etiqueta = ' · '.join(
+                    [str(nombre)] + ([base] if base != BASE_PROMEDIO_ACTUAL else []) +
+                    ([f"{ajuste:+d} pp"] if ajuste else [])
+                )
+                variantes.append((
+                    etiqueta,
+                    reglas.assign(**{'% Médico': (reglas['% Médico'] + ajuste).clip(0, 100)}),
+                    base
+                ))
+    return variantes[:MAX_VARIANTES_WHATIF]
+
+def simulacion_whatif():
+    """Bloque de la proyección que compara variantes de reglas de cobro sobre todo el histórico"""
+    st.subheader("🧪 ¿Y si...? Reglas de cobro sobre el histórico")
     
-    with col_g7:
-        st.markdown(f"""
-        <div class='stMetric'>
-            <label>💰 TOTAL GASTOS FIJOS</label>
-            <div style='font-size: 28px; font-weight: bold; color: {COLORES['primary']};'>
-                €{total_gastos_fijos:,.2f}
-            </div>
-            <small>Mensuales</small>
-        </div>
-        """, unsafe_allow_html=True)
+    liquidaciones = cargar_liquidaciones()
+    if liquidaciones.empty:
+        st.info("La simulación necesita datos cargados: reliquida el histórico guardado con cada variante.")
+        return
+    
+    st.caption(
+        "Escribe uno o varios conjuntos de reglas candidatos (columna 'Variante'; mismas columnas que las "
+        "reglas de cobro). Cada variante se combina con las bases de promedio y los ajustes elegidos y "
+        "todo el histórico se reliquida con cada combinación. La primera fila del resultado son las reglas actuales."
+    )
+    candidatas = st.data_editor(
+        cargar_reglas_cobro().assign(Variante='Candidata')[['Variante'] + COLUMNAS_REGLAS],
+        num_rows="dynamic",
+        use_container_width=True,
+        hide_index=True,
+        key="whatif_reglas",
+        column_config={
+            "Desde (× promedio)": st.column_config.NumberColumn("Desde (× promedio)", min_value=0.0, format="%.2f"),
+            "% Médico": st.column_config.NumberColumn("% Médico", min_value=0, max_value=100, format="%.2f%%"),
+            "Vigente desde": st.column_config.TextColumn("Vigente desde", help="AAAA-MM")
+        }
+    )
+    col_w1, col_w2 = st.columns(2)
+    with col_w1:
+        bases = st.multiselect(
+            "Base del promedio", list(BASES_PROMEDIO), default=[BASE_PROMEDIO_ACTUAL], key="whatif_bases"
+        )
+    with col_w2:
+        ajuste_min, ajuste_max = st.select_slider(
+            "Ajuste del % médico (puntos)", options=list(range(-5, 6)), value=(0, 0), key="whatif_ajustes"
+        )
+    
+    candidatas = candidatas[candidatas['Variante'].notna() & (candidatas['Variante'].astype(str).str.strip() != '')]
+    invalidas = [nombre for nombre, reglas in candidatas.groupby('Variante') if validar_reglas_cobro(reglas)[1]]
+    if invalidas:
+        st.warning(f"⚠️ Variantes con reglas no válidas (se omiten): {', '.join(map(str, invalidas))}")
+    
+    variantes = variantes_whatif(candidatas, bases or [BASE_PROMEDIO_ACTUAL], range(ajuste_min, ajuste_max + 1))
+    resultado = reliquidar_variantes(liquidaciones, variantes)
+    resumen = resultado['resumen']
+    
+    fig_whatif = px.bar(
+        resumen,
+        x='Variante',
+        y='OSA retiene (€)',
+        color='Cobertura gastos %',
+        color_continuous_scale=[[0, '#c62828'], [0.5, '#fff59d'], [1, '#2e7d32']],
+        title=f'Retención OSA del histórico por variante ({len(resultado["gastos_mensuales"])} meses)'
+    )
+    fig_whatif.add_hline(
+        y=resultado['gastos_mensuales'].sum(), line_dash='dash', line_color=COLORES['primary'],
+        annotation_text='Gastos fijos del periodo'
+    )
+    fig_whatif.update_layout(height=450, title_x=0.5, plot_bgcolor='white', xaxis_tickangle=-30)
+    st.plotly_chart(fig_whatif, use_container_width=True)
+    
+    st.dataframe(
+        resumen,
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "Pagos médicos (€)": st.column_config.NumberColumn("Pagos médicos (€)", format="€%.2f"),
+            "OSA retiene (€)": st.column_config.NumberColumn("OSA retiene (€)", format="€%.2f"),
+            "% OSA": st.column_config.NumberColumn("% OSA", format="%.2f%%"),
+            "Cobertura gastos %": st.column_config.NumberColumn("Cobertura gastos", format="%.1f%%"),
+            "Meses cubiertos": st.column_config.NumberColumn(f"Meses cubiertos (de {len(resultado['gastos_mensuales'])})", format="%d"),
+            "Δ OSA vs actual (€)": st.column_config.NumberColumn("Δ OSA vs actual (€)", format="€%.2f")
+        }
+    )
+    
+    with st.expander("📅 Retención mensual por variante", expanded=False):
+        mensual = resultado['retencion_mensual'].assign(**{'Gastos fijos': resultado['gastos_mensuales']})
+        fig_mensual = px.line(mensual, markers=True, labels={'index': 'Mes', 'value': '€', 'variable': 'Variante'})
+        fig_mensual.update_layout(height=400, plot_bgcolor='white')
+        st.plotly_chart(fig_mensual, use_container_width=True)
+
+# -------------------------------------------------------------------
+# PROYECCIÓN GERENCIA - ACTUALIZADA
+# -------------------------------------------------------------------
+def proyeccion_gerencia(df):
+    """Calcula proyecciones financieras para gerencia"""
+    
+    st.markdown(f"""
+    <div class='custom-card'>
+        <h2 style='color: {COLORES['primary']}; margin-bottom: 0;'>📈 Proyección Gerencia</h2>
+        <p style='color: {COLORES['secondary']};'>Análisis de punto de equilibrio y márgenes OSA</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    # -----------------------------------------------------------------
+    # GASTOS FIJOS MENSUALES (MODELO CON VIGENCIAS)
+    # -----------------------------------------------------------------
+    st.subheader("🏢 Gastos Fijos Mensuales OSA")
+    
+    modelo_costes = cargar_modelo_costes()
+    meses_proyeccion = pd.period_range(pd.Timestamp.now(), periods=13, freq='M').strftime('%Y-%m').tolist()
+    mes_proyeccion = st.selectbox(
+        "📅 Mes de la proyección (gastos y reparto vigentes)",
+        meses_proyeccion,
+        key="mes_proyeccion"
+    )
+    gastos_fijos = gastos_por_mes(modelo_costes['gastos'], [mes_proyeccion]).iloc[0]
+    gastos_fijos = gastos_fijos[gastos_fijos > 0]
+    reparto_socios = reparto_por_mes(modelo_costes['socios'], [mes_proyeccion]).iloc[0]
+    reparto_socios = reparto_socios[reparto_socios > 0]
+    descripciones = modelo_costes['gastos'].drop_duplicates('Concepto', keep='last').set_index('Concepto')['Descripción']
+    
+    total_gastos_fijos = float(gastos_fijos.sum())
+    
+    tarjetas = list(gastos_fijos.items()) + [('TOTAL GASTOS FIJOS', total_gastos_fijos)]
+    for inicio in range(0, len(tarjetas), 4):
+        columnas_gastos = st.columns(4)
+        for columna, (concepto, importe) in zip(columnas_gastos, tarjetas[inicio:inicio + 4]):
+            with columna:
+                es_total = concepto == 'TOTAL GASTOS FIJOS'
+                st.markdown(f"""
+                <div class='stMetric'>
+                    <label>{'💰' if es_total else ICONOS_GASTO.get(concepto, '💼')} {concepto}</label>
+                    <div style='font-size: {28 if es_total else 24}px; font-weight: bold; color: {COLORES['primary']};'>
+                        €{importe:,.{2 if es_total else 0}f}
+                    </div>
+                    <small>{'Mensuales' if es_total else descripciones.get(concepto, '')}</small>
+                </div>
+                """, unsafe_allow_html=True)
+    
+    with st.expander("⚙️ Configurar gastos fijos y reparto entre socios", expanded=False):
+        editor_modelo_costes()
+    
+    with st.expander("⚙️ Configurar reglas de cobro de los médicos", expanded=False):
+        editor_reglas_cobro()
+    
+    # Márgenes OSA del escenario según las reglas vigentes en el mes de la proyección
+    margenes = margenes_escenario(cargar_reglas_cobro(), mes_proyeccion, rendimientos_referencia(liquidaciones_de(df)))
     
     st.markdown("---")
     
@@ -1047,18 +2905,10 @@ def proyeccion_gerencia(df):
         medicos_consultor = df[df['Tipo Médico'] == 'CONSULTOR']['Profesional'].nunique()
         medicos_especialista = df[df['Tipo Médico'] == 'ESPECIALISTA']['Profesional'].nunique()
         
-        # Calcular margen real promedio
-        total_pagar_medicos = 0
-        total_osa_retiene = 0
-        
-        for medico in df['Profesional'].unique():
-            df_med = df[df['Profesional'] == medico]
-            subesp = df_med['Subespecialidad'].iloc[0]
-            promedio, _, _ = calcular_promedio_subespecialidad(df, subesp)
-            kpis = calcular_a_cobrar_individual(df_med, promedio)
-            if kpis:
-                total_pagar_medicos += kpis['total_a_cobrar']
-                total_osa_retiene += kpis['a_cobrar_osa']
+        # Margen real de las liquidaciones mensuales
+        liquidaciones = liquidaciones_de(df)
+        total_pagar_medicos = liquidaciones['A Cobrar'].sum()
+        total_osa_retiene = liquidaciones['OSA Retiene'].sum()
         
         margen_real_promedio = (total_osa_retiene / total_hhmm * 100) if total_hhmm > 0 else 0
         
@@ -1096,9 +2946,11 @@ def proyeccion_gerencia(df):
                 help="Distribución por tipo"
             )
         
-        # Calcular cobertura de gastos con datos reales
-        meses_periodo = df['Mes-Año'].nunique()
-        osa_mensual_promedio = total_osa_retiene / meses_periodo if meses_periodo > 0 else 0
+        # Cobertura de gastos mes a mes contra los gastos vigentes en cada mes
+        serie_cobertura = cobertura_mensual(df)
+        meses_periodo = len(serie_cobertura)
+        osa_mensual_promedio = serie_cobertura['OSA retiene'].mean() if meses_periodo > 0 else 0
+        gastos_mensual_promedio = serie_cobertura['Gastos fijos'].mean() if meses_periodo > 0 else 0
         
         col_c1, col_c2, col_c3 = st.columns(3)
         
@@ -1113,73 +2965,67 @@ def proyeccion_gerencia(df):
             st.metric(
                 "📊 OSA Mensual Promedio",
                 f"€{osa_mensual_promedio:,.2f}",
-                help="Margen OSA promedio por mes"
+                help="Margen OSA promedio por mes (regla de cobro aplicada mes a mes)"
             )
         
         with col_c3:
-            cobertura_gastos = (osa_mensual_promedio / total_gastos_fijos) * 100 if total_gastos_fijos > 0 else 0
+            cobertura_gastos = (
+                serie_cobertura['OSA retiene'].sum() / serie_cobertura['Gastos fijos'].sum() * 100
+                if serie_cobertura['Gastos fijos'].sum() > 0 else 0
+            )
             st.metric(
                 "✅ Cobertura Gastos Fijos",
                 f"{cobertura_gastos:.1f}%",
                 delta="Superávit" if cobertura_gastos >= 100 else "Déficit",
                 delta_color="normal" if cobertura_gastos >= 100 else "inverse",
-                help=f"OSA mensual vs Gastos: €{osa_mensual_promedio:,.2f} / €{total_gastos_fijos:,.2f}"
+                help=f"OSA mensual vs gastos vigentes cada mes: €{osa_mensual_promedio:,.2f} / €{gastos_mensual_promedio:,.2f} de media"
             )
         
-        # NUEVO KPI: Diferencia a pagar por Socios
-        diferencia_socios = total_gastos_fijos - osa_mensual_promedio
+        fig_cobertura = px.bar(
+            serie_cobertura,
+            x='Mes-Año',
+            y=['OSA retiene', 'Aporte socios'],
+            title='📅 Cobertura mensual de gastos fijos',
+            color_discrete_sequence=[COLORES['secondary'], '#ffb74d']
+        )
+        fig_cobertura.add_scatter(
+            x=serie_cobertura['Mes-Año'], y=serie_cobertura['Gastos fijos'],
+            mode='lines+markers', name='Gastos fijos vigentes', line=dict(color=COLORES['primary'])
+        )
+        fig_cobertura.update_layout(height=350, title_x=0.5, plot_bgcolor='white', yaxis_title='€', legend_title_text='')
+        st.plotly_chart(fig_cobertura, use_container_width=True)
+        
+        # Diferencia a pagar por Socios: media de los déficits mensuales, repartida con el % vigente cada mes
+        diferencia_socios = serie_cobertura['Aporte socios'].mean() if meses_periodo > 0 else 0
         
         st.markdown("---")
         st.subheader("💰 Distribución a Socios")
         
-        col_s1, col_s2, col_s3, col_s4 = st.columns(4)
+        columnas_socios = st.columns(1 + max(len(reparto_socios), 1))
         
-        with col_s1:
+        with columnas_socios[0]:
             st.markdown(f"""
             <div class='stMetric' style='background-color: #fff3e0;'>
                 <label style='color: {COLORES['primary']};'>💶 Diferencia a pagar por Socios</label>
                 <div style='font-size: 28px; font-weight: bold; color: {COLORES['primary']};'>
                     €{max(diferencia_socios, 0):,.2f}
                 </div>
-                <small>Total Gastos - OSA Retiene</small>
-            </div>
-            """, unsafe_allow_html=True)
-        
-        with col_s2:
-            aporte_fallone = max(diferencia_socios, 0) * 0.70
-            st.markdown(f"""
-            <div class='stMetric'>
-                <label>👤 Fallone (70%)</label>
-                <div style='font-size: 24px; font-weight: bold; color: {COLORES['primary']};'>
-                    €{aporte_fallone:,.2f}
-                </div>
-                <small>Aporte mensual</small>
-            </div>
-            """, unsafe_allow_html=True)
-        
-        with col_s3:
-            aporte_puigdellivol = max(diferencia_socios, 0) * 0.225
-            st.markdown(f"""
-            <div class='stMetric'>
-                <label>👤 Puigdellivol (22.5%)</label>
-                <div style='font-size: 24px; font-weight: bold; color: {COLORES['primary']};'>
-                    €{aporte_puigdellivol:,.2f}
-                </div>
-                <small>Aporte mensual</small>
+                <small>Media mensual de (Gastos - OSA Retiene)</small>
             </div>
             """, unsafe_allow_html=True)
         
-        with col_s4:
-            aporte_ortega = max(diferencia_socios, 0) * 0.075
-            st.markdown(f"""
-            <div class='stMetric'>
-                <label>👤 Ortega (7.5%)</label>
-                <div style='font-size: 24px; font-weight: bold; color: {COLORES['primary']};'>
-                    €{aporte_ortega:,.2f}
+        for columna, (socio, porcentaje) in zip(columnas_socios[1:], reparto_socios.items()):
+            with columna:
+                aporte_socio = serie_cobertura[f'Aporte {socio}'].mean() if f'Aporte {socio}' in serie_cobertura.columns else 0
+                st.markdown(f"""
+                <div class='stMetric'>
+                    <label>👤 {socio} ({porcentaje:g}%)</label>
+                    <div style='font-size: 24px; font-weight: bold; color: {COLORES['primary']};'>
+                        €{aporte_socio:,.2f}
+                    </div>
+                    <small>Aporte mensual medio</small>
                 </div>
-                <small>Aporte mensual</small>
-            </div>
-            """, unsafe_allow_html=True)
+                """, unsafe_allow_html=True)
     else:
         st.warning("⚠️ No hay datos cargados. Usando escenarios simulados para proyección.")
         medicos_consultor = 0
@@ -1239,20 +3085,31 @@ def proyeccion_gerencia(df):
         st.markdown(f"""
         <div style='margin-top: 25px;'>
             <small>Distribución:</small><br>
-            <strong>{pct_encima_promedio}%</strong> por encima (92%/90%)<br>
-            <strong>{100 - pct_encima_promedio}%</strong> por debajo (88%/85%)
+            <strong>{pct_encima_promedio}%</strong> por encima ({100 - margenes['CONSULTOR'][0]:g}%/{100 - margenes['ESPECIALISTA'][0]:g}%)<br>
+            <strong>{100 - pct_encima_promedio}%</strong> por debajo ({100 - margenes['CONSULTOR'][1]:g}%/{100 - margenes['ESPECIALISTA'][1]:g}%)
         </div>
         """, unsafe_allow_html=True)
     
+    # Valores de partida según el índice de tarifas de los datos cargados
+    referencia = referencia_tarifas(
+        cargar_indice_tarifas(),
+        df['Profesional'].nunique() if df is not None and not df.empty else 0
+    )
+    facturacion_referencia = (
+        int(min(max(round(referencia['hhmm_medico_mes'], -3), 1000), 100000)) if referencia else 20000
+    )
+    liquidacion_media = referencia['liquidacion_media'] if referencia and referencia['liquidacion_media'] else 0.70
+    
     with col_s3:
         st.markdown("**💰 Facturación Media por Médico**")
         facturacion_media = st.number_input(
             "Facturación HHMM mensual media (€)",
             min_value=1000,
             max_value=100000,
-            value=20000,
+            value=facturacion_referencia,
             step=1000,
-            help="Importe HHMM promedio por médico al mes",
+            help="Importe HHMM promedio por médico al mes. Valor inicial: volumen mensual × tarifa mediana "
+                 "de cada prestación según el índice de tarifas de los datos cargados",
             key="facturacion_media"
         )
     
@@ -1276,11 +3133,9 @@ def proyeccion_gerencia(df):
     especialistas_encima = int(escenario_especialistas * (pct_encima_promedio / 100))
     especialistas_debajo = escenario_especialistas - especialistas_encima
     
-    # Calcular márgenes individuales
-    margen_consultor_encima = 8.0
-    margen_consultor_debajo = 12.0
-    margen_especialista_encima = 10.0
-    margen_especialista_debajo = 15.0
+    # Márgenes individuales (reglas de cobro vigentes)
+    margen_consultor_encima, margen_consultor_debajo = margenes['CONSULTOR']
+    margen_especialista_encima, margen_especialista_debajo = margenes['ESPECIALISTA']
     
     # Calcular margen ponderado
     total_margen = (
@@ -1294,7 +3149,7 @@ def proyeccion_gerencia(df):
     
     # Calcular facturación necesaria
     facturacion_hhmm_necesaria = total_gastos_fijos / (margen_ponderado / 100) if margen_ponderado > 0 else 0
-    facturacion_vithas_necesaria = facturacion_hhmm_necesaria / 0.70
+    facturacion_vithas_necesaria = facturacion_hhmm_necesaria / liquidacion_media
     
     # Facturación por médico
     facturacion_hhmm_por_medico = facturacion_hhmm_necesaria / total_medicos_escenario if total_medicos_escenario > 0 else 0
@@ -1335,7 +3190,7 @@ def proyeccion_gerencia(df):
             <div style='font-size: 28px; font-weight: bold; color: {COLORES['primary']};'>
                 €{facturacion_vithas_necesaria:,.0f}
             </div>
-            <small>Estimado al 70% liquidación</small>
+            <small>Estimado al {liquidacion_media:.0%} liquidación</small>
         </div>
         """, unsafe_allow_html=True)
     
@@ -1366,6 +3221,25 @@ def proyeccion_gerencia(df):
     
     st.markdown("---")
     
+    # -----------------------------------------------------------------
+    # SIMULACIÓN MONTE CARLO SOBRE LA DISTRIBUCIÓN REAL
+    # -----------------------------------------------------------------
+    simulacion_montecarlo(df, escenario_consultores, escenario_especialistas, total_gastos_fijos, mes_proyeccion)
+    
+    st.markdown("---")
+    
+    # -----------------------------------------------------------------
+    # SUPERFICIE DE EQUILIBRIO (TODAS LAS COMPOSICIONES)
+    # -----------------------------------------------------------------
+    mapa_equilibrio(total_gastos_fijos, margenes, facturacion_media, escenario_consultores, escenario_especialistas,
+                    pct_encima_promedio)
+    
+    st.markdown("---")
+    
+    simulacion_whatif()
+    
+    st.markdown("---")
+    
     # -----------------------------------------------------------------
     # TABLA DE DISTRIBUCIÓN DETALLADA
     # -----------------------------------------------------------------
@@ -1378,8 +3252,8 @@ def proyeccion_gerencia(df):
             'Tipo': 'Consultor',
             'Rendimiento': 'Por encima',
             'Cantidad': consultores_encima,
-            'Margen OSA': f'{margen_consultor_encima}%',
-            '% Cobrar': '92%',
+            'Margen OSA': f'{margen_consultor_encima:g}%',
+            '% Cobrar': f'{100 - margen_consultor_encima:g}%',
             'Aporte por médico (€)': facturacion_media * (margen_consultor_encima / 100),
             'Aporte total (€)': consultores_encima * facturacion_media * (margen_consultor_encima / 100)
         })
@@ -1389,8 +3263,8 @@ def proyeccion_gerencia(df):
             'Tipo': 'Consultor',
             'Rendimiento': 'Por debajo',
             'Cantidad': consultores_debajo,
-            'Margen OSA': f'{margen_consultor_debajo}%',
-            '% Cobrar': '88%',
+            'Margen OSA': f'{margen_consultor_debajo:g}%',
+            '% Cobrar': f'{100 - margen_consultor_debajo:g}%',
             'Aporte por médico (€)': facturacion_media * (margen_consultor_debajo / 100),
             'Aporte total (€)': consultores_debajo * facturacion_media * (margen_consultor_debajo / 100)
         })
@@ -1400,8 +3274,8 @@ def proyeccion_gerencia(df):
             'Tipo': 'Especialista',
             'Rendimiento': 'Por encima',
             'Cantidad': especialistas_encima,
-            'Margen OSA': f'{margen_especialista_encima}%',
-            '% Cobrar': '90%',
+            'Margen OSA': f'{margen_especialista_encima:g}%',
+            '% Cobrar': f'{100 - margen_especialista_encima:g}%',
             'Aporte por médico (€)': facturacion_media * (margen_especialista_encima / 100),
             'Aporte total (€)': especialistas_encima * facturacion_media * (margen_especialista_encima / 100)
         })
@@ -1411,8 +3285,8 @@ def proyeccion_gerencia(df):
             'Tipo': 'Especialista',
             'Rendimiento': 'Por debajo',
             'Cantidad': especialistas_debajo,
-            'Margen OSA': f'{margen_especialista_debajo}%',
-            '% Cobrar': '85%',
+            'Margen OSA': f'{margen_especialista_debajo:g}%',
+            '% Cobrar': f'{100 - margen_especialista_debajo:g}%',
             'Aporte por médico (€)': facturacion_media * (margen_especialista_debajo / 100),
             'Aporte total (€)': especialistas_debajo * facturacion_media * (margen_especialista_debajo / 100)
         })
@@ -1501,53 +3375,1350 @@ def proyeccion_gerencia(df):
     </div>
     """, unsafe_allow_html=True)
     
-    # Botón de descarga de proyección
-    if st.button("📥 Descargar Proyección (Excel)", use_container_width=True, type="primary"):
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # Hoja 1: Gastos fijos
-            df_gastos = pd.DataFrame([
-                {'Concepto': 'SF', 'Monto': 3290},
-                {'Concepto': 'IR', 'Monto': 2835},
-                {'Concepto': 'Jefe Servicio', 'Monto': 3000},
-                {'Concepto': 'RC Profesional', 'Monto': 500},
-                {'Concepto': 'Otros', 'Monto': 100},
-                {'Concepto': 'Despacho legal y laboral', 'Monto': 400},
-                {'Concepto': 'TOTAL', 'Monto': total_gastos_fijos}
-            ])
-            df_gastos.to_excel(writer, index=False, sheet_name='Gastos_Fijos')
+    # Botón de descarga de proyección
+    if st.button("📥 Descargar Proyección (Excel)", use_container_width=True, type="primary"):
+        output = io.BytesIO()
+        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+            # Hoja 1: Gastos fijos
+            df_gastos = pd.DataFrame(
+                [{'Concepto': concepto, 'Monto': importe} for concepto, importe in gastos_fijos.items()] +
+                [{'Concepto': 'TOTAL', 'Monto': total_gastos_fijos}]
+            ).assign(**{'Mes': mes_proyeccion})
+            df_gastos.to_excel(writer, index=False, sheet_name='Gastos_Fijos')
+            
+            # Hoja: Cobertura mensual histórica
+            if df is not None and not df.empty:
+                cobertura_mensual(df).to_excel(writer, index=False, sheet_name='Cobertura_Mensual')
+            
+            # Hoja 2: Proyección
+            df_proyeccion = pd.DataFrame([{
+                'Composición': f'{escenario_consultores}C / {escenario_especialistas}E',
+                'Total Médicos': total_medicos_escenario,
+                '% Encima Promedio': f'{pct_encima_promedio}%',
+                'Margen Ponderado': f'{margen_ponderado:.1f}%',
+                'Facturación HHMM Necesaria': facturacion_hhmm_necesaria,
+                'Facturación Vithas Necesaria': facturacion_vithas_necesaria,
+                'Facturación HHMM x Médico': facturacion_hhmm_por_medico,
+                'Gastos Fijos Mensuales': total_gastos_fijos,
+                'Aporte OSA Estimado': total_aportes if 'total_aportes' in locals() else 0,
+                'Diferencia': (total_aportes - total_gastos_fijos) if 'total_aportes' in locals() else 0
+            }])
+            df_proyeccion.to_excel(writer, index=False, sheet_name='Proyeccion')
+            
+            # Hoja 3: Distribución detallada
+            if not df_distribucion.empty:
+                df_distribucion.to_excel(writer, index=False, sheet_name='Distribucion')
+        
+        output.seek(0)
+        
+        st.download_button(
+            label="⬇️ Confirmar Descarga Proyección",
+            data=output,
+            file_name=f"proyeccion_gerencia_{datetime.now().strftime('%Y%m%d')}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+# -------------------------------------------------------------------
+# MOTOR DE CONCILIACIÓN (NORMALIZACIÓN Y MATCH TOLERANTE)
+# -------------------------------------------------------------------
+COLUMNAS_MATCH_ARCHIVO1 = ['Fecha', 'Paciente', 'Denomin.prestación', 'Médico de tratamiento (nombre)']
+COLUMNAS_MATCH_ARCHIVO2 = ['Fecha del Servicio', 'NHC Paciente', 'Descripción de Prestación', 'Profesional']
+ESTADO_PAGADO = 'Pagado'
+ESTADO_NO_PAGADO = 'No pagado'
+ESTADO_HUERFANO = 'Pago huérfano'
+# Ingesta del match: los textos que usa el match se leen como str sin inferir
+# tipos; fechas e importes se convierten después con errors='coerce', así que
+# se dejan con el tipo que da el Excel. El resto de columnas se leen tal cual
+# (se muestran, se descargan y se guardan para los médicos)
+TIPOS_LECTURA_MATCH = {
+    'Paciente': str,
+    'NHC Paciente': str,
+    'Denomin.prestación': str,
+    'Descripción de Prestación': str,
+    'Médico de tratamiento (nombre)': str,
+    'Profesional': str,
+    'Aseguradora': str
+}
+
+def leer_archivos_match(*archivos):
+    """
+    Lee las hojas completas de los archivos del match (archivo 1 y archivo 2)
+    con los textos del match con tipo explícito, uno tras otro. No se leen en
+    paralelo: openpyxl analiza el Excel en Python y con hilos no se gana nada
+    por el GIL, y un pool de procesos dentro de Streamlit o hereda bloqueos de
+    otros hilos (fork) o vuelve a ejecutar app.py en cada proceso (spawn, porque
+    Streamlit registra el script como __main__). Ver scripts/medir_lectura_match.py.
+    Devuelve una lista de DataFrames en el mismo orden.
+    """
+    return [
+        pd.read_excel(io.BytesIO(archivo.getvalue()), dtype=TIPOS_LECTURA_MATCH)
+        for archivo in archivos
+    ]
+
+def normalizar_pacientes(serie):
+    """
+    Identificador de paciente comparable entre lecturas: texto sin espacios en
+    mayúsculas y los números enteros sin decimales. Una columna numérica con
+    huecos llega como float (1509.0) en una lectura y como '1509' si se lee
+    como texto; ambas dan '1509'.
+    """
+    texto = serie.astype(object).where(serie.notna(), 'nan').astype(str).str.strip().str.upper()
+    return texto.str.replace(r'^(\d+)\.0+$', r'\1', regex=True)
+
+def construir_llave_match(fecha_norm, paciente_norm, prestacion_norm, medico_norm):
+    """Llave exacta del match: 'fecha|paciente|prestación|médico'"""
+    return (
+        fecha_norm.dt.strftime('%Y-%m-%d').fillna('NaT') + '|' +
+        paciente_norm + '|' +
+        prestacion_norm + '|' +
+        medico_norm
+    )
+
+def normalizar_para_match(df, col_fecha, col_paciente, col_prestacion, col_medico):
+    """
+    Devuelve un DataFrame (mismo índice que df) con las columnas normalizadas
+    para el match y la llave 'fecha|paciente|prestación|médico'
+    """
+    norm = pd.DataFrame(index=df.index)
+    norm['Fecha_norm'] = pd.to_datetime(df[col_fecha], errors='coerce').dt.normalize()
+    norm['Paciente_norm'] = normalizar_pacientes(df[col_paciente])
+    norm['Prestacion_norm'] = normalizar_prestaciones(df[col_prestacion])
+    norm['Medico'] = resolver_nombres_profesionales(df[col_medico])[0]
+    norm['Medico_norm'] = normalizar_nombres_serie(norm['Medico'])
+    norm['llave_match'] = construir_llave_match(
+        norm['Fecha_norm'], norm['Paciente_norm'], norm['Prestacion_norm'], norm['Medico_norm']
+    )
+    return norm
+
+def _tokens_prestacion(descripcion):
+    """Tokens de una descripción de prestación sin acentos ni signos"""
+    limpia = ''.join(c if c.isalnum() else ' ' for c in plegar_acentos(descripcion))
+    return frozenset(limpia.split())
+
+def match_tolerante(norm1, norm2, dias_tolerancia=1, umbral_similitud=0.6):
+    """
+    Segunda pasada sobre los registros que no casaron de forma exacta.
+    - Bloquea candidatos por paciente y médico (nunca compara todos contra todos)
+    - Admite una diferencia de ±dias_tolerancia en la fecha
+    - Puntúa la similitud de la prestación (Jaccard de tokens), calculada una
+      sola vez por cada par distinto de descripciones
+    - Asigna uno a uno: en cada ronda se aceptan los pares que son la mejor
+      opción mutua de ambos lados
+    Devuelve un DataFrame con idx1, idx2, 'Días diferencia', 'Similitud', 'Confianza Match'.
+    """
+    columnas_resultado = ['idx1', 'idx2', 'Días diferencia', 'Similitud', 'Confianza Match']
+    if norm1.empty or norm2.empty:
+        return pd.DataFrame(columns=columnas_resultado)
+    
+    izq = norm1[['Fecha_norm', 'Paciente_norm', 'Medico_norm', 'Prestacion_norm']].rename_axis('idx1').reset_index()
+    der = norm2[['Fecha_norm', 'Paciente_norm', 'Medico_norm', 'Prestacion_norm']].rename_axis('idx2').reset_index()
+    
+    # Bloqueo por paciente + médico
+    pares = izq.merge(der, on=['Paciente_norm', 'Medico_norm'], suffixes=('_1', '_2'))
+    pares['Días diferencia'] = (pares['Fecha_norm_2'] - pares['Fecha_norm_1']).dt.days
+    pares = pares[pares['Días diferencia'].abs() <= dias_tolerancia]
+    if pares.empty:
+        return pd.DataFrame(columns=columnas_resultado)
+    
+    # Índice de tokens por descripción distinta y similitud por par distinto
+    codigos, descripciones = pd.factorize(pd.concat([pares['Prestacion_norm_1'], pares['Prestacion_norm_2']]))
+    tokens = [_tokens_prestacion(d) for d in descripciones]
+    pares['cod1'] = codigos[:len(pares)]
+    pares['cod2'] = codigos[len(pares):]
+    pares_distintos = pares[['cod1', 'cod2']].drop_duplicates()
+    similitudes = [
+        len(tokens[a] & tokens[b]) / len(tokens[a] | tokens[b]) if tokens[a] | tokens[b] else 0.0
+        for a, b in zip(pares_distintos['cod1'], pares_distintos['cod2'])
+    ]
+    pares_distintos = pares_distintos.assign(Similitud=similitudes)
+    pares = pares.merge(pares_distintos, on=['cod1', 'cod2'])
+    pares = pares[pares['Similitud'] >= umbral_similitud]
+    if pares.empty:
+        # Había candidatos por paciente, médico y fecha, pero ninguno lo bastante parecido
+        return pd.DataFrame(columns=columnas_resultado)
+    
+    # Puntuación: similitud penalizada por los días de diferencia
+    pares['puntuacion'] = pares['Similitud'] - 0.05 * pares['Días diferencia'].abs()
+    pares = pares.sort_values(['puntuacion', 'idx1', 'idx2'], ascending=[False, True, True])
+    
+    # Asignación uno a uno por rondas de mejor opción mutua
+    asignados = []
+    while not pares.empty:
+        # El primer par de la lista siempre es mejor opción mutua, así que cada ronda avanza
+        mejores = pares.drop_duplicates('idx1').merge(
+            pares.drop_duplicates('idx2')[['idx1', 'idx2']],
+            on=['idx1', 'idx2']
+        )
+        asignados.append(mejores)
+        pares = pares[~pares['idx1'].isin(mejores['idx1']) & ~pares['idx2'].isin(mejores['idx2'])]
+    
+    resultado = pd.concat(asignados, ignore_index=True)
+    resultado['Confianza Match'] = np.select(
+        [
+            (resultado['Días diferencia'] == 0) & (resultado['Similitud'] >= 0.9),
+            resultado['Similitud'] >= 0.75
+        ],
+        ['Alta', 'Media'],
+        default='Baja'
+    )
+    return resultado[columnas_resultado]
+
+def emparejar_normalizados(norm1, norm2, dias_tolerancia=None, umbral_similitud=0.6):
+    """
+    Empareja uno a uno dos conjuntos normalizados (ver normalizar_para_match).
+    
+    Las llaves repetidas se emparejan por número de ocurrencia: la 1ª aparición
+    de una llave en norm1 con la 1ª de norm2, la 2ª con la 2ª, etc. Si se indica
+    dias_tolerancia, el residuo pasa por match_tolerante().
+    Devuelve un DataFrame con idx1, idx2, 'Días diferencia', 'Similitud', 'Confianza Match'.
+    """
+    izq = pd.DataFrame({
+        'idx1': norm1.index,
+        'llave_match': norm1['llave_match'].to_numpy(),
+        'Ocurrencia': norm1.groupby('llave_match').cumcount().to_numpy()
+    })
+    der = pd.DataFrame({
+        'idx2': norm2.index,
+        'llave_match': norm2['llave_match'].to_numpy(),
+        'Ocurrencia': norm2.groupby('llave_match').cumcount().to_numpy()
+    })
+    exactos = izq.merge(der, on=['llave_match', 'Ocurrencia'])[['idx1', 'idx2']]
+    exactos = exactos.assign(**{'Días diferencia': 0, 'Similitud': 1.0, 'Confianza Match': 'Exacta'})
+    
+    if dias_tolerancia is None:
+        return exactos
+    
+    # Segunda pasada tolerante sobre el residuo de ambos lados
+    residuo1 = norm1[~norm1.index.isin(exactos['idx1'])]
+    residuo2 = norm2[~norm2.index.isin(exactos['idx2'])]
+    tolerantes = match_tolerante(residuo1, residuo2, dias_tolerancia, umbral_similitud)
+    if tolerantes.empty:
+        return exactos
+    return pd.concat([exactos, tolerantes], ignore_index=True)
+
+# -------------------------------------------------------------------
+# ÍNDICE DE TARIFAS (PRESTACIÓN × ASEGURADORA)
+# -------------------------------------------------------------------
+ARCHIVO_TARIFAS = 'indice_tarifas.parquet'
+SIN_ASEGURADORA = 'NO ESPECIFICADA'
+TODAS_ASEGURADORAS = '*'
+CUANTILES_TARIFA = {0.1: 'p10', 0.5: 'p50', 0.9: 'p90'}
+
+def normalizar_prestaciones(serie):
+    """Descripción de prestación en mayúsculas y sin espacios (igual que en el match)"""
+    return serie.astype(str).str.strip().str.upper()
+
+def normalizar_aseguradoras(serie):
+    """Aseguradora en mayúsculas y sin espacios; vacías como 'NO ESPECIFICADA'"""
+    return serie.astype('string').str.strip().str.upper().replace('', pd.NA).fillna(SIN_ASEGURADORA).astype(object)
+
+def construir_indice_tarifas(df):
+    """
+    Índice de tarifas indexado por (Prestacion_norm, Aseguradora_norm): nº de
+    registros, registros por mes y percentiles p10/p50/p90 de 'Importe HHMM' y
+    '% Liquidación'. Cada prestación tiene además una fila con aseguradora '*'
+    (todas) que sirve de respaldo. Se calcula con una única agregación.
+    """
+    columnas = ['Registros', 'Registros por mes'] + [
+        f'{etiqueta} {nombre}' for etiqueta in ['Importe', 'Liquidación'] for nombre in CUANTILES_TARIFA.values()
+    ]
+    if df is None or df.empty or not {'Descripción de Prestación', 'Importe HHMM'} <= set(df.columns):
+        vacio = pd.MultiIndex.from_arrays([[], []], names=['Prestacion_norm', 'Aseguradora_norm'])
+        return pd.DataFrame(columns=columnas, index=vacio, dtype=float)
+    
+    datos = pd.DataFrame({
+        'Prestacion_norm': normalizar_prestaciones(df['Descripción de Prestación']),
+        'Aseguradora_norm': normalizar_aseguradoras(df['Aseguradora']) if 'Aseguradora' in df.columns else SIN_ASEGURADORA,
+        'Importe': pd.to_numeric(df['Importe HHMM'], errors='coerce'),
+        'Liquidación': pd.to_numeric(df['% Liquidación'], errors='coerce') if '% Liquidación' in df.columns else float('nan')
+    })
+    meses = pd.to_datetime(df['Fecha del Servicio'], errors='coerce').dt.to_period('M').nunique() if 'Fecha del Servicio' in df.columns else 1
+    
+    # Filas por (prestación, aseguradora) y de respaldo por prestación en la misma agrupación
+    grupos = pd.concat(
+        [datos, datos.assign(Aseguradora_norm=TODAS_ASEGURADORAS)], ignore_index=True
+    ).groupby(['Prestacion_norm', 'Aseguradora_norm'])
+    
+    indice = grupos[['Importe', 'Liquidación']].quantile(list(CUANTILES_TARIFA)).unstack()
+    indice.columns = [f'{etiqueta} {CUANTILES_TARIFA[q]}' for etiqueta, q in indice.columns]
+    indice.insert(0, 'Registros', grupos.size())
+    indice.insert(1, 'Registros por mes', indice['Registros'] / max(meses, 1))
+    return indice[columnas]
+
+def guardar_indice_tarifas(df):
+    """Construye y guarda el índice de tarifas junto a los datos"""
+    return DataManager.save_dataframe(construir_indice_tarifas(df).reset_index(), ARCHIVO_TARIFAS)
+
+@st.cache_data(show_spinner=False)
+def _leer_indice_tarifas(path, firma):
+    return pd.read_parquet(path).set_index(['Prestacion_norm', 'Aseguradora_norm'])
+
+def cargar_indice_tarifas():
+    """
+    Índice de tarifas guardado (en caché hasta que cambie el archivo). Si aún
+    no existe pero hay datos cargados, se construye una vez a partir de ellos.
+    Devuelve None si no hay datos.
+    """
+    path = os.path.join(DataManager.get_data_path(), ARCHIVO_TARIFAS)
+    if _firma_archivo(path) is None:
+        df = DataManager.load_dataframe()
+        if df is None or not guardar_indice_tarifas(df):
+            return None
+    return _leer_indice_tarifas(path, _firma_archivo(path))
+
+def buscar_tarifa(indice, prestaciones, aseguradoras, columna='Importe p50'):
+    """
+    Valor de `columna` del índice para cada (prestación, aseguradora) ya
+    normalizadas; si el par no existe se usa la fila '*' de la prestación
+    y si tampoco existe queda NaN
+    """
+    if indice is None or indice.empty:
+        return pd.Series(float('nan'), index=prestaciones.index)
+    
+    prestaciones_arr = prestaciones.to_numpy()
+    valores = indice[columna]
+    exacto = valores.reindex(pd.MultiIndex.from_arrays([prestaciones_arr, aseguradoras.to_numpy()])).to_numpy()
+    respaldo = valores.reindex(pd.MultiIndex.from_arrays(
+        [prestaciones_arr, np.full(len(prestaciones_arr), TODAS_ASEGURADORAS, dtype=object)]
+    )).to_numpy()
+    return pd.Series(np.where(np.isnan(exacto), respaldo, exacto), index=prestaciones.index)
+
+def referencia_tarifas(indice, n_medicos):
+    """
+    Referencias para las proyecciones a partir de las filas '*' del índice:
+    facturación HHMM mensual (volumen mensual × mediana de cada prestación),
+    la misma por médico y % de liquidación medio ponderado por volumen.
+    Devuelve None si no hay índice.
+    """
+    if indice is None or indice.empty:
+        return None
+    
+    por_prestacion = indice.xs(TODAS_ASEGURADORAS, level='Aseguradora_norm')
+    hhmm_mensual = float((por_prestacion['Registros por mes'] * por_prestacion['Importe p50'].fillna(0)).sum())
+    con_liquidacion = por_prestacion[por_prestacion['Liquidación p50'] > 0]
+    liquidacion_media = (
+        float((con_liquidacion['Liquidación p50'] * con_liquidacion['Registros']).sum() / con_liquidacion['Registros'].sum() / 100)
+        if not con_liquidacion.empty else None
+    )
+    return {
+        'hhmm_mensual': hhmm_mensual,
+        'hhmm_medico_mes': hhmm_mensual / n_medicos if n_medicos > 0 else hhmm_mensual,
+        'liquidacion_media': liquidacion_media
+    }
+
+# -------------------------------------------------------------------
+# VALIDACIÓN DE LÍNEAS DE SERVICIO AL CARGAR (ANOMALÍAS)
+# -------------------------------------------------------------------
+# Regla: (descripción, severidad 0-100). La severidad de 'fuera_de_tarifa'
+# crece con la desviación respecto a la mediana de la tarifa.
+REGLAS_ANOMALIA = {
+    'importe_negativo': ('Importe HHMM negativo', 90),
+    'liquidacion_cero': ('% Liquidación igual a 0', 80),
+    'liquidacion_mayor_100': ('% Liquidación mayor que 100', 80),
+    'importe_vacio': ('Importe HHMM vacío o no numérico', 70),
+    'liquidacion_vacia': ('% Liquidación vacío (Importe Total = Importe HHMM)', 60),
+    'fecha_vacia': ('Fecha del servicio vacía o no válida', 50),
+    'fuera_de_tarifa': ('Importe fuera del rango habitual de la prestación', 40)
+}
+UMBRAL_DESVIACION_TARIFA = 3.0
+MIN_REGISTROS_TARIFA = 5
+
+def nivel_severidad(severidad):
+    """Alta (≥80), Media (≥50) o Baja"""
+    return np.select([severidad >= 80, severidad >= 50], ['Alta', 'Media'], default='Baja')
+
+def detectar_anomalias(df, tarifas=None):
+    """
+    Valida las líneas de servicio de un archivo procesado con operaciones
+    vectorizadas. `tarifas` es el índice histórico; se completa con el del
+    propio archivo. Devuelve solo las filas con alguna anomalía, con las
+    reglas incumplidas, una severidad 0-100 (la mayor de sus reglas) y su nivel.
+    """
+    n = len(df)
+    vacia = pd.Series(float('nan'), index=df.index)
+    importe = pd.to_numeric(df['Importe HHMM'], errors='coerce') if 'Importe HHMM' in df.columns else vacia
+    liquidacion = pd.to_numeric(df['% Liquidación'], errors='coerce') if '% Liquidación' in df.columns else vacia
+    fecha = pd.to_datetime(df['Fecha del Servicio'], errors='coerce') if 'Fecha del Servicio' in df.columns else vacia
+    
+    # Desviación robusta frente a la tarifa: (p90 - p10) ≈ 2.56 desviaciones típicas
+    tarifas_archivo = construir_indice_tarifas(df)
+    tarifas = tarifas_archivo if tarifas is None else tarifas.combine_first(tarifas_archivo)
+    prestaciones = normalizar_prestaciones(df['Descripción de Prestación']) if 'Descripción de Prestación' in df.columns else pd.Series('', index=df.index)
+    aseguradoras = normalizar_aseguradoras(df['Aseguradora']) if 'Aseguradora' in df.columns else pd.Series(SIN_ASEGURADORA, index=df.index)
+    p10, p50, p90, registros = (
+        buscar_tarifa(tarifas, prestaciones, aseguradoras, columna).to_numpy()
+        for columna in ['Importe p10', 'Importe p50', 'Importe p90', 'Registros']
+    )
+    escala = np.maximum((p90 - p10) / 2.563, np.maximum(np.abs(p50) * 0.05, 0.01))
+    desviacion = np.abs(importe.to_numpy() - p50) / escala
+    
+    reglas = {
+        'importe_negativo': (importe < 0).to_numpy(),
+        'liquidacion_cero': (liquidacion == 0).to_numpy(),
+        'liquidacion_mayor_100': (liquidacion > 100).to_numpy(),
+        'importe_vacio': importe.isna().to_numpy(),
+        'liquidacion_vacia': liquidacion.isna().to_numpy(),
+        'fecha_vacia': fecha.isna().to_numpy(),
+        'fuera_de_tarifa': (
+            (desviacion > UMBRAL_DESVIACION_TARIFA) & (registros >= MIN_REGISTROS_TARIFA) & (importe >= 0).to_numpy()
+        )
+    }
+    
+    severidades = np.zeros((n, len(reglas)))
+    descripcion = np.full(n, '', dtype=object)
+    for j, (regla, mascara) in enumerate(reglas.items()):
+        texto, severidad = REGLAS_ANOMALIA[regla]
+        if regla == 'fuera_de_tarifa':
+            severidad = np.minimum(severidad + 10 * (np.nan_to_num(desviacion) - UMBRAL_DESVIACION_TARIFA), 100)
+        severidades[:, j] = np.where(mascara, severidad, 0)
+        descripcion = descripcion + np.where(mascara, texto + '; ', '')
+    
+    severidad_fila = severidades.max(axis=1)
+    con_anomalia = severidad_fila > 0
+    anomalias = pd.DataFrame({
+        'Fila Excel': df.index.to_numpy() + 2,
+        'Profesional': df['Profesional'].to_numpy() if 'Profesional' in df.columns else '',
+        'Fecha del Servicio': fecha.to_numpy(),
+        'Descripción de Prestación': prestaciones.to_numpy(),
+        'Aseguradora': aseguradoras.to_numpy(),
+        'Importe HHMM': importe.to_numpy(),
+        '% Liquidación': liquidacion.to_numpy(),
+        'Tarifa mediana': p50,
+        'Anomalías': pd.Series(descripcion).str.rstrip('; ').to_numpy(),
+        'Nº reglas': (severidades > 0).sum(axis=1),
+        'Severidad': severidad_fila.round(0)
+    })[con_anomalia]
+    anomalias['Nivel'] = nivel_severidad(anomalias['Severidad'].to_numpy())
+    return anomalias.sort_values(['Severidad', 'Fila Excel'], ascending=[False, True]).reset_index(drop=True)
+
+def informe_anomalias(df_procesado):
+    """Informe compacto de anomalías del archivo antes de guardarlo"""
+    anomalias = detectar_anomalias(df_procesado, cargar_indice_tarifas())
+    if anomalias.empty:
+        st.success("✅ Validación: no se han detectado anomalías en las líneas de servicio.")
+        return anomalias
+    
+    niveles = anomalias['Nivel'].value_counts()
+    st.warning(f"⚠️ Validación: {len(anomalias):,} líneas con anomalías "
+               f"({len(anomalias) / len(df_procesado) * 100:.1f}% del archivo). Revísalas antes de guardar.")
+    
+    with st.expander("🚨 Informe de anomalías", expanded=niveles.get('Alta', 0) > 0):
+        col_a1, col_a2, col_a3 = st.columns(3)
+        with col_a1:
+            st.metric("🔴 Severidad alta", f"{niveles.get('Alta', 0):,}")
+        with col_a2:
+            st.metric("🟠 Severidad media", f"{niveles.get('Media', 0):,}")
+        with col_a3:
+            st.metric("🟡 Severidad baja", f"{niveles.get('Baja', 0):,}")
+        
+        # Recuento por regla (una línea puede incumplir varias)
+        por_regla = pd.DataFrame([
+            {'Regla': texto, 'Líneas': int(anomalias['Anomalías'].str.contains(texto, regex=False).sum())}
+            for texto, _ in REGLAS_ANOMALIA.values()
+        ])
+        col_b1, col_b2 = st.columns(2)
+        with col_b1:
+            st.markdown("**Por regla:**")
+            st.dataframe(por_regla[por_regla['Líneas'] > 0], use_container_width=True, hide_index=True)
+        with col_b2:
+            st.markdown("**Por profesional:**")
+            por_profesional = anomalias.groupby('Profesional').agg(
+                Líneas=('Severidad', 'size'),
+                **{'Severidad máx.': ('Severidad', 'max')}
+            ).sort_values('Líneas', ascending=False).reset_index()
+            st.dataframe(por_profesional, use_container_width=True, hide_index=True)
+        
+        st.markdown("**Detalle (mayor severidad primero):**")
+        st.dataframe(
+            anomalias,
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "Fecha del Servicio": st.column_config.DateColumn("Fecha del Servicio", format="DD/MM/YYYY"),
+                "Importe HHMM": st.column_config.NumberColumn("Importe HHMM", format="€%.2f"),
+                "Tarifa mediana": st.column_config.NumberColumn("Tarifa mediana", format="€%.2f"),
+                "Severidad": st.column_config.ProgressColumn("Severidad", min_value=0, max_value=100, format="%d")
+            }
+        )
+        
+        output = io.BytesIO()
+        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+            anomalias.to_excel(writer, index=False, sheet_name='Anomalías')
+        output.seek(0)
+        st.download_button(
+            label="📥 Descargar informe de anomalías (Excel)",
+            data=output,
+            file_name=f"anomalias_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            key="descargar_anomalias"
+        )
+    return anomalias
+
+# -------------------------------------------------------------------
+# IMPORTE ESPERADO DE LOS SERVICIOS NO PAGADOS
+# -------------------------------------------------------------------
+def inferir_aseguradoras(df1, norm1, df2):
+    """
+    Aseguradora de cada servicio del archivo 1: la columna 'Aseguradora' si existe;
+    si no, la aseguradora más frecuente del paciente en el archivo de pagos
+    """
+    if 'Aseguradora' in df1.columns:
+        return normalizar_aseguradoras(df1['Aseguradora'])
+    if not {'Aseguradora', 'NHC Paciente'} <= set(df2.columns):
+        return pd.Series(SIN_ASEGURADORA, index=norm1.index)
+    
+    habitual = (
+        pd.DataFrame({
+            'Paciente_norm': normalizar_pacientes(df2['NHC Paciente']),
+            'Aseguradora_norm': normalizar_aseguradoras(df2['Aseguradora'])
+        })
+        .value_counts()
+        .reset_index()
+        .drop_duplicates('Paciente_norm')
+        .set_index('Paciente_norm')['Aseguradora_norm']
+    )
+    return norm1['Paciente_norm'].map(habitual).fillna(SIN_ASEGURADORA)
+
+def estimar_importe_esperado(prestaciones, aseguradoras, tarifas):
+    """Importe esperado de cada servicio: mediana del índice de tarifas (0 si la prestación no tiene histórico)"""
+    return buscar_tarifa(tarifas, prestaciones, aseguradoras, 'Importe p50').fillna(0.0)
+
+def conciliar_archivos(df1, df2, df1_norm=None, df2_norm=None, dias_tolerancia=None, umbral_similitud=0.6,
+                       tarifas=None):
+    """
+    Concilia el archivo 1 (Mes finalizado real) contra el archivo 2 (Mes Pagado)
+    con emparejar_normalizados(). Añade a df1_norm las columnas 'Match',
+    'Cobrado OSA (€)', 'Confianza Match', 'idx2' (fila pagada del archivo 2),
+    'Aseguradora' e 'Importe esperado (€)' (solo no pagados, según el índice de
+    `tarifas` completado con las del propio archivo 2), y a df2_norm la columna
+    'Match'. Un pago nunca cubre dos servicios.
+    """
+    if df1_norm is None:
+        df1_norm = normalizar_para_match(df1, *COLUMNAS_MATCH_ARCHIVO1)
+    if df2_norm is None:
+        df2_norm = normalizar_para_match(df2, *COLUMNAS_MATCH_ARCHIVO2)
+    tarifas_pago = construir_indice_tarifas(df2)
+    tarifas = tarifas_pago if tarifas is None else tarifas.combine_first(tarifas_pago)
+    
+    # Importe HHMM del archivo 2 por fila
+    if 'Importe HHMM' in df2.columns:
+        df2_norm['Importe_HHMM_Archivo2'] = pd.to_numeric(df2['Importe HHMM'], errors='coerce')
+    else:
+        df2_norm['Importe_HHMM_Archivo2'] = 0
+    
+    pares = emparejar_normalizados(df1_norm, df2_norm, dias_tolerancia, umbral_similitud)
+    pares = pares.set_index('idx1')
+    
+    df1_norm['idx2'] = pares['idx2'].reindex(df1_norm.index).astype('Int64')
+    df1_norm['Match'] = df1_norm['idx2'].notna().to_numpy(dtype=bool)
+    df1_norm['Confianza Match'] = pares['Confianza Match'].reindex(df1_norm.index).fillna('')
+    df1_norm['Cobrado OSA (€)'] = 0.0
+    df1_norm.loc[pares.index, 'Cobrado OSA (€)'] = df2_norm.loc[pares['idx2'], 'Importe_HHMM_Archivo2'].fillna(0).to_numpy()
+    df2_norm['Match'] = df2_norm.index.isin(pares['idx2'])
+    
+    # Importe esperado de los no pagados a partir del índice de tarifas
+    df1_norm['Aseguradora'] = inferir_aseguradoras(df1, df1_norm, df2)
+    df1_norm['Importe esperado (€)'] = 0.0
+    no_pagados = ~df1_norm['Match']
+    df1_norm.loc[no_pagados, 'Importe esperado (€)'] = estimar_importe_esperado(
+        df1_norm.loc[no_pagados, 'Prestacion_norm'], df1_norm.loc[no_pagados, 'Aseguradora'], tarifas
+    )
+    
+    pares_tolerantes = pares[pares['Confianza Match'] != 'Exacta'].reset_index()
+    
+    # Resultado completo (outer): servicios del archivo 1 + pagos sin servicio del archivo 2
+    servicios = pd.DataFrame({
+        'Estado': np.where(df1_norm['Match'], ESTADO_PAGADO, ESTADO_NO_PAGADO),
+        'idx1': df1_norm.index,
+        'idx2': df1_norm['idx2'].to_numpy(),
+        'Profesional': df1_norm['Medico'].to_numpy(),
+        'Importe (€)': df1_norm['Cobrado OSA (€)'].to_numpy(),
+        'Importe esperado (€)': df1_norm['Importe esperado (€)'].to_numpy()
+    })
+    huerfanos = df2_norm[~df2_norm['Match']]
+    pagos_huerfanos = pd.DataFrame({
+        'Estado': ESTADO_HUERFANO,
+        'idx1': pd.array([pd.NA] * len(huerfanos), dtype='Int64'),
+        'idx2': huerfanos.index,
+        'Profesional': huerfanos['Medico'].to_numpy(),
+        'Importe (€)': huerfanos['Importe_HHMM_Archivo2'].fillna(0).to_numpy(),
+        'Importe esperado (€)': 0.0
+    })
+    resultado = pd.concat([servicios, pagos_huerfanos], ignore_index=True)
+    resultado['idx1'] = resultado['idx1'].astype('Int64')
+    resultado['idx2'] = resultado['idx2'].astype('Int64')
+    
+    return {
+        'df1_norm': df1_norm,
+        'df2_norm': df2_norm,
+        'pares_tolerantes': pares_tolerantes,
+        'resultado': resultado
+    }
+
+def resumen_conciliacion(resultado):
+    """
+    Totales y resumen por profesional de los tres grupos (pagados, no pagados
+    y pagos huérfanos) con una única agregación sobre el resultado completo
+    """
+    agregado = resultado.groupby(['Profesional', 'Estado']).agg(
+        Registros=('Estado', 'size'),
+        Importe=('Importe (€)', 'sum'),
+        Esperado=('Importe esperado (€)', 'sum')
+    ).unstack('Estado', fill_value=0)
+    
+    por_profesional = pd.DataFrame(index=agregado.index)
+    for estado in [ESTADO_PAGADO, ESTADO_NO_PAGADO, ESTADO_HUERFANO]:
+        por_profesional[estado] = agregado['Registros'][estado] if estado in agregado['Registros'] else 0
+        por_profesional[f'Importe {estado}'] = agregado['Importe'][estado] if estado in agregado['Importe'] else 0.0
+    por_profesional['Por Cobrar'] = agregado['Esperado'][ESTADO_NO_PAGADO] if ESTADO_NO_PAGADO in agregado['Esperado'] else 0.0
+    
+    por_profesional = por_profesional.reset_index()
+    total_servicios = por_profesional[ESTADO_PAGADO] + por_profesional[ESTADO_NO_PAGADO]
+    por_profesional = pd.DataFrame({
+        'Profesional': por_profesional['Profesional'],
+        'Total Registros': total_servicios,
+        'Pagados': por_profesional[ESTADO_PAGADO],
+        'No Pagados': por_profesional[ESTADO_NO_PAGADO],
+        '% Pago': (por_profesional[ESTADO_PAGADO] / total_servicios.where(total_servicios > 0) * 100).fillna(0),
+        'Cobrado (€)': por_profesional[f'Importe {ESTADO_PAGADO}'],
+        'Por Cobrar (€)': por_profesional['Por Cobrar'],
+        'Pagos huérfanos': por_profesional[ESTADO_HUERFANO],
+        'Importe huérfano (€)': por_profesional[f'Importe {ESTADO_HUERFANO}']
+    }).sort_values('Total Registros', ascending=False)
+    
+    totales = {
+        'pagados': int(por_profesional['Pagados'].sum()),
+        'no_pagados': int(por_profesional['No Pagados'].sum()),
+        'huerfanos': int(por_profesional['Pagos huérfanos'].sum()),
+        'cobrado': float(por_profesional['Cobrado (€)'].sum()),
+        'por_cobrar': float(por_profesional['Por Cobrar (€)'].sum()),
+        'importe_huerfano': float(por_profesional['Importe huérfano (€)'].sum())
+    }
+    return totales, por_profesional
+
+# -------------------------------------------------------------------
+# LIBRO DE PENDIENTES MULTI-MES (CARRY-OVER DE NO PAGADOS)
+# -------------------------------------------------------------------
+ARCHIVO_LEDGER = 'conciliacion_ledger.parquet'
+ESTADO_ABIERTO = 'Abierto'
+ESTADO_COBRADO = 'Cobrado'
+COLUMNAS_LEDGER = [
+    'Fecha', 'Paciente', 'Denomin.prestación', 'Médico de tratamiento (nombre)', 'Aseguradora',
+    'Fecha_norm', 'Paciente_norm', 'Prestacion_norm', 'Medico', 'Medico_norm', 'llave_match',
+    'Mes origen', 'Lote servicios', 'Fecha registro', 'Importe esperado (€)',
+    'Estado', 'Lote pago', 'Archivo pago', 'Fecha cobro', 'Cobrado OSA (€)', 'Confianza Match'
+]
+
+def hash_archivo(contenido):
+    """Huella corta del contenido de un archivo subido (identifica lotes ya registrados)"""
+    return hashlib.sha1(contenido).hexdigest()[:16]
+
+def cargar_ledger():
+    """Carga el libro de pendientes (vacío si aún no existe), ordenado por llave de match"""
+    ledger = DataManager.load_dataframe(ARCHIVO_LEDGER)
+    if ledger is None:
+        ledger = pd.DataFrame(columns=COLUMNAS_LEDGER)
+    ledger = migrar_llaves_ledger(ledger)
+    return ledger.sort_values('llave_match', kind='stable').reset_index(drop=True)
+
+def migrar_llaves_ledger(ledger):
+    """
+    Rehace las llaves guardadas antes de normalizar los NHC numéricos
+    ('…|1509.0|…' -> '…|1509|…') para que los pendientes abiertos sigan
+    casando con los pagos leídos ahora. Sin cambios devuelve el mismo libro.
+    """
+    if ledger.empty:
+        return ledger
+    paciente = normalizar_pacientes(ledger['Paciente_norm'])
+    if paciente.equals(ledger['Paciente_norm'].astype(paciente.dtype)):
+        return ledger
+    return ledger.assign(
+        Paciente_norm=paciente,
+        llave_match=construir_llave_match(
+            pd.to_datetime(ledger['Fecha_norm']), paciente,
+            ledger['Prestacion_norm'].astype(str), ledger['Medico_norm'].astype(str)
+        )
+    )
+
+def actualizar_ledger(ledger, df1, conciliacion, lote_servicios, lote_pago, nombre_pago,
+                      dias_tolerancia=None, umbral_similitud=0.6):
+    """
+    Actualiza el libro con un nuevo par de archivos:
+    1. Los pagos huérfanos del archivo 2 se concilian contra los pendientes
+       abiertos de meses anteriores (índice por llave + match tolerante opcional)
+    2. Si el lote de servicios ya estaba en el libro, sus pendientes abiertos
+       que ahora casan directamente con el archivo 2 se cierran
+    3. Los no pagados del archivo 1 se añaden como pendientes abiertos
+    Cada lote se aplica una sola vez: repetir el mismo par de archivos no duplica nada.
+    Devuelve (ledger actualizado, nº pendientes cerrados, nº pendientes nuevos).
+    """
+    df1_norm = conciliacion['df1_norm']
+    df2_norm = conciliacion['df2_norm']
+    cerrados = 0
+    nuevos = 0
+    
+    pago_nuevo = lote_pago not in set(ledger['Lote pago'].dropna())
+    lote_registrado = lote_servicios in set(ledger['Lote servicios'].dropna())
+    
+    # 1. Pagos huérfanos contra pendientes abiertos de otros lotes
+    if pago_nuevo:
+        abiertos = ledger[(ledger['Estado'] == ESTADO_ABIERTO) & (ledger['Lote servicios'] != lote_servicios)]
+        huerfanos = df2_norm[~df2_norm['Match']]
+        
+        # Solo se consideran los pendientes con llave o paciente+médico presentes en los pagos
+        llaves = pd.Index(huerfanos['llave_match'].unique())
+        if dias_tolerancia is None:
+            candidatos = abiertos[abiertos['llave_match'].isin(llaves)]
+        else:
+            bloques = pd.MultiIndex.from_frame(huerfanos[['Paciente_norm', 'Medico_norm']].drop_duplicates())
+            candidatos = abiertos[pd.MultiIndex.from_frame(abiertos[['Paciente_norm', 'Medico_norm']]).isin(bloques)]
+        
+        if not candidatos.empty and not huerfanos.empty:
+            pares = emparejar_normalizados(candidatos, huerfanos, dias_tolerancia, umbral_similitud)
+            if not pares.empty:
+                idx = pares['idx1'].to_numpy()
+                ledger.loc[idx, 'Estado'] = ESTADO_COBRADO
+                ledger.loc[idx, 'Lote pago'] = lote_pago
+                ledger.loc[idx, 'Archivo pago'] = nombre_pago
+                ledger.loc[idx, 'Fecha cobro'] = pd.Timestamp.now().normalize()
+                ledger.loc[idx, 'Cobrado OSA (€)'] = df2_norm.loc[pares['idx2'], 'Importe_HHMM_Archivo2'].fillna(0).to_numpy()
+                ledger.loc[idx, 'Confianza Match'] = pares['Confianza Match'].to_numpy()
+                cerrados = len(pares)
+    
+    # 2. Pendientes del mismo lote de servicios que casan directamente en esta ejecución
+    if pago_nuevo and lote_registrado:
+        abiertos = ledger[(ledger['Estado'] == ESTADO_ABIERTO) & (ledger['Lote servicios'] == lote_servicios)]
+        pagados = df1_norm[df1_norm['Match']]
+        if not abiertos.empty and not pagados.empty:
+            # Por llave siguen abiertos tantos como servicios no casan ahora; los
+            # últimos se cierran con el importe de los últimos servicios pagados
+            # de esa llave (los primeros ya estaban pagados al registrar el lote)
+            sin_pagar = df1_norm.loc[~df1_norm['Match'], 'llave_match'].value_counts()
+            por_llave = abiertos.groupby('llave_match')
+            cerrar = por_llave.cumcount() >= abiertos['llave_match'].map(sin_pagar).fillna(0).astype(int)
+            a_cerrar = pd.DataFrame({
+                'llave_match': abiertos['llave_match'],
+                'orden': por_llave.cumcount(ascending=False)
+            })[cerrar]
+            pagos = pd.DataFrame({
+                'llave_match': pagados['llave_match'],
+                'orden': pagados.groupby('llave_match').cumcount(ascending=False),
+                'Cobrado OSA (€)': pagados['Cobrado OSA (€)'].fillna(0),
+                'Confianza Match': pagados['Confianza Match']
+            })
+            cierres = a_cerrar.reset_index().merge(pagos, on=['llave_match', 'orden']).set_index('index')
+            if not cierres.empty:
+                idx = cierres.index
+                ledger.loc[idx, 'Estado'] = ESTADO_COBRADO
+                ledger.loc[idx, 'Lote pago'] = lote_pago
+                ledger.loc[idx, 'Archivo pago'] = nombre_pago
+                ledger.loc[idx, 'Fecha cobro'] = pd.Timestamp.now().normalize()
+                ledger.loc[idx, 'Cobrado OSA (€)'] = cierres['Cobrado OSA (€)'].to_numpy()
+                ledger.loc[idx, 'Confianza Match'] = cierres['Confianza Match'].to_numpy()
+                cerrados += len(cierres)
+    
+    # 3. No pagados del archivo 1 como nuevos pendientes abiertos
+    if not lote_registrado:
+        no_pagados = df1_norm[~df1_norm['Match']]
+        if not no_pagados.empty:
+            originales = df1.loc[no_pagados.index]
+            nuevos_pendientes = pd.DataFrame({
+                'Fecha': pd.to_datetime(originales['Fecha'], errors='coerce'),
+                'Paciente': originales['Paciente'].astype(str),
+                'Denomin.prestación': originales['Denomin.prestación'].astype(str),
+                'Médico de tratamiento (nombre)': originales['Médico de tratamiento (nombre)'].astype(str),
+                'Aseguradora': no_pagados['Aseguradora'],
+                'Fecha_norm': no_pagados['Fecha_norm'],
+                'Paciente_norm': no_pagados['Paciente_norm'],
+                'Prestacion_norm': no_pagados['Prestacion_norm'],
+                'Medico': no_pagados['Medico'],
+                'Medico_norm': no_pagados['Medico_norm'],
+                'llave_match': no_pagados['llave_match'],
+                'Mes origen': no_pagados['Fecha_norm'].dt.strftime('%Y-%m'),
+                'Lote servicios': lote_servicios,
+                'Fecha registro': pd.Timestamp.now().normalize(),
+                'Importe esperado (€)': no_pagados['Importe esperado (€)'],
+                'Estado': ESTADO_ABIERTO,
+                'Lote pago': None,
+                'Archivo pago': None,
+                'Fecha cobro': pd.NaT,
+                'Cobrado OSA (€)': 0.0,
+                'Confianza Match': ''
+            })
+            # Con el libro vacío se evita concat: mantendría columnas de tipo object
+            ledger = nuevos_pendientes if ledger.empty else pd.concat([ledger, nuevos_pendientes], ignore_index=True)
+            nuevos = len(nuevos_pendientes)
+    
+    ledger = ledger.sort_values('llave_match', kind='stable').reset_index(drop=True)
+    return ledger, cerrados, nuevos
+
+# -------------------------------------------------------------------
+# ANTIGÜEDAD DE COBROS (AGING) SOBRE EL LIBRO DE PENDIENTES
+# -------------------------------------------------------------------
+ARCHIVO_AGING = 'aging_cobros.parquet'
+TRAMOS_ANTIGUEDAD = ['0–30 días', '31–60 días', '61–90 días', '>90 días']
+LIMITES_TRAMOS = [-float('inf'), 30, 60, 90, float('inf')]
+
+def calcular_aging(ledger, fecha_corte=None):
+    """
+    Agrega los pendientes abiertos del libro por médico, aseguradora y tramo
+    de antigüedad (nº de servicios e importe esperado). Se precalcula al
+    ejecutar el match y se guarda para que los paneles solo tengan que leerlo.
+    """
+    fecha_corte = pd.Timestamp.now().normalize() if fecha_corte is None else pd.Timestamp(fecha_corte)
+    abiertos = ledger[ledger['Estado'] == ESTADO_ABIERTO]
+    dias = (fecha_corte - pd.to_datetime(abiertos['Fecha_norm'])).dt.days
+    
+    aging = abiertos.assign(
+        Aseguradora=abiertos['Aseguradora'].fillna(SIN_ASEGURADORA),
+        Tramo=pd.cut(dias, LIMITES_TRAMOS, labels=TRAMOS_ANTIGUEDAD)
+    ).groupby(['Medico', 'Aseguradora', 'Tramo'], observed=True).agg(
+        Servicios=('llave_match', 'size'),
+        **{'Importe esperado (€)': ('Importe esperado (€)', 'sum')}
+    ).reset_index()
+    aging['Fecha corte'] = fecha_corte
+    return aging
+
+def mostrar_aging(profesional=None):
+    """Muestra el aging precalculado: tramos por médico y por aseguradora (o solo los de un médico)"""
+    aging = DataManager.load_dataframe(ARCHIVO_AGING)
+    if aging is None or aging.empty:
+        return
+    
+    if profesional is not None:
+        aging = aging[normalizar_nombres_serie(aging['Medico']) == normalizar_nombre_medico(profesional)]
+        if aging.empty:
+            return
+    
+    fecha_corte = pd.Timestamp(aging['Fecha corte'].iloc[0])
+    st.markdown(f"**⏱️ Antigüedad de lo pendiente de cobro** (calculada al {fecha_corte:%d/%m/%Y}):")
+    
+    importe_tramo = aging.groupby('Tramo', observed=False)['Importe esperado (€)'].sum().reindex(TRAMOS_ANTIGUEDAD, fill_value=0)
+    columnas_tramo = st.columns(len(TRAMOS_ANTIGUEDAD))
+    for columna, tramo in zip(columnas_tramo, TRAMOS_ANTIGUEDAD):
+        with columna:
+            st.metric(tramo, f"€{importe_tramo[tramo]:,.2f}")
+    
+    formato_tramos = {tramo: st.column_config.NumberColumn(tramo, format="€%.2f") for tramo in TRAMOS_ANTIGUEDAD + ['Total']}
+    agrupaciones = [('Aseguradora', 'Por aseguradora')] if profesional is not None else [('Medico', 'Por médico'), ('Aseguradora', 'Por aseguradora')]
+    for columna_agrupacion, titulo in agrupaciones:
+        pivote = aging.pivot_table(
+            index=columna_agrupacion, columns='Tramo', values='Importe esperado (€)',
+            aggfunc='sum', fill_value=0, observed=False
+        ).reindex(columns=TRAMOS_ANTIGUEDAD, fill_value=0)
+        pivote['Total'] = pivote.sum(axis=1)
+        st.markdown(f"*{titulo} (importe esperado):*")
+        st.dataframe(pivote.sort_values('Total', ascending=False), use_container_width=True, column_config=formato_tramos)
+
+def libro_pendientes(profesional=None):
+    """Muestra el libro de pendientes multi-mes (todos o solo los de un profesional)"""
+    ledger = cargar_ledger()
+    if ledger.empty:
+        st.info("📒 El libro de pendientes está vacío. Se alimenta cada vez que el administrador ejecuta un match.")
+        return
+    
+    if profesional is not None:
+        ledger = ledger[ledger['Medico_norm'] == normalizar_nombre_medico(profesional)]
+    
+    abiertos = ledger[ledger['Estado'] == ESTADO_ABIERTO]
+    cobrados = ledger[ledger['Estado'] == ESTADO_COBRADO]
+    hoy = pd.Timestamp.now().normalize()
+    
+    col_l1, col_l2, col_l3 = st.columns(3)
+    with col_l1:
+        st.metric("⏳ Pendientes abiertos", f"{len(abiertos):,}",
+                  f"€{abiertos['Importe esperado (€)'].sum():,.2f} esperados", delta_color="off")
+    with col_l2:
+        st.metric("✅ Cobrados en meses posteriores", f"{len(cobrados):,}")
+    with col_l3:
+        antiguedad_media = (hoy - abiertos['Fecha_norm']).dt.days.mean() if not abiertos.empty else 0
+        st.metric("📅 Antigüedad media (días)", f"{antiguedad_media:,.0f}")
+    
+    if not abiertos.empty:
+        mostrar_aging(profesional)
+        
+        st.markdown("**Pendientes abiertos por mes de origen:**")
+        indice = 'Medico' if profesional is None else 'Denomin.prestación'
+        pivote = abiertos.pivot_table(index=indice, columns='Mes origen', values='llave_match', aggfunc='count', fill_value=0)
+        st.dataframe(pivote, use_container_width=True)
+        
+        with st.expander("🔍 Ver pendientes abiertos", expanded=False):
+            detalle = abiertos[['Fecha', 'Paciente', 'Denomin.prestación', 'Medico', 'Aseguradora', 'Mes origen', 'Importe esperado (€)']].assign(
+                **{'Días pendiente': (hoy - abiertos['Fecha_norm']).dt.days}
+            ).sort_values('Días pendiente', ascending=False)
+            st.dataframe(
+                detalle,
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    "Importe esperado (€)": st.column_config.NumberColumn("Importe esperado (€)", format="€%.2f")
+                }
+            )
+    
+    if not cobrados.empty:
+        with st.expander("✅ Ver pendientes cobrados en meses posteriores", expanded=False):
+            st.dataframe(
+                cobrados[['Fecha', 'Paciente', 'Denomin.prestación', 'Medico', 'Mes origen',
+                          'Archivo pago', 'Fecha cobro', 'Cobrado OSA (€)', 'Confianza Match']],
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    "Cobrado OSA (€)": st.column_config.NumberColumn("Cobrado OSA (€)", format="€%.2f")
+                }
+            )
+
+# -------------------------------------------------------------------
+# FUNCIÓN DE MATCH DE ARCHIVOS (PARA ADMIN) - CORREGIDA
+# -------------------------------------------------------------------
+CLAVE_RESULTADO_MATCH = 'match_resultado'
+
+def clave_match(archivo1, archivo2, dias_tolerancia, umbral_similitud):
+    """
+    Identifica un match por la huella de los dos archivos subidos y las
+    opciones de la pasada tolerante (dias_tolerancia None = sin pasada tolerante)
+    """
+    return (
+        hash_archivo(archivo1.getvalue()),
+        hash_archivo(archivo2.getvalue()),
+        dias_tolerancia,
+        umbral_similitud if dias_tolerancia is not None else None
+    )
+
+def ejecutar_match(archivo1, archivo2, clave, dias_tolerancia, umbral_similitud):
+    """
+    Lee y concilia los dos archivos, guarda el resultado para los médicos y
+    actualiza el libro de pendientes. Devuelve todo lo que necesita
+    mostrar_resultado_match, para conservarlo en la sesión.
+    """
+    
+    # Cargar archivos
+    df1, df2 = leer_archivos_match(archivo1, archivo2)
+    
+    # Verificar que existan las columnas necesarias
+    columnas_df1 = ['Fecha', 'Paciente', 'Denomin.prestación', 'Médico de tratamiento (nombre)']
+    columnas_df2 = ['Fecha del Servicio', 'NHC Paciente', 'Descripción de Prestación', 'Profesional']
+    
+    columnas_faltantes_df1 = [col for col in columnas_df1 if col not in df1.columns]
+    columnas_faltantes_df2 = [col for col in columnas_df2 if col not in df2.columns]
+    
+    if columnas_faltantes_df1 or columnas_faltantes_df2:
+        if columnas_faltantes_df1:
+            st.error(f"❌ Archivo 1: Faltan columnas: {', '.join(columnas_faltantes_df1)}")
+        if columnas_faltantes_df2:
+            st.error(f"❌ Archivo 2: Faltan columnas: {', '.join(columnas_faltantes_df2)}")
+        
+        with st.expander("🔍 Ver columnas disponibles en Archivo 1"):
+            st.write(df1.columns.tolist())
+        with st.expander("🔍 Ver columnas disponibles en Archivo 2"):
+            st.write(df2.columns.tolist())
+        
+        st.stop()
+    
+    # -----------------------------------------------------------------
+    # PASO 1: NORMALIZAR COLUMNAS Y CREAR LLAVE DE MATCH
+    # -----------------------------------------------------------------
+    df1_norm = normalizar_para_match(df1, *COLUMNAS_MATCH_ARCHIVO1)
+    df2_norm = normalizar_para_match(df2, *COLUMNAS_MATCH_ARCHIVO2)
+    
+    # -----------------------------------------------------------------
+    # PASO 2: COINCIDENCIAS EXACTAS + SEGUNDA PASADA TOLERANTE
+    # -----------------------------------------------------------------
+    conciliacion = conciliar_archivos(
+        df1, df2, df1_norm, df2_norm,
+        dias_tolerancia=dias_tolerancia,
+        umbral_similitud=umbral_similitud,
+        tarifas=cargar_indice_tarifas()
+    )
+    
+    # -----------------------------------------------------------------
+    # PASO 3: SEPARAR PAGADOS Y NO PAGADOS CON SUS IMPORTES
+    # -----------------------------------------------------------------
+    
+    # Para los pagados, columna "Cobrado OSA (€)" con el Importe HHMM del archivo 2
+    df_match = df1[df1_norm['Match']]
+    df_match_con_importes = df_match.assign(**{
+        'Cobrado OSA (€)': df1_norm.loc[df1_norm['Match'], 'Cobrado OSA (€)'],
+        'Confianza Match': df1_norm.loc[df1_norm['Match'], 'Confianza Match']
+    })
+    
+    # Para los no pagados, columna "Por Cobrar OSA (€)" con el importe esperado
+    # (mediana histórica del Importe HHMM para la prestación y aseguradora)
+    df_no_pagados = df1[~df1_norm['Match']]
+    df_no_pagados_con_importes = df_no_pagados.assign(**{
+        'Por Cobrar OSA (€)': df1_norm.loc[~df1_norm['Match'], 'Importe esperado (€)']
+    })
+    
+    # Pagos del archivo 2 sin servicio en el archivo 1
+    resultado = conciliacion['resultado']
+    idx_huerfanos = resultado.loc[resultado['Estado'] == ESTADO_HUERFANO, 'idx2'].to_numpy(dtype=int)
+    df_huerfanos = df2.loc[idx_huerfanos]
+    
+    # -----------------------------------------------------------------
+    # PASO 4: GUARDAR ARCHIVOS PARA LOS MÉDICOS
+    # -----------------------------------------------------------------
+    # Guardar los archivos originales para que los médicos puedan consultarlos
+    DataManager.save_dataframe(df1, 'archivo1_match.parquet')
+    DataManager.save_dataframe(df2, 'archivo2_match.parquet')
+    
+    # Guardar también los DataFrames con las nuevas columnas para los médicos
+    DataManager.save_dataframe(df_match_con_importes, 'match_pagados.parquet')
+    DataManager.save_dataframe(df_no_pagados_con_importes.assign(**{
+        'Aseguradora': df1_norm.loc[~df1_norm['Match'], 'Aseguradora']
+    }), 'match_nopagados.parquet')
+    DataManager.save_dataframe(df_huerfanos, 'match_huerfanos.parquet')
+    
+    # Actualizar el libro de pendientes multi-mes
+    ledger, cerrados, nuevos = actualizar_ledger(
+        cargar_ledger(), df1, conciliacion,
+        lote_servicios=clave[0],
+        lote_pago=clave[1],
+        nombre_pago=archivo2.name,
+        dias_tolerancia=dias_tolerancia,
+        umbral_similitud=umbral_similitud
+    )
+    DataManager.save_dataframe(ledger, ARCHIVO_LEDGER)
+    DataManager.save_dataframe(calcular_aging(ledger), ARCHIVO_AGING)
+    
+    return {
+        'clave': clave,
+        'df1': df1,
+        'df2': df2,
+        'df1_norm': df1_norm,
+        'df2_norm': df2_norm,
+        'resultado': resultado,
+        'pares_tolerantes': conciliacion['pares_tolerantes'],
+        'df_match_con_importes': df_match_con_importes,
+        'df_no_pagados_con_importes': df_no_pagados_con_importes,
+        'df_huerfanos': df_huerfanos,
+        'cerrados': cerrados,
+        'nuevos': nuevos
+    }
+
+def mostrar_resultado_match(match):
+    """
+    Muestra un resultado de ejecutar_match. Los filtros y las pestañas solo
+    recortan el resultado guardado en la sesión: cambiar un filtro o
+    descargar una tabla no vuelve a leer ni a conciliar los archivos.
+    """
+    df1, df2 = match['df1'], match['df2']
+    df1_norm, df2_norm = match['df1_norm'], match['df2_norm']
+    resultado = match['resultado']
+    df_match_con_importes = match['df_match_con_importes']
+    df_no_pagados_con_importes = match['df_no_pagados_con_importes']
+    df_huerfanos = match['df_huerfanos']
+    pares_tolerantes = match['pares_tolerantes']
+    
+    # Información básica
+    st.info(f"📊 Archivo 1: {len(df1)} registros | Archivo 2: {len(df2)} registros")
+    
+    # Mostrar ejemplos de normalización para verificar
+    with st.expander("🔍 Ver ejemplos de normalización de nombres", expanded=False):
+        col_ex1, col_ex2 = st.columns(2)
+        
+        with col_ex1:
+            st.markdown("**Archivo 1 - Nombres originales vs normalizados:**")
+            ejemplos_df1 = df1[['Médico de tratamiento (nombre)']].join(df1_norm['Medico_norm']).dropna().head(10)
+            st.dataframe(ejemplos_df1, use_container_width=True)
+        
+        with col_ex2:
+            st.markdown("**Archivo 2 - Nombres originales vs normalizados:**")
+            ejemplos_df2 = df2[['Profesional']].join(df2_norm['Medico_norm']).dropna().head(10)
+            st.dataframe(ejemplos_df2, use_container_width=True)
+    
+    if not pares_tolerantes.empty:
+        st.info(f"🧩 Match tolerante: {len(pares_tolerantes):,} coincidencias adicionales "
+                f"({', '.join(f'{k}: {v}' for k, v in pares_tolerantes['Confianza Match'].value_counts().items())})")
+    
+    # -----------------------------------------------------------------
+    # PASO 1: MOSTRAR RESULTADOS
+    # -----------------------------------------------------------------
+    
+    st.markdown("---")
+    st.subheader("📊 Resultados del Match")
+    
+    # Métricas principales
+    col_m1, col_m2, col_m3, col_m4, col_m5 = st.columns(5)
+    
+    with col_m1:
+        st.markdown(f"""
+        <div class='stMetric'>
+            <label>📋 Total Archivo 1</label>
+            <div class='metric-highlight'>{len(df1):,}</div>
+            <small>Registros a verificar</small>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    with col_m2:
+        st.markdown(f"""
+        <div class='stMetric'>
+            <label>✅ Coincidencias</label>
+            <div class='metric-highlight' style='color: #28a745;'>{len(df_match_con_importes):,}</div>
+            <small>Pagados correctamente</small>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    with col_m3:
+        st.markdown(f"""
+        <div class='stMetric'>
+            <label>❌ No pagados</label>
+            <div class='metric-highlight' style='color: #dc3545;'>{len(df_no_pagados_con_importes):,}</div>
+            <small>No encontrados en Archivo 2 (≈ €{df_no_pagados_con_importes['Por Cobrar OSA (€)'].sum():,.2f})</small>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    with col_m4:
+        porcentaje_coincidencia = (len(df_match_con_importes) / len(df1) * 100) if len(df1) > 0 else 0
+        st.markdown(f"""
+        <div class='stMetric'>
+            <label>📊 % Coincidencia</label>
+            <div class='metric-highlight'>{porcentaje_coincidencia:.1f}%</div>
+            <small>Tasa de pago</small>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    with col_m5:
+        st.markdown(f"""
+        <div class='stMetric'>
+            <label>💸 Pagos huérfanos</label>
+            <div class='metric-highlight' style='color: #ffc107;'>{len(df_huerfanos):,}</div>
+            <small>En Archivo 2 sin servicio en Archivo 1</small>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    st.markdown("---")
+    
+    # -----------------------------------------------------------------
+    # PASO 2: FILTROS POR PROFESIONAL Y DESCRIPCIÓN DE PRESTACIÓN
+    # -----------------------------------------------------------------
+    st.subheader("🔍 Análisis Detallado con Filtros")
+    
+    col_f1, col_f2 = st.columns(2)
+    
+    with col_f1:
+        # Obtener lista de profesionales únicos del archivo 1 (usando el original, no el normalizado)
+        profesionales = ['TODOS'] + sorted(df1['Médico de tratamiento (nombre)'].dropna().unique().tolist())
+        profesional_filtro = st.selectbox(
+            "👨‍⚕️ Filtrar por Profesional",
+            profesionales,
+            key="match_filtro_profesional"
+        )
+    
+    with col_f2:
+        # Obtener lista de prestaciones únicas del archivo 1
+        prestaciones = ['TODAS'] + sorted(df1['Denomin.prestación'].dropna().unique().tolist())
+        prestacion_filtro = st.selectbox(
+            "🩺 Filtrar por Descripción de Prestación",
+            prestaciones,
+            key="match_filtro_prestacion"
+        )
+    
+    # Aplicar filtros (sin filtros activos las tablas se usan tal cual, sin copiar)
+    filtra_profesional = profesional_filtro != 'TODOS'
+    filtra_prestacion = prestacion_filtro != 'TODAS'
+    
+    def filtrar_servicios(tabla):
+        return filtrar_vista(
+            tabla,
+            tabla['Médico de tratamiento (nombre)'] == profesional_filtro if filtra_profesional else None,
+            tabla['Denomin.prestación'] == prestacion_filtro if filtra_prestacion else None
+        )
+    
+    df1_filtrado = filtrar_servicios(df1)
+    df_match_filtrado = filtrar_servicios(df_match_con_importes)
+    df_no_pagados_filtrado = filtrar_servicios(df_no_pagados_con_importes)
+    # Los pagos huérfanos se filtran por el nombre del catálogo del profesional elegido
+    norm_huerfanos = df2_norm.loc[df_huerfanos.index]
+    if filtra_profesional:
+        medicos_filtro = set(df1_norm.loc[df1['Médico de tratamiento (nombre)'] == profesional_filtro, 'Medico'])
+    df_huerfanos_filtrado = filtrar_vista(
+        df_huerfanos,
+        norm_huerfanos['Medico'].isin(medicos_filtro) if filtra_profesional else None,
+        norm_huerfanos['Prestacion_norm'] == str(prestacion_filtro).strip().upper() if filtra_prestacion else None
+    )
+    resultado_filtrado = resultado
+    
+    if profesional_filtro != 'TODOS' or prestacion_filtro != 'TODAS':
+        resultado_filtrado = resultado[
+            resultado['idx1'].isin(df1_filtrado.index) |
+            (resultado['idx2'].isin(df_huerfanos_filtrado.index) & (resultado['Estado'] == ESTADO_HUERFANO))
+        ]
+    
+    # Métricas con filtros aplicados
+    col_fm1, col_fm2, col_fm3 = st.columns(3)
+    
+    with col_fm1:
+        st.metric(
+            "📋 Registros en filtro",
+            f"{len(df1_filtrado):,}"
+        )
+    
+    with col_fm2:
+        st.metric(
+            "✅ Pagados en filtro",
+            f"{len(df_match_filtrado):,}",
+            delta=f"{(len(df_match_filtrado)/len(df1_filtrado)*100):.1f}%" if len(df1_filtrado) > 0 else "0%"
+        )
+    
+    with col_fm3:
+        st.metric(
+            "❌ No pagados en filtro",
+            f"{len(df_no_pagados_filtrado):,}",
+            delta=f"{(len(df_no_pagados_filtrado)/len(df1_filtrado)*100):.1f}%" if len(df1_filtrado) > 0 else "0%",
+            delta_color="inverse"
+        )
+    
+    # -----------------------------------------------------------------
+    # PASO 3: MOSTRAR TABLAS
+    # -----------------------------------------------------------------
+    
+    tab1, tab2, tab_huerfanos, tab3 = st.tabs([
+        "✅ Pagados", "❌ No Pagados", "💸 Pagos sin servicio", "📊 Resumen por Profesional"
+    ])
+    
+    with tab1:
+        st.subheader(f"Registros Pagados Correctamente ({len(df_match_filtrado)})")
+        if not df_match_filtrado.empty:
+            # Seleccionar columnas a mostrar incluyendo Cobrado OSA
+            columnas_mostrar = df_match_filtrado.columns.tolist()
+            if 'Cobrado OSA (€)' in df_match_filtrado.columns:
+                st.dataframe(
+                    df_match_filtrado,
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={
+                        "Cobrado OSA (€)": st.column_config.NumberColumn(
+                            "Cobrado OSA (€)",
+                            format="€%.2f",
+                            help="Importe HHMM del Archivo 2 (pagado)"
+                        )
+                    }
+                )
+            else:
+                st.dataframe(
+                    df_match_filtrado,
+                    use_container_width=True,
+                    hide_index=True
+                )
             
-            # Hoja 2: Proyección
-            df_proyeccion = pd.DataFrame([{
-                'Composición': f'{escenario_consultores}C / {escenario_especialistas}E',
-                'Total Médicos': total_medicos_escenario,
-                '% Encima Promedio': f'{pct_encima_promedio}%',
-                'Margen Ponderado': f'{margen_ponderado:.1f}%',
-                'Facturación HHMM Necesaria': facturacion_hhmm_necesaria,
-                'Facturación Vithas Necesaria': facturacion_vithas_necesaria,
-                'Facturación HHMM x Médico': facturacion_hhmm_por_medico,
-                'Gastos Fijos Mensuales': total_gastos_fijos,
-                'Aporte OSA Estimado': total_aportes if 'total_aportes' in locals() else 0,
-                'Diferencia': (total_aportes - total_gastos_fijos) if 'total_aportes' in locals() else 0
-            }])
-            df_proyeccion.to_excel(writer, index=False, sheet_name='Proyeccion')
+            # Botón de descarga
+            output = io.BytesIO()
+            with pd.ExcelWriter(output, engine='openpyxl') as writer:
+                df_match_filtrado.to_excel(writer, index=False, sheet_name='Pagados')
+            output.seek(0)
             
-            # Hoja 3: Distribución detallada
-            if not df_distribucion.empty:
-                df_distribucion.to_excel(writer, index=False, sheet_name='Distribucion')
+            st.download_button(
+                label="📥 Descargar Pagados (Excel)",
+                data=output,
+                file_name=f"pagados_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+        else:
+            st.info("No hay registros pagados con los filtros seleccionados.")
+    
+    with tab2:
+        st.subheader(f"Registros No Pagados ({len(df_no_pagados_filtrado)})")
+        if not df_no_pagados_filtrado.empty:
+            # Seleccionar columnas a mostrar incluyendo Por Cobrar OSA (importe esperado)
+            if 'Por Cobrar OSA (€)' in df_no_pagados_filtrado.columns:
+                st.dataframe(
+                    df_no_pagados_filtrado,
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={
+                        "Por Cobrar OSA (€)": st.column_config.NumberColumn(
+                            "Por Cobrar OSA (€)",
+                            format="€%.2f",
+                            help="Estimado: mediana histórica del Importe HHMM para la prestación y aseguradora"
+                        )
+                    }
+                )
+            else:
+                st.dataframe(
+                    df_no_pagados_filtrado,
+                    use_container_width=True,
+                    hide_index=True
+                )
+            
+            # Botón de descarga
+            output = io.BytesIO()
+            with pd.ExcelWriter(output, engine='openpyxl') as writer:
+                df_no_pagados_filtrado.to_excel(writer, index=False, sheet_name='No_Pagados')
+            output.seek(0)
+            
+            st.download_button(
+                label="📥 Descargar No Pagados (Excel)",
+                data=output,
+                file_name=f"no_pagados_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+        else:
+            st.info("No hay registros no pagados con los filtros seleccionados.")
+    
+    with tab_huerfanos:
+        st.subheader(f"Pagos sin servicio en Archivo 1 ({len(df_huerfanos_filtrado)})")
+        if not df_huerfanos_filtrado.empty:
+            importe_huerfano = df2_norm.loc[df_huerfanos_filtrado.index, 'Importe_HHMM_Archivo2'].sum()
+            st.caption(f"Importe HHMM pagado sin servicio correspondiente: €{importe_huerfano:,.2f}. "
+                       "Pueden ser servicios de otros meses o servicios que faltan en el Archivo 1.")
+            st.dataframe(df_huerfanos_filtrado, use_container_width=True, hide_index=True)
+            
+            # Botón de descarga
+            output = io.BytesIO()
+            with pd.ExcelWriter(output, engine='openpyxl') as writer:
+                df_huerfanos_filtrado.to_excel(writer, index=False, sheet_name='Pagos_sin_servicio')
+            output.seek(0)
+            
+            st.download_button(
+                label="📥 Descargar Pagos sin servicio (Excel)",
+                data=output,
+                file_name=f"pagos_sin_servicio_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+        else:
+            st.success("Todos los pagos del Archivo 2 corresponden a un servicio del Archivo 1.")
+    
+    with tab3:
+        st.subheader("Resumen por Profesional")
+        
+        # Resumen de los tres grupos con una única agregación sobre el resultado del match
+        _, df_resumen = resumen_conciliacion(resultado_filtrado)
+        
+        st.dataframe(
+            df_resumen,
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "Profesional": "Profesional",
+                "Total Registros": st.column_config.NumberColumn("Total", format="%d"),
+                "Pagados": st.column_config.NumberColumn("✅ Pagados", format="%d"),
+                "No Pagados": st.column_config.NumberColumn("❌ No Pagados", format="%d"),
+                "% Pago": st.column_config.NumberColumn("% Pago", format="%.1f%%"),
+                "Cobrado (€)": st.column_config.NumberColumn("Cobrado (€)", format="€%.2f"),
+                "Por Cobrar (€)": st.column_config.NumberColumn("Por Cobrar (€)", format="€%.2f"),
+                "Pagos huérfanos": st.column_config.NumberColumn("💸 Pagos huérfanos", format="%d"),
+                "Importe huérfano (€)": st.column_config.NumberColumn("Importe huérfano (€)", format="€%.2f")
+            }
+        )
         
+        # Botón de descarga del resumen
+        output = io.BytesIO()
+        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+            df_resumen.to_excel(writer, index=False, sheet_name='Resumen_Profesional')
         output.seek(0)
         
         st.download_button(
-            label="⬇️ Confirmar Descarga Proyección",
+            label="📥 Descargar Resumen (Excel)",
             data=output,
-            file_name=f"proyeccion_gerencia_{datetime.now().strftime('%Y%m%d')}.xlsx",
+            file_name=f"resumen_match_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
+    
+    
+    st.success("✅ Archivos guardados. Los médicos ya pueden ver su match personal.")
+    st.info(f"📒 Libro de pendientes: {match['cerrados']:,} pendientes de meses anteriores cobrados en este archivo, "
+            f"{match['nuevos']:,} nuevos pendientes registrados.")
+
 
-# -------------------------------------------------------------------
-# FUNCIÓN DE MATCH DE ARCHIVOS (PARA ADMIN) - CORREGIDA
-# -------------------------------------------------------------------
 def match_archivos():
     """Compara dos archivos Excel (Mes finalizado real vs Mes Pagado) y encuentra coincidencias"""
     
@@ -1558,30 +4729,6 @@ def match_archivos():
     </div>
     """, unsafe_allow_html=True)
     
-    # Función auxiliar para normalizar nombres de médicos
-    def normalizar_nombre_medico(nombre):
-        """
-        Normaliza el nombre del médico para poder comparar:
-        - Elimina comas
-        - Convierte a mayúsculas
-        - Elimina espacios extras
-        - Ordena apellido y nombre de forma consistente
-        """
-        if pd.isna(nombre):
-            return ""
-        
-        nombre_str = str(nombre).strip().upper()
-        
-        # Eliminar comas y espacios múltiples
-        nombre_sin_comas = nombre_str.replace(',', ' ')
-        nombre_sin_comas = ' '.join(nombre_sin_comas.split())
-        
-        # Dividir en partes y ordenar alfabéticamente
-        partes = nombre_sin_comas.split()
-        partes_ordenadas = sorted(partes)
-        
-        return ' '.join(partes_ordenadas)
-    
     # Explicación del proceso
     with st.expander("ℹ️ ¿Cómo funciona este match?", expanded=False):
         st.markdown("""
@@ -1606,9 +4753,17 @@ def match_archivos():
         
         Si **las 4 columnas coinciden** después de la normalización, la fila se considera como **"Pagado correctamente"**.
         
+        **Servicios repetidos:** si el mismo paciente tiene la misma prestación dos veces el mismo día,
+        cada pago del Archivo 2 cubre un único servicio (1ª aparición con 1ª, 2ª con 2ª...).
+        
         **Nuevas columnas añadidas:**
         - En pestaña "Pagados": Columna "Cobrado OSA (€)" (Importe HHMM del Archivo 2)
-        - En pestaña "No Pagados": Columna "Por Cobrar OSA (€)" (SIEMPRE 0, ya que no aparecen en el archivo de pagos)
+        - En pestaña "No Pagados": Columna "Por Cobrar OSA (€)" (importe esperado: mediana histórica del Importe HHMM para esa prestación y aseguradora)
+        
+        **Match tolerante (opcional):** sobre lo que no casó de forma exacta se hace una segunda
+        pasada con el mismo paciente y médico, admitiendo ±N días de diferencia en la fecha y
+        prestaciones redactadas de otra forma. Cada coincidencia indica su confianza
+        (Exacta / Alta / Media / Baja) en la columna "Confianza Match".
         """)
     
     # Crear dos columnas para los archivos
@@ -1636,563 +4791,102 @@ def match_archivos():
         if archivo2 is not None:
             st.success(f"✅ Archivo cargado: {archivo2.name}")
     
+    # Opciones del match tolerante
+    col_t1, col_t2, col_t3 = st.columns(3)
+    with col_t1:
+        usar_tolerante = st.checkbox("🧩 Activar match tolerante", value=True, key="match_tolerante")
+    with col_t2:
+        dias_tolerancia = st.slider("± Días de diferencia", 0, 7, 1, key="match_dias_tolerancia", disabled=not usar_tolerante)
+    with col_t3:
+        umbral_similitud = st.slider(
+            "Similitud mínima de prestación", 0.3, 1.0, 0.6, 0.05,
+            key="match_umbral_similitud",
+            disabled=not usar_tolerante
+        )
+    
     st.markdown("---")
     
     # Botón para ejecutar el match
     if archivo1 is not None and archivo2 is not None:
+        clave = clave_match(archivo1, archivo2, dias_tolerancia if usar_tolerante else None, umbral_similitud)
+        # Resultado guardado en la sesión: solo vale para estos mismos archivos y opciones
+        resultado_match = st.session_state.get(CLAVE_RESULTADO_MATCH)
+        if resultado_match is not None and resultado_match['clave'] != clave:
+            resultado_match = None
+        
         if st.button("🔍 EJECUTAR MATCH", use_container_width=True, type="primary"):
-            
-            with st.spinner("Procesando archivos y buscando coincidencias..."):
-                
-                # Cargar archivos
-                df1 = pd.read_excel(archivo1)
-                df2 = pd.read_excel(archivo2)
-                
-                # Mostrar información básica
-                st.info(f"📊 Archivo 1: {len(df1)} registros | Archivo 2: {len(df2)} registros")
-                
-                # Verificar que existan las columnas necesarias
-                columnas_df1 = ['Fecha', 'Paciente', 'Denomin.prestación', 'Médico de tratamiento (nombre)']
-                columnas_df2 = ['Fecha del Servicio', 'NHC Paciente', 'Descripción de Prestación', 'Profesional']
-                
-                columnas_faltantes_df1 = [col for col in columnas_df1 if col not in df1.columns]
-                columnas_faltantes_df2 = [col for col in columnas_df2 if col not in df2.columns]
-                
-                if columnas_faltantes_df1 or columnas_faltantes_df2:
-                    if columnas_faltantes_df1:
-                        st.error(f"❌ Archivo 1: Faltan columnas: {', '.join(columnas_faltantes_df1)}")
-                    if columnas_faltantes_df2:
-                        st.error(f"❌ Archivo 2: Faltan columnas: {', '.join(columnas_faltantes_df2)}")
-                    
-                    with st.expander("🔍 Ver columnas disponibles en Archivo 1"):
-                        st.write(df1.columns.tolist())
-                    with st.expander("🔍 Ver columnas disponibles en Archivo 2"):
-                        st.write(df2.columns.tolist())
-                    
-                    st.stop()
-                
-                # -----------------------------------------------------------------
-                # PASO 1: NORMALIZAR COLUMNAS PARA LA COMPARACIÓN
-                # -----------------------------------------------------------------
-                
-                # Copias para no modificar originales
-                df1_norm = df1.copy()
-                df2_norm = df2.copy()
-                
-                # Normalizar fechas
-                df1_norm['Fecha_norm'] = pd.to_datetime(df1_norm['Fecha'], errors='coerce').dt.date
-                df2_norm['Fecha_norm'] = pd.to_datetime(df2_norm['Fecha del Servicio'], errors='coerce').dt.date
-                
-                # Normalizar paciente (quitar espacios, mayúsculas)
-                df1_norm['Paciente_norm'] = df1_norm['Paciente'].astype(str).str.strip().str.upper()
-                df2_norm['Paciente_norm'] = df2_norm['NHC Paciente'].astype(str).str.strip().str.upper()
-                
-                # Normalizar prestación
-                df1_norm['Prestacion_norm'] = df1_norm['Denomin.prestación'].astype(str).str.strip().str.upper()
-                df2_norm['Prestacion_norm'] = df2_norm['Descripción de Prestación'].astype(str).str.strip().str.upper()
-                
-                # -----------------------------------------------------------------
-                # PASO 2: NORMALIZAR NOMBRES DE MÉDICOS (ELIMINAR COMAS)
-                # -----------------------------------------------------------------
-                # Aplicar la función de normalización a los nombres de médicos
-                df1_norm['Medico_norm'] = df1_norm['Médico de tratamiento (nombre)'].apply(normalizar_nombre_medico)
-                df2_norm['Medico_norm'] = df2_norm['Profesional'].apply(normalizar_nombre_medico)
-                
-                # Mostrar ejemplos de normalización para verificar
-                with st.expander("🔍 Ver ejemplos de normalización de nombres", expanded=False):
-                    col_ex1, col_ex2 = st.columns(2)
-                    
-                    with col_ex1:
-                        st.markdown("**Archivo 1 - Nombres originales vs normalizados:**")
-                        ejemplos_df1 = df1_norm[['Médico de tratamiento (nombre)', 'Medico_norm']].dropna().head(10)
-                        st.dataframe(ejemplos_df1, use_container_width=True)
-                    
-                    with col_ex2:
-                        st.markdown("**Archivo 2 - Nombres originales vs normalizados:**")
-                        ejemplos_df2 = df2_norm[['Profesional', 'Medico_norm']].dropna().head(10)
-                        st.dataframe(ejemplos_df2, use_container_width=True)
-                
-                # -----------------------------------------------------------------
-                # PASO 3: CREAR COLUMNA LLAVE PARA MATCH
-                # -----------------------------------------------------------------
-                df1_norm['llave_match'] = (
-                    df1_norm['Fecha_norm'].astype(str) + '|' +
-                    df1_norm['Paciente_norm'] + '|' +
-                    df1_norm['Prestacion_norm'] + '|' +
-                    df1_norm['Medico_norm']
-                )
-                
-                df2_norm['llave_match'] = (
-                    df2_norm['Fecha_norm'].astype(str) + '|' +
-                    df2_norm['Paciente_norm'] + '|' +
-                    df2_norm['Prestacion_norm'] + '|' +
-                    df2_norm['Medico_norm']
-                )
-                
-                # -----------------------------------------------------------------
-                # PASO 4: ENCONTRAR COINCIDENCIAS
-                # -----------------------------------------------------------------
-                
-                # Crear conjunto de llaves del archivo 2 (lo pagado)
-                llaves_pagadas = set(df2_norm['llave_match'].dropna().unique())
-                
-                # Marcar en df1 qué registros tienen match
-                df1_norm['Match'] = df1_norm['llave_match'].isin(llaves_pagadas)
-                
-                # Crear DataFrame de resultados (solo los que hicieron match)
-                df_match = df1[df1_norm['Match']].copy()
-                
-                # Crear DataFrame de no pagados (los que NO hicieron match)
-                df_no_pagados = df1[~df1_norm['Match']].copy()
-                
-                # -----------------------------------------------------------------
-                # PASO 5: AÑADIR COLUMNAS DE IMPORTES - CORREGIDO
-                # -----------------------------------------------------------------
-                
-                # Para los pagados, añadir columna "Cobrado OSA (€)" con el Importe HHMM del archivo 2
-                if not df_match.empty:
-                    # Crear un diccionario para mapear llave_match a Importe HHMM del archivo 2
-                    # Asegurarse de que la columna Importe HHMM existe en df2
-                    if 'Importe HHMM' in df2.columns:
-                        df2_norm['Importe_HHMM_Archivo2'] = pd.to_numeric(df2['Importe HHMM'], errors='coerce')
-                    else:
-                        df2_norm['Importe_HHMM_Archivo2'] = 0
-                    
-                    mapa_importes = dict(zip(df2_norm['llave_match'], df2_norm['Importe_HHMM_Archivo2']))
-                    
-                    # Añadir la columna a df_match
-                    df_match_con_importes = df_match.copy()
-                    df_match_con_importes['Cobrado OSA (€)'] = df_match_con_importes.index.map(
-                        lambda idx: mapa_importes.get(df1_norm.loc[idx, 'llave_match'], 0) if idx in df1_norm.index else 0
-                    )
-                else:
-                    df_match_con_importes = df_match.copy()
-                    df_match_con_importes['Cobrado OSA (€)'] = 0
-                
-                # Para los no pagados, añadir columna "Por Cobrar OSA (€)" con valor 0
-                # CORREGIDO: Siempre 0 porque no aparecen en el archivo de pagos
-                if not df_no_pagados.empty:
-                    df_no_pagados_con_importes = df_no_pagados.copy()
-                    df_no_pagados_con_importes['Por Cobrar OSA (€)'] = 0  # Siempre 0
-                else:
-                    df_no_pagados_con_importes = df_no_pagados.copy()
-                    df_no_pagados_con_importes['Por Cobrar OSA (€)'] = 0
-                
-                # -----------------------------------------------------------------
-                # PASO 6: MOSTRAR RESULTADOS
-                # -----------------------------------------------------------------
-                
-                st.markdown("---")
-                st.subheader("📊 Resultados del Match")
-                
-                # Métricas principales
-                col_m1, col_m2, col_m3, col_m4 = st.columns(4)
-                
-                with col_m1:
-                    st.markdown(f"""
-                    <div class='stMetric'>
-                        <label>📋 Total Archivo 1</label>
-                        <div class='metric-highlight'>{len(df1):,}</div>
-                        <small>Registros a verificar</small>
-                    </div>
-                    """, unsafe_allow_html=True)
-                
-                with col_m2:
-                    st.markdown(f"""
-                    <div class='stMetric'>
-                        <label>✅ Coincidencias</label>
-                        <div class='metric-highlight' style='color: #28a745;'>{len(df_match_con_importes):,}</div>
-                        <small>Pagados correctamente</small>
-                    </div>
-                    """, unsafe_allow_html=True)
-                
-                with col_m3:
-                    st.markdown(f"""
-                    <div class='stMetric'>
-                        <label>❌ No pagados</label>
-                        <div class='metric-highlight' style='color: #dc3545;'>{len(df_no_pagados_con_importes):,}</div>
-                        <small>No encontrados en Archivo 2</small>
-                    </div>
-                    """, unsafe_allow_html=True)
-                
-                with col_m4:
-                    porcentaje_coincidencia = (len(df_match_con_importes) / len(df1) * 100) if len(df1) > 0 else 0
-                    st.markdown(f"""
-                    <div class='stMetric'>
-                        <label>📊 % Coincidencia</label>
-                        <div class='metric-highlight'>{porcentaje_coincidencia:.1f}%</div>
-                        <small>Tasa de pago</small>
-                    </div>
-                    """, unsafe_allow_html=True)
-                
-                st.markdown("---")
-                
-                # -----------------------------------------------------------------
-                # PASO 7: FILTROS POR PROFESIONAL Y DESCRIPCIÓN DE PRESTACIÓN
-                # -----------------------------------------------------------------
-                st.subheader("🔍 Análisis Detallado con Filtros")
-                
-                col_f1, col_f2 = st.columns(2)
-                
-                with col_f1:
-                    # Obtener lista de profesionales únicos del archivo 1 (usando el original, no el normalizado)
-                    profesionales = ['TODOS'] + sorted(df1['Médico de tratamiento (nombre)'].dropna().unique().tolist())
-                    profesional_filtro = st.selectbox(
-                        "👨‍⚕️ Filtrar por Profesional",
-                        profesionales,
-                        key="match_filtro_profesional"
-                    )
-                
-                with col_f2:
-                    # Obtener lista de prestaciones únicas del archivo 1
-                    prestaciones = ['TODAS'] + sorted(df1['Denomin.prestación'].dropna().unique().tolist())
-                    prestacion_filtro = st.selectbox(
-                        "🩺 Filtrar por Descripción de Prestación",
-                        prestaciones,
-                        key="match_filtro_prestacion"
-                    )
-                
-                # Aplicar filtros
-                df1_filtrado = df1.copy()
-                df_match_filtrado = df_match_con_importes.copy()
-                df_no_pagados_filtrado = df_no_pagados_con_importes.copy()
-                
-                if profesional_filtro != 'TODOS':
-                    df1_filtrado = df1_filtrado[df1_filtrado['Médico de tratamiento (nombre)'] == profesional_filtro]
-                    df_match_filtrado = df_match_filtrado[df_match_filtrado['Médico de tratamiento (nombre)'] == profesional_filtro]
-                    df_no_pagados_filtrado = df_no_pagados_filtrado[df_no_pagados_filtrado['Médico de tratamiento (nombre)'] == profesional_filtro]
-                
-                if prestacion_filtro != 'TODAS':
-                    df1_filtrado = df1_filtrado[df1_filtrado['Denomin.prestación'] == prestacion_filtro]
-                    df_match_filtrado = df_match_filtrado[df_match_filtrado['Denomin.prestación'] == prestacion_filtro]
-                    df_no_pagados_filtrado = df_no_pagados_filtrado[df_no_pagados_filtrado['Denomin.prestación'] == prestacion_filtro]
-                
-                # Métricas con filtros aplicados
-                col_fm1, col_fm2, col_fm3 = st.columns(3)
-                
-                with col_fm1:
-                    st.metric(
-                        "📋 Registros en filtro",
-                        f"{len(df1_filtrado):,}"
-                    )
-                
-                with col_fm2:
-                    st.metric(
-                        "✅ Pagados en filtro",
-                        f"{len(df_match_filtrado):,}",
-                        delta=f"{(len(df_match_filtrado)/len(df1_filtrado)*100):.1f}%" if len(df1_filtrado) > 0 else "0%"
-                    )
-                
-                with col_fm3:
-                    st.metric(
-                        "❌ No pagados en filtro",
-                        f"{len(df_no_pagados_filtrado):,}",
-                        delta=f"{(len(df_no_pagados_filtrado)/len(df1_filtrado)*100):.1f}%" if len(df1_filtrado) > 0 else "0%",
-                        delta_color="inverse"
-                    )
-                
-                # -----------------------------------------------------------------
-                # PASO 8: MOSTRAR TABLAS
-                # -----------------------------------------------------------------
-                
-                tab1, tab2, tab3 = st.tabs(["✅ Pagados", "❌ No Pagados", "📊 Resumen por Profesional"])
-                
-                with tab1:
-                    st.subheader(f"Registros Pagados Correctamente ({len(df_match_filtrado)})")
-                    if not df_match_filtrado.empty:
-                        # Seleccionar columnas a mostrar incluyendo Cobrado OSA
-                        columnas_mostrar = df_match_filtrado.columns.tolist()
-                        if 'Cobrado OSA (€)' in df_match_filtrado.columns:
-                            st.dataframe(
-                                df_match_filtrado,
-                                use_container_width=True,
-                                hide_index=True,
-                                column_config={
-                                    "Cobrado OSA (€)": st.column_config.NumberColumn(
-                                        "Cobrado OSA (€)",
-                                        format="€%.2f",
-                                        help="Importe HHMM del Archivo 2 (pagado)"
-                                    )
-                                }
-                            )
-                        else:
-                            st.dataframe(
-                                df_match_filtrado,
-                                use_container_width=True,
-                                hide_index=True
-                            )
-                        
-                        # Botón de descarga
-                        output = io.BytesIO()
-                        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                            df_match_filtrado.to_excel(writer, index=False, sheet_name='Pagados')
-                        output.seek(0)
-                        
-                        st.download_button(
-                            label="📥 Descargar Pagados (Excel)",
-                            data=output,
-                            file_name=f"pagados_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                        )
-                    else:
-                        st.info("No hay registros pagados con los filtros seleccionados.")
-                
-                with tab2:
-                    st.subheader(f"Registros No Pagados ({len(df_no_pagados_filtrado)})")
-                    if not df_no_pagados_filtrado.empty:
-                        # Seleccionar columnas a mostrar incluyendo Por Cobrar OSA (siempre 0)
-                        if 'Por Cobrar OSA (€)' in df_no_pagados_filtrado.columns:
-                            st.dataframe(
-                                df_no_pagados_filtrado,
-                                use_container_width=True,
-                                hide_index=True,
-                                column_config={
-                                    "Por Cobrar OSA (€)": st.column_config.NumberColumn(
-                                        "Por Cobrar OSA (€)",
-                                        format="€%.2f",
-                                        help="SIEMPRE 0 - No aparecen en el archivo de pagos"
-                                    )
-                                }
-                            )
-                        else:
-                            st.dataframe(
-                                df_no_pagados_filtrado,
-                                use_container_width=True,
-                                hide_index=True
-                            )
-                        
-                        # Botón de descarga
-                        output = io.BytesIO()
-                        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                            df_no_pagados_filtrado.to_excel(writer, index=False, sheet_name='No_Pagados')
-                        output.seek(0)
-                        
-                        st.download_button(
-                            label="📥 Descargar No Pagados (Excel)",
-                            data=output,
-                            file_name=f"no_pagados_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                        )
-                    else:
-                        st.info("No hay registros no pagados con los filtros seleccionados.")
-                
-                with tab3:
-                    st.subheader("Resumen por Profesional")
-                    
-                    # Crear resumen por profesional con las nuevas columnas - CORREGIDO
-                    resumen_profesional = []
-                    
-                    for profesional in df1['Médico de tratamiento (nombre)'].dropna().unique():
-                        # Filtrar registros del profesional
-                        df_prof = df1[df1['Médico de tratamiento (nombre)'] == profesional]
-                        df_prof_match = df_match[df_match['Médico de tratamiento (nombre)'] == profesional]
-                        
-                        total_registros = len(df_prof)
-                        pagados = len(df_prof_match)
-                        no_pagados = total_registros - pagados
-                        porcentaje_pago = (pagados / total_registros * 100) if total_registros > 0 else 0
-                        
-                        # Calcular importes
-                        # Para pagados, buscar el importe en el archivo 2
-                        cobrado_total = 0
-                        for idx in df_prof_match.index:
-                            if idx in df1_norm.index:
-                                llave = df1_norm.loc[idx, 'llave_match']
-                                if llave and llave in llaves_pagadas:
-                                    # Buscar en df2_norm
-                                    registro_pagado = df2_norm[df2_norm['llave_match'] == llave]
-                                    if not registro_pagado.empty and 'Importe HHMM' in df2.columns:
-                                        importe = pd.to_numeric(registro_pagado.iloc[0].get('Importe HHMM', 0), errors='coerce')
-                                        cobrado_total += importe if pd.notna(importe) else 0
-                        
-                        # Para no pagados, el importe es 0 (CORREGIDO)
-                        por_cobrar_total = 0  # Siempre 0
-                        
-                        resumen_profesional.append({
-                            'Profesional': profesional,
-                            'Total Registros': total_registros,
-                            'Pagados': pagados,
-                            'No Pagados': no_pagados,
-                            '% Pago': f"{porcentaje_pago:.1f}%",
-                            'Cobrado (€)': cobrado_total,
-                            'Por Cobrar (€)': por_cobrar_total  # Siempre 0
-                        })
-                    
-                    df_resumen = pd.DataFrame(resumen_profesional)
-                    df_resumen = df_resumen.sort_values('Total Registros', ascending=False)
-                    
-                    st.dataframe(
-                        df_resumen,
-                        use_container_width=True,
-                        hide_index=True,
-                        column_config={
-                            "Profesional": "Profesional",
-                            "Total Registros": st.column_config.NumberColumn("Total", format="%d"),
-                            "Pagados": st.column_config.NumberColumn("✅ Pagados", format="%d"),
-                            "No Pagados": st.column_config.NumberColumn("❌ No Pagados", format="%d"),
-                            "% Pago": "% Pago",
-                            "Cobrado (€)": st.column_config.NumberColumn("Cobrado (€)", format="€%.2f"),
-                            "Por Cobrar (€)": st.column_config.NumberColumn("Por Cobrar (€)", format="€%.2f")
-                        }
+            if resultado_match is None:
+                with st.spinner("Procesando archivos y buscando coincidencias..."):
+                    resultado_match = ejecutar_match(
+                        archivo1, archivo2, clave,
+                        dias_tolerancia=dias_tolerancia if usar_tolerante else None,
+                        umbral_similitud=umbral_similitud
                     )
-                    
-                    # Botón de descarga del resumen
-                    output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                        df_resumen.to_excel(writer, index=False, sheet_name='Resumen_Profesional')
-                    output.seek(0)
-                    
-                    st.download_button(
-                        label="📥 Descargar Resumen (Excel)",
-                        data=output,
-                        file_name=f"resumen_match_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
-                
-                # -----------------------------------------------------------------
-                # PASO 9: GUARDAR ARCHIVOS PARA LOS MÉDICOS
-                # -----------------------------------------------------------------
-                # Guardar los archivos originales para que los médicos puedan consultarlos
-                DataManager.save_dataframe(df1, 'archivo1_match.parquet')
-                DataManager.save_dataframe(df2, 'archivo2_match.parquet')
-                
-                # Guardar también los DataFrames con las nuevas columnas para los médicos
-                DataManager.save_dataframe(df_match_con_importes, 'match_pagados.parquet')
-                DataManager.save_dataframe(df_no_pagados_con_importes, 'match_nopagados.parquet')
-                
-                st.success("✅ Archivos guardados. Los médicos ya pueden ver su match personal.")
+                guardar_en_sesion(CLAVE_RESULTADO_MATCH, resultado_match)
+            else:
+                st.info("ℹ️ Estos archivos ya están conciliados con las mismas opciones; se muestra el resultado guardado.")
+        
+        if resultado_match is not None:
+            mostrar_resultado_match(resultado_match)
     
     else:
         st.info("👆 Por favor, sube ambos archivos para realizar el match.")
+    
+    # Libro de pendientes multi-mes (independiente de los archivos subidos)
+    st.markdown("---")
+    st.subheader("📒 Libro de Pendientes (multi-mes)")
+    libro_pendientes()
 
 # -------------------------------------------------------------------
 # MATCH PERSONAL PARA MÉDICOS (SOLO SUS DATOS) - CORREGIDO
 # -------------------------------------------------------------------
-def match_personal_medico(df_archivo1, df_archivo2, nombre_medico):
+def match_personal_medico(df_pagados, df_no_pagados, nombre_medico):
     """
-    Realiza el match específico para un médico individual
-    usando los archivos que subió el administrador
+    Muestra el match de un médico individual a partir del resultado que
+    guardó el administrador (mismas opciones de tolerancia y mismas tarifas)
     """
     
-    # Función auxiliar para normalizar nombres de médicos
-    def normalizar_nombre_medico(nombre):
-        if pd.isna(nombre):
-            return ""
-        nombre_str = str(nombre).strip().upper()
-        nombre_sin_comas = nombre_str.replace(',', ' ')
-        nombre_sin_comas = ' '.join(nombre_sin_comas.split())
-        partes = nombre_sin_comas.split()
-        partes_ordenadas = sorted(partes)
-        return ' '.join(partes_ordenadas)
-    
-    # Verificar que los DataFrames no estén vacíos
-    if df_archivo1 is None or df_archivo2 is None or df_archivo1.empty or df_archivo2.empty:
+    # Verificar que el administrador haya hecho el match
+    if df_pagados is None or df_no_pagados is None:
         st.warning("El administrador aún no ha subido los archivos para realizar el match.")
         return
     
     # Verificar columnas necesarias
-    columnas_df1 = ['Fecha', 'Paciente', 'Denomin.prestación', 'Médico de tratamiento (nombre)']
-    columnas_df2 = ['Fecha del Servicio', 'NHC Paciente', 'Descripción de Prestación', 'Profesional']
-    
-    columnas_faltantes_df1 = [col for col in columnas_df1 if col not in df_archivo1.columns]
-    columnas_faltantes_df2 = [col for col in columnas_df2 if col not in df_archivo2.columns]
+    columnas_faltantes = [
+        col for col in ['Fecha', 'Médico de tratamiento (nombre)']
+        if col not in df_pagados.columns or col not in df_no_pagados.columns
+    ]
     
-    if columnas_faltantes_df1 or columnas_faltantes_df2:
-        st.error("❌ Los archivos no tienen las columnas necesarias.")
-        if columnas_faltantes_df1:
-            st.error(f"Archivo 1 faltan: {', '.join(columnas_faltantes_df1)}")
-        if columnas_faltantes_df2:
-            st.error(f"Archivo 2 faltan: {', '.join(columnas_faltantes_df2)}")
+    if columnas_faltantes:
+        st.error("❌ El resultado del match no tiene las columnas necesarias.")
+        st.error(f"Faltan: {', '.join(columnas_faltantes)}")
         return
     
     with st.spinner("Procesando tus datos..."):
         
-        # Normalizar datos
-        df1_norm = df_archivo1.copy()
-        df2_norm = df_archivo2.copy()
-        
-        # Normalizar fechas
-        df1_norm['Fecha_norm'] = pd.to_datetime(df1_norm['Fecha'], errors='coerce').dt.date
-        df2_norm['Fecha_norm'] = pd.to_datetime(df2_norm['Fecha del Servicio'], errors='coerce').dt.date
-        
-        # Normalizar paciente
-        df1_norm['Paciente_norm'] = df1_norm['Paciente'].astype(str).str.strip().str.upper()
-        df2_norm['Paciente_norm'] = df2_norm['NHC Paciente'].astype(str).str.strip().str.upper()
-        
-        # Normalizar prestación
-        df1_norm['Prestacion_norm'] = df1_norm['Denomin.prestación'].astype(str).str.strip().str.upper()
-        df2_norm['Prestacion_norm'] = df2_norm['Descripción de Prestación'].astype(str).str.strip().str.upper()
-        
-        # Normalizar nombres de médicos
-        df1_norm['Medico_norm'] = df1_norm['Médico de tratamiento (nombre)'].apply(normalizar_nombre_medico)
-        df2_norm['Medico_norm'] = df2_norm['Profesional'].apply(normalizar_nombre_medico)
-        
-        # Normalizar el nombre del médico actual para filtrar
+        # Filtrar solo los registros del médico actual (misma normalización que el match)
         nombre_medico_norm = normalizar_nombre_medico(nombre_medico)
         
-        # Filtrar solo los registros del médico actual en ambos archivos
-        df1_medico = df1_norm[df1_norm['Medico_norm'] == nombre_medico_norm].copy()
-        df2_medico = df2_norm[df2_norm['Medico_norm'] == nombre_medico_norm].copy()
-        
-        # Crear llaves de match
-        df1_medico['llave_match'] = (
-            df1_medico['Fecha_norm'].astype(str) + '|' +
-            df1_medico['Paciente_norm'] + '|' +
-            df1_medico['Prestacion_norm'] + '|' +
-            df1_medico['Medico_norm']
-        )
-        
-        df2_medico['llave_match'] = (
-            df2_medico['Fecha_norm'].astype(str) + '|' +
-            df2_medico['Paciente_norm'] + '|' +
-            df2_medico['Prestacion_norm'] + '|' +
-            df2_medico['Medico_norm']
-        )
-        
-        # Crear conjunto de llaves pagadas
-        llaves_pagadas = set(df2_medico['llave_match'].dropna().unique())
-        
-        # Marcar qué registros del médico tienen match
-        df1_medico['Match'] = df1_medico['llave_match'].isin(llaves_pagadas)
+        def del_medico(tabla):
+            medicos = resolver_nombres_profesionales(tabla['Médico de tratamiento (nombre)'])[0]
+            return tabla[normalizar_nombres_serie(medicos) == nombre_medico_norm]
         
-        # Obtener los registros originales (sin normalizar) para mostrar
-        indices_match = df1_medico[df1_medico['Match']].index
-        indices_no_match = df1_medico[~df1_medico['Match']].index
+        # Los pagados ya traen "Cobrado OSA (€)" y "Confianza Match"
+        df_match_con_importes = del_medico(df_pagados)
         
-        df_match = df_archivo1.loc[indices_match] if not indices_match.empty else pd.DataFrame()
-        df_no_pagados = df_archivo1.loc[indices_no_match] if not indices_no_match.empty else pd.DataFrame()
-        
-        # -----------------------------------------------------------------
-        # AÑADIR COLUMNAS DE IMPORTES PARA EL MÉDICO - CORREGIDO
-        # -----------------------------------------------------------------
+        # Los no pagados traen "Por Cobrar OSA (€)"; se añade su tramo de antigüedad
+        pendientes = del_medico(df_no_pagados)
+        dias_pendiente = (
+            pd.Timestamp.now().normalize()
+            - pd.to_datetime(pendientes['Fecha'], errors='coerce').dt.normalize()
+        ).dt.days
+        df_no_pagados_con_importes = pendientes.assign(**{
+            'Antigüedad': pd.cut(dias_pendiente, LIMITES_TRAMOS, labels=TRAMOS_ANTIGUEDAD)
+        })
+        columnas = [c for c in df_no_pagados_con_importes.columns if c != 'Por Cobrar OSA (€)']
+        df_no_pagados_con_importes = df_no_pagados_con_importes[columnas + ['Por Cobrar OSA (€)']]
         
-        # Para los pagados, añadir columna "Cobrado OSA (€)" con el Importe HHMM del archivo 2
-        if not df_match.empty:
-            # Crear un diccionario para mapear llave_match a Importe HHMM del archivo 2
-            if 'Importe HHMM' in df_archivo2.columns:
-                df2_medico['Importe_HHMM_Archivo2'] = pd.to_numeric(df2_medico['Importe HHMM'], errors='coerce')
-            else:
-                df2_medico['Importe_HHMM_Archivo2'] = 0
-            
-            mapa_importes = dict(zip(df2_medico['llave_match'], df2_medico['Importe_HHMM_Archivo2']))
-            
-            # Añadir la columna a df_match
-            df_match_con_importes = df_match.copy()
-            df_match_con_importes['Cobrado OSA (€)'] = df_match_con_importes.index.map(
-                lambda idx: mapa_importes.get(df1_medico.loc[idx, 'llave_match'], 0) if idx in df1_medico.index else 0
-            )
-        else:
-            df_match_con_importes = df_match.copy()
-            df_match_con_importes['Cobrado OSA (€)'] = 0
-        
-        # Para los no pagados, añadir columna "Por Cobrar OSA (€)" con valor 0
-        # CORREGIDO: Siempre 0 porque no aparecen en el archivo de pagos
-        if not df_no_pagados.empty:
-            df_no_pagados_con_importes = df_no_pagados.copy()
-            df_no_pagados_con_importes['Por Cobrar OSA (€)'] = 0  # Siempre 0
-        else:
-            df_no_pagados_con_importes = df_no_pagados.copy()
-            df_no_pagados_con_importes['Por Cobrar OSA (€)'] = 0
+        total_servicios = len(df_match_con_importes) + len(df_no_pagados_con_importes)
         
         # MOSTRAR RESULTADOS
         st.markdown("---")
@@ -2204,7 +4898,7 @@ def match_personal_medico(df_archivo1, df_archivo2, nombre_medico):
             st.markdown(f"""
             <div class='stMetric'>
                 <label>📋 Tus registros totales</label>
-                <div class='metric-highlight'>{len(df1_medico):,}</div>
+                <div class='metric-highlight'>{total_servicios:,}</div>
                 <small>En el período analizado</small>
             </div>
             """, unsafe_allow_html=True)
@@ -2234,7 +4928,7 @@ def match_personal_medico(df_archivo1, df_archivo2, nombre_medico):
             st.subheader(f"Servicios Pagados ({len(df_match_con_importes)})")
             if not df_match_con_importes.empty:
                 # Seleccionar columnas relevantes para mostrar
-                columnas_mostrar = ['Fecha', 'Paciente', 'Denomin.prestación']
+                columnas_mostrar = ['Fecha', 'Paciente', 'Denomin.prestación', 'Confianza Match']
                 columnas_existentes = [col for col in columnas_mostrar if col in df_match_con_importes.columns]
                 
                 # Mostrar con columna de Cobrado OSA
@@ -2276,10 +4970,10 @@ def match_personal_medico(df_archivo1, df_archivo2, nombre_medico):
         with tab2:
             st.subheader(f"Servicios Pendientes ({len(df_no_pagados_con_importes)})")
             if not df_no_pagados_con_importes.empty:
-                columnas_mostrar = ['Fecha', 'Paciente', 'Denomin.prestación']
+                columnas_mostrar = ['Fecha', 'Paciente', 'Denomin.prestación', 'Aseguradora', 'Antigüedad']
                 columnas_existentes = [col for col in columnas_mostrar if col in df_no_pagados_con_importes.columns]
                 
-                # Mostrar con columna de Por Cobrar OSA (siempre 0)
+                # Mostrar con columna de Por Cobrar OSA (importe esperado)
                 if 'Por Cobrar OSA (€)' in df_no_pagados_con_importes.columns:
                     st.dataframe(
                         df_no_pagados_con_importes[columnas_existentes + ['Por Cobrar OSA (€)']],
@@ -2289,7 +4983,7 @@ def match_personal_medico(df_archivo1, df_archivo2, nombre_medico):
                             "Por Cobrar OSA (€)": st.column_config.NumberColumn(
                                 "Por Cobrar OSA (€)",
                                 format="€%.2f",
-                                help="SIEMPRE 0 - No aparecen en el archivo de pagos"
+                                help="Estimado: mediana histórica del Importe HHMM para la prestación y aseguradora"
                             )
                         }
                     )
@@ -2319,11 +5013,10 @@ def match_personal_medico(df_archivo1, df_archivo2, nombre_medico):
         st.markdown("---")
         st.subheader("📋 Resumen Ejecutivo")
         
-        total_servicios = len(df1_medico)
         if total_servicios > 0:
             # Calcular totales de importes
             total_cobrado = df_match_con_importes['Cobrado OSA (€)'].sum() if not df_match_con_importes.empty and 'Cobrado OSA (€)' in df_match_con_importes.columns else 0
-            total_por_cobrar = 0  # Siempre 0
+            total_por_cobrar = df_no_pagados_con_importes['Por Cobrar OSA (€)'].sum()
             
             col_r1, col_r2 = st.columns(2)
             
@@ -2342,16 +5035,23 @@ def match_personal_medico(df_archivo1, df_archivo2, nombre_medico):
                 <div style='background-color: #ffebee; padding: 20px; border-radius: 10px;'>
                     <h4 style='color: #c62828;'>⏳ Pendiente</h4>
                     <p style='font-size: 18px;'><strong>{len(df_no_pagados_con_importes)} servicios</strong> ({len(df_no_pagados_con_importes)/total_servicios*100:.1f}%)</p>
-                    <p style='font-size: 16px;'><strong>Total por cobrar: €0.00</strong> (no aparecen en pagos)</p>
-                    <p>Estos servicios aún no aparecen en pagos. El importe pendiente es 0 porque no están registrados como pagados.</p>
+                    <p style='font-size: 16px;'><strong>Total por cobrar (estimado): €{total_por_cobrar:,.2f}</strong></p>
+                    <p>Estos servicios aún no aparecen en pagos. El importe se estima con la tarifa histórica de cada prestación y aseguradora.</p>
                 </div>
                 """, unsafe_allow_html=True)
 
 # -------------------------------------------------------------------
 # DASHBOARD ADMINISTRADOR
 # -------------------------------------------------------------------
+@st.fragment
 def dashboard_admin(df):
-    """Dashboard completo para administradores"""
+    """
+    Dashboard completo para administradores.
+    Es un fragmento y los filtros globales van en un formulario: elegir
+    fechas, subespecialidad y tipo no ejecuta nada hasta pulsar "Aplicar",
+    y entonces solo se recalcula este dashboard (no la cabecera, la carga
+    de datos ni las demás pestañas).
+    """
     
     st.markdown(f"""
     <div class='custom-card'>
@@ -2360,43 +5060,45 @@ def dashboard_admin(df):
     </div>
     """, unsafe_allow_html=True)
     
-    # Filtros globales
-    col_f1, col_f2, col_f3 = st.columns([2,2,2])
-    
-    with col_f1:
-        if 'Fecha del Servicio' in df.columns:
-            min_date = df['Fecha del Servicio'].min().date()
-            max_date = df['Fecha del Servicio'].max().date()
-            fecha_range = st.date_input(
-                "📅 Rango de Fechas",
-                value=(min_date, max_date),
-                min_value=min_date,
-                max_value=max_date,
-                key="admin_fecha_range"
-            )
-    
-    with col_f2:
-        subespecialidades = ['TODAS'] + sorted(df['Subespecialidad'].unique().tolist())
-        subesp_selected = st.selectbox("🏥 Subespecialidad", subespecialidades, key="admin_subesp")
-    
-    with col_f3:
-        tipos_medico = ['TODOS'] + sorted(df['Tipo Médico'].unique().tolist())
-        tipo_selected = st.selectbox("👨‍⚕️ Tipo de Médico", tipos_medico, key="admin_tipo")
-    
-    # Aplicar filtros
-    df_filtered = df.copy()
+    # Filtros globales: se aplican juntos al enviar el formulario
+    with st.form("admin_filtros_globales", border=False):
+        col_f1, col_f2, col_f3 = st.columns([2,2,2])
+        
+        with col_f1:
+            # Datos ordenados por fecha: los extremos son la primera y la última fecha válida
+            primera_fecha, ultima_fecha = extremos_fechas(df) if 'Fecha del Servicio' in df.columns else (None, None)
+            if primera_fecha is not None:
+                min_date = primera_fecha.date()
+                max_date = ultima_fecha.date()
+                fecha_range = st.date_input(
+                    "📅 Rango de Fechas",
+                    value=(min_date, max_date),
+                    min_value=min_date,
+                    max_value=max_date,
+                    key="admin_fecha_range"
+                )
+        
+        with col_f2:
+            subespecialidades = ['TODAS'] + sorted(df['Subespecialidad'].unique().tolist())
+            subesp_selected = st.selectbox("🏥 Subespecialidad", subespecialidades, key="admin_subesp")
+        
+        with col_f3:
+            tipos_medico = ['TODOS'] + sorted(df['Tipo Médico'].unique().tolist())
+            tipo_selected = st.selectbox("👨‍⚕️ Tipo de Médico", tipos_medico, key="admin_tipo")
+        
+        st.form_submit_button("🔎 Aplicar filtros", use_container_width=True)
     
+    # Aplicar filtros: el rango de fechas es una porción contigua (datos ordenados por
+    # fecha) y el resto se evalúa solo sobre esa porción; sin filtros, sin copia
+    df_rango = df
     if 'fecha_range' in locals() and len(fecha_range) == 2:
-        df_filtered = df_filtered[
-            (df_filtered['Fecha del Servicio'].dt.date >= fecha_range[0]) &
-            (df_filtered['Fecha del Servicio'].dt.date <= fecha_range[1])
-        ]
-    
-    if subesp_selected != 'TODAS':
-        df_filtered = df_filtered[df_filtered['Subespecialidad'] == subesp_selected]
+        df_rango = rango_fechas(df, fecha_range[0], fecha_range[1])
     
-    if tipo_selected != 'TODOS':
-        df_filtered = df_filtered[df_filtered['Tipo Médico'] == tipo_selected]
+    df_filtered = filtrar_vista(
+        df_rango,
+        df_rango['Subespecialidad'] == subesp_selected if subesp_selected != 'TODAS' else None,
+        df_rango['Tipo Médico'] == tipo_selected if tipo_selected != 'TODOS' else None
+    )
     
     # Calcular métricas generales
     metricas = calcular_dashboard_general(df_filtered)
@@ -2543,29 +5245,33 @@ def dashboard_admin(df):
         # Tabla de médicos con KPIs individuales
         st.subheader("📋 Análisis Individual por Médico")
         
-        medicos_data = []
-        for medico in df_filtered['Profesional'].unique():
-            df_med = df_filtered[df_filtered['Profesional'] == medico]
-            subesp = df_med['Subespecialidad'].iloc[0]
-            tipo = df_med['Tipo Médico'].iloc[0]
-            promedio, _, _ = calcular_promedio_subespecialidad(df_filtered, subesp)
-            kpis = calcular_a_cobrar_individual(df_med, promedio)
-            
-            if kpis:
-                medicos_data.append({
-                    'Profesional': medico,
-                    'Subespecialidad': subesp,
-                    'Tipo': tipo,
-                    'Registros': kpis['total_registros'],
-                    'Facturado HHMM': kpis['importe_hhmm_total'],
-                    'Promedio Subesp': kpis['promedio_subespecialidad'],
-                    '% Cobrar': f"{kpis['porcentaje_cobrar']:.1f}%",
-                    'A Cobrar': kpis['total_a_cobrar'],
-                    'OSA Retiene': kpis['a_cobrar_osa'],
-                    '% OSA': f"{kpis['porcentaje_osa']:.1f}%"
-                })
-        
-        df_medicos = pd.DataFrame(medicos_data)
+        st.caption("Suma de las liquidaciones mensuales de cada médico en los meses filtrados "
+                   "(cada mes se liquida contra el promedio de su subespecialidad en ese mes). "
+                   "Si el rango de fechas corta un mes, se aplica el % de ese mes solo al HHMM del rango.")
+        
+        registros_sin_fecha, hhmm_sin_fecha = resumen_sin_fecha(df)
+        if registros_sin_fecha:
+            st.warning(f"⚠️ {registros_sin_fecha:,} registros sin fecha de servicio (€{hhmm_sin_fecha:,.2f} HHMM) "
+                       "no entran en ninguna liquidación mensual. Corrige su fecha en el archivo para liquidarlos.")
+        
+        df_medicos = liquidaciones_de(df_filtered).groupby('Profesional', sort=False).agg(**{
+            'Subespecialidad': ('Subespecialidad', 'last'),
+            'Tipo': ('Tipo', 'last'),
+            'Registros': ('Registros', 'sum'),
+            'Facturado HHMM': ('Importe HHMM', 'sum'),
+            'Promedio Subesp': ('Promedio Subespecialidad', 'sum'),
+            'Meses por encima': ('Por encima', 'sum'),
+            'Meses': ('Por encima', 'size'),
+            'A Cobrar': ('A Cobrar', 'sum'),
+            'OSA Retiene': ('OSA Retiene', 'sum')
+        }).reset_index()
+        porcentaje_medico = (df_medicos['A Cobrar'] / df_medicos['Facturado HHMM'].where(df_medicos['Facturado HHMM'] != 0)) * 100
+        df_medicos.insert(7, '% Cobrar', porcentaje_medico.map(lambda v: f"{v:.1f}%" if pd.notna(v) else "-"))
+        df_medicos['% OSA'] = (100 - porcentaje_medico).map(lambda v: f"{v:.1f}%" if pd.notna(v) else "-")
+        df_medicos['Meses por encima'] = (
+            df_medicos['Meses por encima'].astype(int).astype(str) + '/' + df_medicos['Meses'].astype(str)
+        )
+        df_medicos = df_medicos.drop(columns='Meses')
         
         st.dataframe(
             df_medicos,
@@ -2577,7 +5283,9 @@ def dashboard_admin(df):
                 "Tipo": "Tipo",
                 "Registros": st.column_config.NumberColumn("Registros", format="%d"),
                 "Facturado HHMM": st.column_config.NumberColumn("Facturado HHMM (€)", format="€%.2f"),
-                "Promedio Subesp": st.column_config.NumberColumn("Promedio Subesp (€)", format="€%.2f"),
+                "Promedio Subesp": st.column_config.NumberColumn("Promedio Subesp (€)", format="€%.2f",
+                                                                 help="Suma de los promedios mensuales de la subespecialidad"),
+                "Meses por encima": "Meses por encima",
                 "% Cobrar": "% Médico",
                 "A Cobrar": st.column_config.NumberColumn("A Cobrar (€)", format="€%.2f"),
                 "OSA Retiene": st.column_config.NumberColumn("OSA Retiene (€)", format="€%.2f"),
@@ -2597,18 +5305,16 @@ def dashboard_medico(df, profesional_nombre):
     """Dashboard específico para médicos"""
     
     # Filtrar datos del médico
-    df_medico = df[df['Profesional'] == profesional_nombre].copy()
+    df_medico = filas_medico(df, profesional_nombre)
     
     if df_medico.empty:
         st.warning("No hay datos disponibles para este médico en el período actual.")
         return
     
-    # Obtener subespecialidad y calcular promedios
+    # Subespecialidad y KPIs a partir de sus liquidaciones mensuales
     subespecialidad = df_medico['Subespecialidad'].iloc[0]
-    promedio_subespecialidad, suma_total, num_medicos = calcular_promedio_subespecialidad(df, subespecialidad)
-    
-    # Calcular KPIs
-    kpis = calcular_a_cobrar_individual(df_medico, promedio_subespecialidad)
+    liquidaciones_medico = liquidaciones_de(df_medico)
+    kpis = calcular_a_cobrar_individual(liquidaciones_medico)
     
     if not kpis:
         st.error("Error calculando KPIs")
@@ -2695,7 +5401,7 @@ def dashboard_medico(df, profesional_nombre):
             <div style='font-size: 28px; font-weight: bold; color: {COLORES['primary']};'>
                 {kpis['porcentaje_cobrar']:.1f}%
             </div>
-            <small>{kpis['tipo_medico']} {'por encima' if kpis['por_encima_promedio'] else 'por debajo'}</small>
+            <small>{kpis['tipo_medico']} · {kpis['meses_por_encima']}/{kpis['meses_liquidados']} meses por encima</small>
         </div>
         """, unsafe_allow_html=True)
     
@@ -2795,6 +5501,28 @@ def dashboard_medico(df, profesional_nombre):
             )
             st.plotly_chart(fig_evol, use_container_width=True)
     
+    # Liquidaciones mensuales cerradas
+    with st.expander("📅 Liquidación mes a mes", expanded=False):
+        registros_sin_fecha, hhmm_sin_fecha = resumen_sin_fecha(df_medico)
+        if registros_sin_fecha:
+            st.warning(f"⚠️ {registros_sin_fecha:,} servicios sin fecha (€{hhmm_sin_fecha:,.2f} HHMM) no entran en "
+                       "ninguna liquidación mensual hasta que el administrador corrija su fecha.")
+        st.dataframe(
+            liquidaciones_medico.drop(columns=['Profesional', 'Por encima', 'Mes completo']).sort_values('Mes-Año', ascending=False),
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "Mes-Año": "Mes",
+                "Registros": st.column_config.NumberColumn("Registros", format="%d"),
+                "Importe Total": st.column_config.NumberColumn("Importe Total (€)", format="€%.2f"),
+                "Importe HHMM": st.column_config.NumberColumn("Importe HHMM (€)", format="€%.2f"),
+                "Promedio Subespecialidad": st.column_config.NumberColumn("Promedio Subesp. del mes (€)", format="€%.2f"),
+                "% Cobrar": st.column_config.NumberColumn("% Médico", format="%.1f%%"),
+                "A Cobrar": st.column_config.NumberColumn("A Cobrar (€)", format="€%.2f"),
+                "OSA Retiene": st.column_config.NumberColumn("OSA Retiene (€)", format="€%.2f")
+            }
+        )
+    
     st.markdown("---")
     
     # -------------------------------------------------------------------
@@ -2858,7 +5586,7 @@ def dashboard_medico(df, profesional_nombre):
     
     if columnas_existentes:
         # Crear DataFrame con las columnas seleccionadas
-        df_detalle = df_medico[columnas_existentes].copy()
+        df_detalle = df_medico[columnas_existentes]
         
         # Renombrar columnas
         df_detalle = df_detalle.rename(columns={k: v for k, v in columnas_deseadas.items() if k in df_detalle.columns})
@@ -2961,18 +5689,71 @@ def dashboard_medico(df, profesional_nombre):
         st.info("Para ver tu match personal, el administrador debe haber subido los dos archivos en su panel.")
         
         # Cargar los archivos de match desde el DataManager
-        archivo1_match = DataManager.load_dataframe('archivo1_match.parquet')
-        archivo2_match = DataManager.load_dataframe('archivo2_match.parquet')
+        # (el resultado del administrador, no los archivos: no se vuelve a conciliar)
+        match_pagados = DataManager.load_dataframe('match_pagados.parquet')
+        match_nopagados = DataManager.load_dataframe('match_nopagados.parquet')
         
-        if archivo1_match is not None and archivo2_match is not None:
+        if match_pagados is not None and match_nopagados is not None:
             # Usar la función de match personal
-            match_personal_medico(archivo1_match, archivo2_match, profesional_nombre)
+            match_personal_medico(match_pagados, match_nopagados, profesional_nombre)
         else:
             st.warning("El administrador aún no ha subido los archivos para realizar el match.")
             
             # Botón para solicitar al admin (opcional)
             if st.button("📧 Notificar al administrador", use_container_width=True):
                 st.info("Funcionalidad de notificación en desarrollo. Por ahora, contacta al administrador directamente.")
+        
+        st.markdown("---")
+        st.markdown("**📒 Tus pendientes de meses anteriores:**")
+        libro_pendientes(profesional_nombre)
+
+# -------------------------------------------------------------------
+# VERSIONES DE LOS DATOS (HISTORIAL Y RESTAURACIÓN)
+# -------------------------------------------------------------------
+def versiones_datos():
+    """Historial de versiones publicadas de los datos con opción de volver a una anterior"""
+    versiones = DataManager.listar_versiones()
+    if not versiones:
+        return
+    
+    actual = DataManager.version_actual()
+    with st.expander(f"🕘 Versiones de los datos ({len(versiones)})", expanded=False):
+        st.caption(f"Se conservan las {DataManager.MAX_VERSIONES} versiones más recientes. "
+                   "Restaurar una versión solo cambia cuál es la vigente; no borra las demás.")
+        historial = pd.DataFrame([{
+            'Vigente': '✅' if info['version'] == actual else '',
+            'Fecha': info.get('fecha', ''),
+            'Archivo': info.get('archivo', ''),
+            'Registros': info.get('registros'),
+            'Médicos': info.get('medicos'),
+            'Usuario': info.get('usuario', ''),
+            'Origen': info.get('origen', 'Carga de archivo'),
+            'Versión': info['version']
+        } for info in versiones])
+        st.dataframe(historial, use_container_width=True, hide_index=True)
+        
+        anteriores = [info['version'] for info in versiones if info['version'] != actual]
+        if not anteriores:
+            return
+        col_v1, col_v2 = st.columns([3, 1])
+        with col_v1:
+            version = st.selectbox(
+                "Versión a restaurar",
+                anteriores,
+                format_func=lambda v: f"{v} · {DataManager.get_upload_metadata(v).get('archivo', '')}",
+                key="version_restaurar"
+            )
+        with col_v2:
+            st.markdown("<div style='margin-top: 28px;'></div>", unsafe_allow_html=True)
+            restaurar = st.button("↩️ Restaurar", use_container_width=True, key="restaurar_version")
+        if restaurar:
+            if DataManager.restaurar_version(version):
+                df_restaurado = DataManager.load_dataframe()
+                guardar_datos_derivados(df_restaurado)
+                st.success(f"✅ Versión {version} restaurada.")
+                st.rerun()
+            else:
+                st.error("❌ La versión seleccionada ya no está disponible.")
 
 # -------------------------------------------------------------------
 # PANEL DE ADMINISTRADOR
@@ -3031,19 +5812,23 @@ def panel_admin(df_actual):
                     medicos_resumen = medicos_resumen.sort_values('Total Facturado', ascending=False)
                     st.dataframe(medicos_resumen, use_container_width=True, hide_index=True)
                 
+                # Profesionales que no están en el catálogo
+                revisar_nombres_desconocidos(df_procesado)
+                
+                # Validación de las líneas de servicio
+                informe_anomalias(df_procesado)
+                
                 # Confirmar guardado
                 if st.button("💾 Guardar Datos Permanentemente", use_container_width=True, type="primary"):
-                    if DataManager.save_dataframe(df_procesado):
-                        metadata = {
-                            'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                            'archivo': uploaded_file.name,
-                            'registros': len(df_procesado),
-                            'medicos': df_procesado['Profesional'].nunique(),
-                            'usuario': st.session_state['username']
-                        }
-                        DataManager.save_upload_metadata(metadata)
-                        
-                        st.session_state['df_global'] = df_procesado
+                    metadata = {
+                        'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        'archivo': uploaded_file.name,
+                        'registros': len(df_procesado),
+                        'medicos': df_procesado['Profesional'].nunique(),
+                        'usuario': st.session_state['username']
+                    }
+                    if DataManager.publicar_version(df_procesado, metadata):
+                        guardar_datos_derivados(df_procesado)
                         st.success("✅ Datos guardados correctamente. Ya están disponibles para todos los médicos.")
                         st.rerun()
             
@@ -3066,6 +5851,8 @@ def panel_admin(df_actual):
                 metadata = DataManager.get_upload_metadata()
                 if metadata:
                     st.metric("Última actualización", metadata.get('fecha', 'No disponible'))
+            
+            versiones_datos()
     
     with tab2:
         if df_actual is not None and not df_actual.empty:
@@ -3089,22 +5876,10 @@ def panel_admin(df_actual):
         **Versión:** 3.2.0  
         **Última actualización:** Febrero 2026  
         **Colores corporativos:** {COLORES['primary']} / {COLORES['secondary']}
-        
-        **Médicos configurados en el sistema:**
         """)
         
-        # Mostrar lista de médicos disponibles
-        medicos_sistema = []
-        for profesional in PROFESIONALES_INFO.keys():
-            info = PROFESIONALES_INFO[profesional]
-            medicos_sistema.append({
-                'Profesional': profesional,
-                'Especialidad': info['especialidad'],
-                'Tipo': info['tipo']
-            })
-        
-        df_medicos_sistema = pd.DataFrame(medicos_sistema)
-        st.dataframe(df_medicos_sistema, use_container_width=True, hide_index=True)
+        # Catálogo editable de médicos configurados en el sistema
+        editor_catalogo_profesionales(df_actual)
 
 # -------------------------------------------------------------------
 # FUNCIÓN PRINCIPAL
@@ -3121,6 +5896,9 @@ def main():
     username = st.session_state['username']
     rol = user_info['rol']
     
+    # Descartar resultados guardados en la sesión si retiene demasiada memoria
+    limitar_memoria_sesion()
+    
     # Sidebar con información del usuario
     with st.sidebar:
         st.markdown(f"""
@@ -3150,6 +5928,9 @@ def main():
                 st.warning("⏳ Esperando que el administrador cargue los datos...")
         
         st.markdown("---")
+        if rol == 'admin':
+            panel_perfilado()
+            panel_memoria()
         logout()
     
     # Mostrar header en área principal
@@ -3174,4 +5955,16 @@ def main():
             dashboard_medico(df_global, profesional)
 
 if __name__ == "__main__":
-    main()
+    ejecucion = st.session_state.get('ejecucion_actual', 0) + 1
+    st.session_state['ejecucion_actual'] = ejecucion
+    
+    # Perfilado opcional activado por el administrador en una ejecución anterior;
+    # la ejecución que provoca el clic en "Cancelar" no se perfila
+    activado_en = st.session_state.get('perfilar_proxima')
+    if (activado_en is not None and activado_en < ejecucion
+            and not st.session_state.get('cancelar_perfilado', False)
+            and st.session_state.get('user_info', {}).get('rol') == 'admin'):
+        del st.session_state['perfilar_proxima']
+        perfilar_ejecucion(main)
+    else:
+        main()
@@ -0,0 +1,80 @@
+"""
+Mide el tiempo de arranque en frío de la aplicación.
+
+Cada repetición se ejecuta en un proceso Python nuevo (sin módulos en caché)
+y mide:
+  - import_streamlit: importar Streamlit (línea base, no depende de app.py)
+  - primer_render:    ejecutar app.py hasta pintar la primera pantalla
+  - modulos_pesados:  si pandas / numpy / plotly quedaron cargados tras el render
+
+Uso:
+    python scripts/medir_arranque.py                 # pantalla de login
+    python scripts/medir_arranque.py --rol admin     # primera pantalla del admin
+    python scripts/medir_arranque.py --repeticiones 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+RUTA_APP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'app.py'))
+
+CODIGO_MEDICION = r'''
+import json, sys, time
+t0 = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+t1 = time.perf_counter()
+at = AppTest.from_file({ruta!r}, default_timeout=120)
+if {rol!r} == 'admin':
+    at.session_state['authentication_status'] = True
+    at.session_state['username'] = 'admin'
+    at.session_state['user_info'] = {{'rol': 'admin', 'nombre': 'Administrador'}}
+at.run()
+t2 = time.perf_counter()
+print(json.dumps({{
+    'import_streamlit': t1 - t0,
+    'primer_render': t2 - t1,
+    'modulos_pesados': sorted(m for m in ('pandas', 'numpy', 'plotly.express', 'openpyxl') if m in sys.modules),
+    'excepciones': len(at.exception),
+}}))
+'''
+
+
+def medir(rol, repeticiones):
+    """Ejecuta las repeticiones en procesos nuevos y devuelve las mediciones"""
+    codigo = CODIGO_MEDICION.format(ruta=RUTA_APP, rol=rol)
+    resultados = []
+    for _ in range(repeticiones):
+        salida = subprocess.run(
+            [sys.executable, '-c', codigo],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(RUTA_APP)
+        )
+        resultados.append(json.loads(salida.stdout.strip().splitlines()[-1]))
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide el arranque en frío de app.py")
+    parser.add_argument('--rol', choices=['login', 'admin'], default='login')
+    parser.add_argument('--repeticiones', type=int, default=5)
+    args = parser.parse_args()
+    
+    resultados = medir(args.rol, args.repeticiones)
+    
+    for clave in ('import_streamlit', 'primer_render'):
+        valores = [r[clave] for r in resultados]
+        print(f"{clave:18s} mediana {statistics.median(valores) * 1000:8.1f} ms   "
+              f"min {min(valores) * 1000:8.1f} ms   max {max(valores) * 1000:8.1f} ms")
+    
+    print(f"{'modulos_pesados':18s} {', '.join(resultados[-1]['modulos_pesados']) or '(ninguno)'}")
+    if any(r['excepciones'] for r in resultados):
+        print("⚠️ La aplicación lanzó excepciones durante el render")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Mide la lectura de los dos archivos del match (archivo 1 y archivo 2).
+
+Compara, sobre el mismo par de libros y con los mismos tipos de lectura:
+  - secuencial:  leer_archivos_match() de app.py (un archivo y luego el otro)
+  - hilos:       un hilo por archivo (ThreadPoolExecutor)
+  - procesos:    un proceso 'spawn' por archivo (ProcessPoolExecutor), contando
+                 el arranque de los procesos
+
+y muestra la mediana de cada modo y la aceleración frente a secuencial. Hilos
+y procesos son solo de referencia: la aplicación no los usa. Sin --archivos
+genera un par sintético con el número de filas indicado.
+
+Uso:
+    python scripts/medir_lectura_match.py                      # 20.000 filas
+    python scripts/medir_lectura_match.py --filas 100000 --repeticiones 3
+    python scripts/medir_lectura_match.py --archivos servicios.xlsx pagos.xlsx
+"""
+import argparse
+import functools
+import io
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+RUTA_PAQUETE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def libros_sinteticos(filas):
+    """Contenido .xlsx de un archivo 1 y un archivo 2 con las columnas del match"""
+    import numpy as np
+    import pandas as pd
+    azar = np.random.default_rng(0)
+    fechas = pd.Timestamp('2025-01-01') + pd.to_timedelta(azar.integers(0, 365, filas), unit='D')
+    pacientes = azar.integers(1, filas // 3 + 2, filas).astype(str)
+    prestaciones = np.array(['CONSULTA PRIMERA', 'CONSULTA SUCESIVA', 'ECOGRAFIA', 'RADIOGRAFIA TORAX'])[azar.integers(0, 4, filas)]
+    medicos = np.array([f'MEDICO {i:02d}, NOMBRE' for i in range(40)])[azar.integers(0, 40, filas)]
+    aseguradoras = np.array(['SANITAS', 'ADESLAS', 'DKV', 'PRIVADO'])[azar.integers(0, 4, filas)]
+    archivo1 = pd.DataFrame({
+        'Fecha': fechas, 'Paciente': pacientes, 'Denomin.prestación': prestaciones,
+        'Médico de tratamiento (nombre)': medicos, 'Aseguradora': aseguradoras,
+        'Centro': 'CENTRAL', 'Observaciones': ''
+    })
+    archivo2 = pd.DataFrame({
+        'Fecha del Servicio': fechas, 'NHC Paciente': pacientes, 'Descripción de Prestación': prestaciones,
+        'Profesional': medicos, 'Importe HHMM': azar.uniform(10, 200, filas).round(2),
+        '% Liquidación': 0.7, 'Aseguradora': aseguradoras
+    })
+    contenidos = []
+    for df in (archivo1, archivo2):
+        salida = io.BytesIO()
+        df.to_excel(salida, index=False)
+        contenidos.append(salida.getvalue())
+    return contenidos
+
+
+def medir(lectura, repeticiones):
+    """Tiempos (s) de las repeticiones de una lectura"""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        lectura()
+        tiempos.append(time.perf_counter() - inicio)
+    return tiempos
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide la lectura de los archivos del match")
+    parser.add_argument('--filas', type=int, default=20000)
+    parser.add_argument('--archivos', nargs=2, metavar=('ARCHIVO1', 'ARCHIVO2'))
+    parser.add_argument('--repeticiones', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    warnings.filterwarnings('ignore')
+    sys.path.insert(0, RUTA_PAQUETE)
+    import pandas as pd
+    import app
+
+    if args.archivos:
+        contenidos = [open(ruta, 'rb').read() for ruta in args.archivos]
+    else:
+        contenidos = libros_sinteticos(args.filas)
+    leer = functools.partial(pd.read_excel, dtype=app.TIPOS_LECTURA_MATCH)
+
+    def hilos():
+        with ThreadPoolExecutor(max_workers=len(contenidos)) as pool:
+            return list(pool.map(leer, map(io.BytesIO, contenidos)))
+
+    def procesos():
+        with ProcessPoolExecutor(max_workers=len(contenidos), mp_context=multiprocessing.get_context('spawn')) as pool:
+            return list(pool.map(leer, map(io.BytesIO, contenidos)))
+
+    modos = {
+        'secuencial': lambda: app.leer_archivos_match(*map(io.BytesIO, contenidos)),
+        'hilos': hilos,
+        'procesos': procesos,
+    }
+
+    print(f"CPU disponibles: {os.cpu_count()}   tamaño: "
+          f"{' + '.join(f'{len(c) / 1024:.0f} KB' for c in contenidos)}")
+    base = None
+    for modo, lectura in modos.items():
+        mediana = statistics.median(medir(lectura, args.repeticiones))
+        base = base or mediana
+        print(f"{modo:12s} mediana {mediana * 1000:8.1f} ms   aceleración x{base / mediana:4.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Mide la memoria de los trabajadores y de las sesiones al cargar los datos vigentes.
+
+Modo trabajadores: lanza N procesos Python a la vez (como N trabajadores de Streamlit detrás de
+un proxy) y en cada uno carga los datos de la versión vigente de dos formas:
+  - parquet: pd.read_parquet (cada proceso descomprime su propia copia)
+  - arrow:   DataManager.load_dataframe (Arrow IPC mapeado en memoria)
+
+De cada proceso se lee /proc/self/smaps_rollup (solo Linux):
+  - rss:      memoria residente total
+  - privada:  páginas solo de ese proceso (lo que crece con cada trabajador)
+  - compartida: páginas compartidas con otros procesos (caché del sistema)
+
+Modo sesiones: en un solo proceso abre M sesiones de administrador (AppTest)
+que se mantienen vivas, como M usuarios en un trabajador, y con tracemalloc
+mide por sesión:
+  - pico:      memoria Python/numpy asignada durante el render
+  - retenida:  lo que sigue asignado al terminar el render (copias por sesión)
+
+Uso:
+    python scripts/medir_memoria.py                  # 4 trabajadores
+    python scripts/medir_memoria.py --procesos 8
+    python scripts/medir_memoria.py --modo sesiones --sesiones 3
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+RUTA_PAQUETE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+CODIGO_MEDICION = r'''
+import json, logging, sys, time, warnings
+logging.disable(logging.CRITICAL)
+warnings.filterwarnings('ignore')
+sys.path.insert(0, {ruta!r})
+import app
+import pandas as pd
+
+def memoria():
+    valores = {{}}
+    with open('/proc/self/smaps_rollup') as f:
+        for linea in f:
+            partes = linea.split()
+            if len(partes) >= 3 and partes[-1] == 'kB':
+                valores[partes[0].rstrip(':')] = int(partes[1]) / 1024
+    return {{
+        'rss': valores.get('Rss', 0),
+        'privada': valores.get('Private_Clean', 0) + valores.get('Private_Dirty', 0),
+        'compartida': valores.get('Shared_Clean', 0) + valores.get('Shared_Dirty', 0),
+    }}
+
+base = memoria()
+if {modo!r} == 'parquet':
+    df = pd.read_parquet(app.DataManager._ruta_datos_version())
+else:
+    df = app.DataManager.load_dataframe()
+# Tocar todas las columnas, como haría un dashboard al agregar
+_ = [df[c].iloc[-1] for c in df.columns]
+_ = df.groupby('Profesional')['Importe HHMM'].sum()
+despues = memoria()
+# Esperar a que todos los trabajadores tengan los datos cargados a la vez
+time.sleep({espera})
+print(json.dumps({{
+    'registros': len(df),
+    **{{clave: despues[clave] - base[clave] for clave in despues}},
+}}))
+'''
+
+
+CODIGO_SESIONES = r'''
+import json, logging, tracemalloc, warnings
+logging.disable(logging.CRITICAL)
+warnings.filterwarnings('ignore')
+from streamlit.testing.v1 import AppTest
+
+MB = 1024 ** 2
+sesiones, resultados = [], []
+tracemalloc.start()
+for _ in range({sesiones}):
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    at = AppTest.from_file({ruta!r}, default_timeout=600)
+    at.session_state['authentication_status'] = True
+    at.session_state['username'] = 'admin'
+    at.session_state['user_info'] = {{'rol': 'admin', 'nombre': 'Administrador'}}
+    at.run()
+    actual, pico = tracemalloc.get_traced_memory()
+    resultados.append({{'pico': (pico - base) / MB, 'retenida': (actual - base) / MB, 'excepciones': len(at.exception)}})
+    sesiones.append(at)
+print(json.dumps(resultados))
+'''
+
+
+def medir_sesiones(sesiones):
+    """Abre las sesiones en un proceso nuevo y devuelve la medición de cada una"""
+    codigo = CODIGO_SESIONES.format(ruta=os.path.join(RUTA_PAQUETE, 'app.py'), sesiones=sesiones)
+    salida = subprocess.run([sys.executable, '-c', codigo], capture_output=True, text=True, check=True,
+                            cwd=RUTA_PAQUETE)
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def medir(modo, procesos, espera=2.0):
+    """Lanza los procesos a la vez y devuelve la medición de cada uno"""
+    codigo = CODIGO_MEDICION.format(ruta=RUTA_PAQUETE, modo=modo, espera=espera)
+    lanzados = [
+        subprocess.Popen([sys.executable, '-c', codigo], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         text=True, cwd=RUTA_PAQUETE)
+        for _ in range(procesos)
+    ]
+    return [json.loads(p.communicate()[0].strip().splitlines()[-1]) for p in lanzados]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide la memoria por trabajador al cargar los datos")
+    parser.add_argument('--modo', choices=['trabajadores', 'sesiones'], default='trabajadores')
+    parser.add_argument('--procesos', type=int, default=4)
+    parser.add_argument('--sesiones', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.modo == 'sesiones':
+        for numero, resultado in enumerate(medir_sesiones(args.sesiones), start=1):
+            print(f"sesión {numero}: pico {resultado['pico']:8.1f} MB   retenida {resultado['retenida']:8.1f} MB")
+            if resultado['excepciones']:
+                print("  ⚠️ La aplicación lanzó excepciones durante el render")
+        return
+
+    for modo in ('parquet', 'arrow'):
+        resultados = medir(modo, args.procesos)
+        print(f"{modo:8s} ({resultados[0]['registros']:,} registros, {args.procesos} procesos)")
+        for clave in ('rss', 'privada', 'compartida'):
+            valores = [r[clave] for r in resultados]
+            print(f"  {clave:11s} mediana {statistics.median(valores):8.1f} MB   "
+                  f"total {sum(valores):8.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
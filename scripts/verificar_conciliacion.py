@@ -0,0 +1,150 @@
+"""
+Comprobaciones de regresión del motor de conciliación (match de pagos).
+
+Cada comprobación construye un par de archivos mínimo en memoria, lo pasa
+por conciliar_archivos() (la misma ruta que el match del administrador y el
+match personal de los médicos) y verifica el resultado. No lee ni escribe
+la carpeta de datos.
+
+Uso:
+    python scripts/verificar_conciliacion.py
+"""
+import logging
+import os
+import sys
+import warnings
+
+RUTA_PAQUETE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def archivos_match(servicios, pagos):
+    """DataFrames del archivo 1 y del archivo 2 a partir de tuplas (fecha, paciente, prestación, médico[, importe])"""
+    import pandas as pd
+    df1 = pd.DataFrame(servicios, columns=['Fecha', 'Paciente', 'Denomin.prestación', 'Médico de tratamiento (nombre)'])
+    df2 = pd.DataFrame(pagos, columns=['Fecha del Servicio', 'NHC Paciente', 'Descripción de Prestación',
+                                       'Profesional', 'Importe HHMM'])
+    for df, columna in [(df1, 'Fecha'), (df2, 'Fecha del Servicio')]:
+        df[columna] = pd.to_datetime(df[columna])
+    return df1, df2
+
+
+def candidatos_sin_similitud(app):
+    """Mismo paciente y médico a ±1 día, pero prestaciones sin parecido: nada casa y no falla"""
+    df1, df2 = archivos_match(
+        [('2025-03-10', '1509', 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA')],
+        [('2025-03-11', '1509', 'RADIOGRAFIA TORAX', 'GARCIA LOPEZ, ANA', 40.0)]
+    )
+    conciliacion = app.conciliar_archivos(df1, df2, dias_tolerancia=1, umbral_similitud=0.6)
+    assert conciliacion['pares_tolerantes'].empty
+    assert not conciliacion['df1_norm']['Match'].any()
+    assert (conciliacion['resultado']['Estado'] == app.ESTADO_HUERFANO).sum() == 1
+
+
+def pacientes_numericos_con_huecos(app):
+    """Un NHC leído como float (1509.0, columna con huecos) casa con el mismo NHC leído como texto"""
+    df1, df2 = archivos_match(
+        [('2025-03-10', 1509.0, 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA'),
+         ('2025-03-10', None, 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA')],
+        [('2025-03-10', '1509', 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA', 40.0)]
+    )
+    norm1 = app.normalizar_para_match(df1, *app.COLUMNAS_MATCH_ARCHIVO1)
+    norm2 = app.normalizar_para_match(df2, *app.COLUMNAS_MATCH_ARCHIVO2)
+    assert norm1['Paciente_norm'].tolist() == ['1509', 'NAN']
+    assert norm1['llave_match'].iloc[0] == norm2['llave_match'].iloc[0]
+    assert app.conciliar_archivos(df1, df2)['df1_norm']['Match'].tolist() == [True, False]
+
+
+def ledger_con_llaves_antiguas(app):
+    """Los pendientes abiertos guardados con '…|1509.0|…' se cierran con pagos leídos como '1509'"""
+    import pandas as pd
+    df1, df2 = archivos_match(
+        [('2025-03-10', 1509.0, 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA')],
+        [('2025-04-02', '1509', 'OTRA PRESTACION', 'GARCIA LOPEZ, ANA', 10.0)]
+    )
+    ledger, _, nuevos = app.actualizar_ledger(
+        pd.DataFrame(columns=app.COLUMNAS_LEDGER), df1, app.conciliar_archivos(df1, df2),
+        lote_servicios='marzo', lote_pago='pago-marzo', nombre_pago='marzo.xlsx'
+    )
+    assert nuevos == 1
+    # Libro tal y como lo guardaba la versión anterior
+    ledger['Paciente_norm'] = '1509.0'
+    ledger['llave_match'] = ledger['llave_match'].str.replace('|1509|', '|1509.0|', regex=False)
+    ledger = app.migrar_llaves_ledger(ledger)
+    assert ledger['llave_match'].str.contains('|1509|', regex=False).all()
+
+    df1_abril, pagos_abril = archivos_match(
+        [('2025-04-05', '2000', 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA')],
+        [('2025-03-10', '1509', 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA', 40.0)]
+    )
+    _, cerrados, _ = app.actualizar_ledger(
+        ledger, df1_abril, app.conciliar_archivos(df1_abril, pagos_abril),
+        lote_servicios='abril', lote_pago='pago-abril', nombre_pago='abril.xlsx'
+    )
+    assert cerrados == 1
+
+
+def ledger_lote_ya_registrado(app):
+    """Un pago nuevo que casa directamente con servicios de un lote ya registrado cierra sus pendientes"""
+    import pandas as pd
+    servicios = [('2025-03-10', '1509', 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA'),
+                 ('2025-03-10', '1509', 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA'),
+                 ('2025-03-12', '2000', 'ECOGRAFIA', 'GARCIA LOPEZ, ANA')]
+    df1, pagos_marzo = archivos_match(
+        servicios, [('2025-03-10', '1509', 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA', 40.0)]
+    )
+    ledger, _, nuevos = app.actualizar_ledger(
+        pd.DataFrame(columns=app.COLUMNAS_LEDGER), df1, app.conciliar_archivos(df1, pagos_marzo),
+        lote_servicios='marzo', lote_pago='pago-marzo', nombre_pago='marzo.xlsx'
+    )
+    assert nuevos == 2
+
+    # Mismo archivo de servicios con el pago complementario: casan los dos servicios duplicados
+    df1, pagos_abril = archivos_match(
+        servicios, [('2025-03-10', '1509', 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA', 40.0),
+                    ('2025-03-10', '1509', 'CONSULTA PRIMERA', 'GARCIA LOPEZ, ANA', 35.0)]
+    )
+    ledger, cerrados, nuevos = app.actualizar_ledger(
+        ledger, df1, app.conciliar_archivos(df1, pagos_abril),
+        lote_servicios='marzo', lote_pago='pago-abril', nombre_pago='abril.xlsx'
+    )
+    assert (cerrados, nuevos) == (1, 0)
+    cobrados = ledger[ledger['Estado'] == app.ESTADO_COBRADO]
+    assert cobrados['Paciente_norm'].tolist() == ['1509']
+    assert cobrados['Cobrado OSA (€)'].iloc[0] == 35.0
+    assert ledger.loc[ledger['Estado'] == app.ESTADO_ABIERTO, 'Paciente_norm'].tolist() == ['2000']
+
+    # Repetir el mismo par de archivos no cierra nada más
+    _, cerrados, nuevos = app.actualizar_ledger(
+        ledger, df1, app.conciliar_archivos(df1, pagos_abril),
+        lote_servicios='marzo', lote_pago='pago-abril', nombre_pago='abril.xlsx'
+    )
+    assert (cerrados, nuevos) == (0, 0)
+
+
+COMPROBACIONES = [
+    candidatos_sin_similitud,
+    pacientes_numericos_con_huecos,
+    ledger_con_llaves_antiguas,
+    ledger_lote_ya_registrado,
+]
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    warnings.filterwarnings('ignore')
+    sys.path.insert(0, RUTA_PAQUETE)
+    import app
+
+    fallos = 0
+    for comprobacion in COMPROBACIONES:
+        try:
+            comprobacion(app)
+            print(f"✅ {comprobacion.__name__}")
+        except Exception as e:
+            fallos += 1
+            print(f"❌ {comprobacion.__name__}: {type(e).__name__}: {e}")
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == '__main__':
+    main()
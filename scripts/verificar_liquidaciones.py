@@ -0,0 +1,147 @@
+"""
+Comprobaciones de regresión de la liquidación mensual y de las reglas de cobro.
+
+Cada comprobación construye unos pocos registros en memoria (ya procesados:
+médico, fecha, HHMM, subespecialidad y tipo) y verifica las liquidaciones y el
+tramo aplicado. Se ejecutan dentro de un directorio temporal, así que no leen
+ni escriben la carpeta de datos.
+
+Uso:
+    python scripts/verificar_liquidaciones.py
+"""
+import logging
+import os
+import sys
+import tempfile
+import warnings
+
+RUTA_PAQUETE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def datos(registros):
+    """DataFrame procesado a partir de tuplas (médico, fecha, HHMM, subespecialidad, tipo)"""
+    import pandas as pd
+    df = pd.DataFrame(registros, columns=['Profesional', 'Fecha del Servicio', 'Importe HHMM',
+                                          'Subespecialidad', 'Tipo Médico'])
+    df['Fecha del Servicio'] = pd.to_datetime(df['Fecha del Servicio'])
+    df['Importe Total'] = df['Importe HHMM']
+    df['Mes-Año'] = df['Fecha del Servicio'].dt.strftime('%Y-%m')
+    return df
+
+
+def reglas(app, filas):
+    """Tabla de reglas a partir de tuplas (tipo, tramo, desde, % médico, vigente desde)"""
+    import pandas as pd
+    return pd.DataFrame(filas, columns=app.COLUMNAS_REGLAS)
+
+
+def mes_parcial_prorrateado(app):
+    """Un rango que corta un mes prorratea su HHMM con el % decidido sobre el mes completo"""
+    df = datos([
+        ('GARCIA LOPEZ, ANA', '2025-03-10', 100.0, 'MANO', 'ESPECIALISTA'),
+        ('GARCIA LOPEZ, ANA', '2025-03-20', 300.0, 'MANO', 'ESPECIALISTA'),
+        ('PEREZ RUIZ, LUIS', '2025-03-12', 200.0, 'MANO', 'ESPECIALISTA'),
+    ])
+    assert app.guardar_liquidaciones(df)
+    completo = app.liquidaciones_de(df).set_index('Profesional')
+    assert completo['Mes completo'].all()
+    assert completo.loc['GARCIA LOPEZ, ANA', 'Tramo'] == app.TRAMO_ENCIMA
+
+    parcial = app.liquidaciones_de(df[df['Fecha del Servicio'] <= '2025-03-15']).set_index('Profesional')
+    ana = parcial.loc['GARCIA LOPEZ, ANA']
+    assert not ana['Mes completo']
+    assert ana['Tramo'] == app.TRAMO_ENCIMA and ana['% Cobrar'] == completo.loc['GARCIA LOPEZ, ANA', '% Cobrar']
+    assert (ana['Registros'], ana['Importe HHMM']) == (1, 100.0)
+    assert ana['A Cobrar'] + ana['OSA Retiene'] == 100.0
+    assert ana['Promedio Subespecialidad'] == 300.0 * 0.25
+    # El otro médico tiene todo su mes dentro del rango
+    assert parcial.loc['PEREZ RUIZ, LUIS', 'Mes completo']
+
+
+def registros_sin_fecha(app):
+    """Los registros sin fecha no entran en ningún mes y se cuentan aparte"""
+    df = datos([
+        ('GARCIA LOPEZ, ANA', '2025-03-10', 100.0, 'MANO', 'ESPECIALISTA'),
+        ('GARCIA LOPEZ, ANA', None, 40.0, 'MANO', 'ESPECIALISTA'),
+    ])
+    liquidaciones = app.calcular_liquidaciones(df)
+    assert liquidaciones['Mes-Año'].tolist() == ['2025-03']
+    assert (liquidaciones['Registros'].sum(), liquidaciones['Importe HHMM'].sum()) == (1, 100.0)
+    assert app.resumen_sin_fecha(df) == (1, 40.0)
+
+
+def promedio_subespecialidad_cero(app):
+    """Con una subespecialidad sin facturación en el mes el médico está en el promedio (sin NaN)"""
+    df = datos([
+        ('GARCIA LOPEZ, ANA', '2025-03-10', 0.0, 'MANO', 'ESPECIALISTA'),
+        ('PEREZ RUIZ, LUIS', '2025-03-12', 0.0, 'MANO', 'CONSULTOR'),
+    ])
+    liquidaciones = app.calcular_liquidaciones(df)
+    assert liquidaciones['Rendimiento'].tolist() == [1.0, 1.0]
+    assert liquidaciones['Por encima'].all()
+    assert (liquidaciones['Tramo'] == app.TRAMO_ENCIMA).all()
+    assert not liquidaciones[['% Cobrar', 'A Cobrar', 'OSA Retiene']].isna().any().any()
+
+
+def tipos_antes_de_su_vigencia(app):
+    """Los meses anteriores a la primera vigencia de un tipo se liquidan con las reglas de '*'"""
+    tabla = reglas(app, [
+        ('ESPECIALISTA', 'Propia', 0.0, 85.0, '2025-06'),
+        (app.TIPO_CUALQUIERA, app.TRAMO_GENERAL, 0.0, 70.0, '2025-01'),
+    ])
+    casos = [
+        # tipo, mes, % esperado, tramo esperado
+        ('ESPECIALISTA', '2024-12', app.PORCENTAJE_COBRO_DEFECTO, app.TRAMO_GENERAL),
+        ('ESPECIALISTA', '2025-03', 0.70, app.TRAMO_GENERAL),
+        ('ESPECIALISTA', '2025-06', 0.85, 'Propia'),
+        ('ESPECIALISTA', '2025-09', 0.85, 'Propia'),
+        ('CONSULTOR', '2025-09', 0.70, app.TRAMO_GENERAL),
+    ]
+    tipos, meses, esperados, tramos = zip(*casos)
+    porcentaje, tramo = app.evaluar_reglas_cobro(tabla, list(tipos), list(meses), [1.0] * len(casos))
+    assert porcentaje.tolist() == list(esperados), porcentaje
+    assert tramo.tolist() == list(tramos), tramo
+
+    # La simulación what-if reproduce la misma regla
+    import pandas as pd
+    liquidaciones = pd.DataFrame({
+        'Profesional': [f'MEDICO {i}' for i in range(len(casos))],
+        'Mes-Año': list(meses), 'Tipo': list(tipos), 'Subespecialidad': 'X', 'Importe HHMM': 100.0
+    })
+    simulacion = app.reliquidar_variantes(
+        liquidaciones, [('Actual', tabla, app.BASE_PROMEDIO_ACTUAL)], gastos=app.cargar_modelo_costes()['gastos']
+    )
+    assert simulacion['porcentaje'][:, 0].tolist() == list(esperados), simulacion['porcentaje']
+
+
+COMPROBACIONES = [
+    mes_parcial_prorrateado,
+    registros_sin_fecha,
+    promedio_subespecialidad_cero,
+    tipos_antes_de_su_vigencia,
+]
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    warnings.filterwarnings('ignore')
+    sys.path.insert(0, RUTA_PAQUETE)
+    import app
+
+    fallos = 0
+    for comprobacion in COMPROBACIONES:
+        with tempfile.TemporaryDirectory() as directorio:
+            os.chdir(directorio)
+            try:
+                comprobacion(app)
+                print(f"✅ {comprobacion.__name__}")
+            except Exception as e:
+                fallos += 1
+                print(f"❌ {comprobacion.__name__}: {type(e).__name__}: {e}")
+            finally:
+                os.chdir(RUTA_PAQUETE)
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == '__main__':
+    main()
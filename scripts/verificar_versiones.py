@@ -0,0 +1,102 @@
+"""
+Comprobaciones de regresión de las versiones de los datos (DataManager).
+
+Cada comprobación publica unas pocas versiones pequeñas con
+DataManager.publicar_version() y verifica el puntero, la lectura, la
+restauración y la poda. Se ejecutan dentro de un directorio temporal, así que
+no leen ni escriben la carpeta de datos.
+
+Uso:
+    python scripts/verificar_versiones.py
+"""
+import logging
+import os
+import sys
+import tempfile
+import warnings
+
+RUTA_PAQUETE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def datos(importe):
+    """Datos mínimos de una versión; el importe la identifica"""
+    import pandas as pd
+    return pd.DataFrame({
+        'Profesional': ['GARCIA LOPEZ, ANA', 'PEREZ RUIZ, LUIS', 'GARCIA LOPEZ, ANA'],
+        'Fecha del Servicio': pd.to_datetime(['2025-03-20', None, '2025-03-10']),
+        'Importe HHMM': [importe, 1.0, 2.0]
+    })
+
+
+def publicar_y_leer(app):
+    """Publicar mueve el puntero a la nueva versión, que se lee ordenada por fecha (sin fecha al final)"""
+    DataManager = app.DataManager
+    assert DataManager.version_actual() is None and DataManager.load_dataframe() is None
+
+    primera = DataManager.publicar_version(datos(10.0), {'archivo': 'marzo.xlsx'})
+    segunda = DataManager.publicar_version(datos(20.0), {'archivo': 'marzo-bis.xlsx'})
+    assert primera and segunda and primera != segunda
+    assert DataManager.version_actual() == segunda == DataManager.firma_version()
+    assert DataManager.get_upload_metadata() == {'archivo': 'marzo-bis.xlsx', 'version': segunda}
+
+    df = DataManager.load_dataframe()
+    assert df['Importe HHMM'].tolist() == [2.0, 20.0, 1.0]
+    assert df['Fecha del Servicio'].isna().tolist() == [False, False, True]
+    assert DataManager.load_dataframe(version=primera)['Importe HHMM'].max() == 10.0
+    # Sin restos de publicaciones a medias
+    assert not [n for n in os.listdir(DataManager._ruta_versiones()) if n.startswith('.')]
+
+
+def restaurar_y_podar(app):
+    """Se conservan MAX_VERSIONES; restaurar solo mueve el puntero y la versión vigente no se poda"""
+    DataManager = app.DataManager
+    versiones = [DataManager.publicar_version(datos(float(i)), {}) for i in range(DataManager.MAX_VERSIONES + 2)]
+    conservadas = [info['version'] for info in DataManager.listar_versiones()]
+    assert conservadas == versiones[::-1][:DataManager.MAX_VERSIONES]
+
+    # Restaurar solo mueve el puntero; una versión ya podada no se puede restaurar
+    mas_antigua = conservadas[-1]
+    assert DataManager.restaurar_version(mas_antigua)
+    assert DataManager.version_actual() == mas_antigua
+    assert DataManager.load_dataframe()['Importe HHMM'].max() == float(versiones.index(mas_antigua))
+    assert not DataManager.restaurar_version(versiones[0])
+
+    # Con un límite menor la poda borra las sobrantes, pero nunca la vigente
+    limite = DataManager.MAX_VERSIONES
+    DataManager.MAX_VERSIONES = 2
+    try:
+        DataManager._podar_versiones()
+    finally:
+        DataManager.MAX_VERSIONES = limite
+    assert [info['version'] for info in DataManager.listar_versiones()] == conservadas[:2] + [mas_antigua]
+
+
+COMPROBACIONES = [
+    publicar_y_leer,
+    restaurar_y_podar,
+]
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    warnings.filterwarnings('ignore')
+    sys.path.insert(0, RUTA_PAQUETE)
+    import app
+
+    fallos = 0
+    for comprobacion in COMPROBACIONES:
+        with tempfile.TemporaryDirectory() as directorio:
+            os.chdir(directorio)
+            try:
+                comprobacion(app)
+                print(f"✅ {comprobacion.__name__}")
+            except Exception as e:
+                fallos += 1
+                print(f"❌ {comprobacion.__name__}: {type(e).__name__}: {e}")
+            finally:
+                os.chdir(RUTA_PAQUETE)
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == '__main__':
+    main()